@@ -0,0 +1,217 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.messages import AnyMessage
+
+from config.settings import settings
+from core.metrics import (
+    MEMORY_CACHE_EVICTIONS,
+    MEMORY_CACHE_REQUESTS,
+    MEMORY_CACHE_SIZE,
+    RESPONSE_CACHE_EVICTIONS,
+    RESPONSE_CACHE_REQUESTS,
+    RESPONSE_CACHE_SIZE,
+)
+
+
+@dataclass(frozen=True)
+class MemorySnapshot:
+    """The long term memories of a user, as used in the assistant's system prompt"""
+    user_profile: Any
+    todos: list[dict]
+    instructions: Any
+
+
+class MemorySnapshotCache:
+    """
+    Read-through cache of per-user memory snapshots, in front of the store.
+
+    Entries are evicted least-recently-used once `max_size` is reached and
+    expire after `ttl` seconds, which bounds how stale a snapshot can get when
+    another process writes to the same store. Update nodes invalidate the
+    user's entry whenever they write to the store. Hits, misses and evictions
+    are exported on /metrics.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, MemorySnapshot]] = OrderedDict()
+        # bumped on every invalidation, so loads that raced with a write are not cached
+        self._generation = 0
+        # the graph can also be run from several threads at once, each with its own event loop (sync `invoke`)
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: str) -> MemorySnapshot | None:
+        """Return the cached snapshot of a user, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(user_id, "expired")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                MEMORY_CACHE_REQUESTS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            MEMORY_CACHE_REQUESTS.labels(result="hit").inc()
+            return entry[1]
+
+    def set(self, user_id: str, snapshot: MemorySnapshot, generation: int | None = None):
+        """
+        Cache a snapshot of a user.
+
+        Pass the `generation` read before loading the snapshot; if any entry
+        was invalidated in the meantime the snapshot may be stale and is dropped.
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)), "size")
+            MEMORY_CACHE_SIZE.set(len(self._entries))
+
+    def invalidate(self, user_id: str):
+        """Drop the cached snapshot of a user after their memories changed"""
+        with self._lock:
+            self._generation += 1
+            if user_id in self._entries:
+                self._remove(user_id, "invalidated")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            MEMORY_CACHE_SIZE.set(0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size}
+
+    def _remove(self, user_id: str, reason: str):
+        del self._entries[user_id]
+        MEMORY_CACHE_EVICTIONS.labels(reason=reason).inc()
+        MEMORY_CACHE_SIZE.set(len(self._entries))
+
+
+class ResponseCache:
+    """
+    Cache of the assistant's replies to read-only turns, the turns that update no memory.
+
+    A reply is keyed on a digest of what the assistant answered from: its system
+    prompt, which holds the user's memories, the last `tail_messages` messages of
+    the thread and the normalized user message. Changed memories therefore never
+    serve an old reply, and update nodes also drop the user's replies as soon as
+    they write to the store. Entries are evicted least-recently-used once
+    `max_size` is reached and expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int = 0, ttl: float = 600.0, tail_messages: int = 2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tail_messages = tail_messages
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+        self._user_keys: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def make_key(self, system_msg: str, history: list[AnyMessage], message: str) -> str:
+        """Key of a reply to `message`, given the system prompt and the thread's messages before it"""
+        tail = history[len(history) - self.tail_messages:] if self.tail_messages > 0 else []
+        normalized = " ".join(re.findall(r"\w+", message.lower()))
+        content = json.dumps([system_msg,
+                              [[m.type, m.content, getattr(m, "tool_calls", None)] for m in tail],
+                              normalized], default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, user_id: str, key: str) -> str | None:
+        """Return the cached reply, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove((user_id, key), "expired")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                RESPONSE_CACHE_REQUESTS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end((user_id, key))
+            self.hits += 1
+            RESPONSE_CACHE_REQUESTS.labels(result="hit").inc()
+            return entry[1]
+
+    def set(self, user_id: str, key: str, reply: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[(user_id, key)] = (time.monotonic() + self.ttl, reply)
+            self._entries.move_to_end((user_id, key))
+            self._user_keys.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)), "size")
+            RESPONSE_CACHE_SIZE.set(len(self._entries))
+
+    def invalidate(self, user_id: str):
+        """Drop the cached replies of a user after their memories changed"""
+        with self._lock:
+            for key in list(self._user_keys.get(user_id, ())):
+                self._remove((user_id, key), "invalidated")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_keys.clear()
+            RESPONSE_CACHE_SIZE.set(0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size}
+
+    def _remove(self, entry_key: tuple[str, str], reason: str):
+        user_id, key = entry_key
+        del self._entries[entry_key]
+        keys = self._user_keys[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._user_keys[user_id]
+        RESPONSE_CACHE_EVICTIONS.labels(reason=reason).inc()
+        RESPONSE_CACHE_SIZE.set(len(self._entries))
+
+
+# Every worker process has its own caches and the update nodes only invalidate those of
+# their process, so with several workers the next turn could be served a stale snapshot
+# or reply by another one: the caches are turned off then
+_several_workers = settings.SERVICE_WORKERS > 1 and not settings.DEV
+
+memory_cache = MemorySnapshotCache(
+    max_size=0 if _several_workers else settings.MEMORY_CACHE_MAX_SIZE,
+    ttl=settings.MEMORY_CACHE_TTL_SECONDS,
+)
+
+response_cache = ResponseCache(
+    max_size=0 if _several_workers else settings.RESPONSE_CACHE_MAX_SIZE,
+    ttl=settings.RESPONSE_CACHE_TTL_SECONDS,
+    tail_messages=settings.RESPONSE_CACHE_TAIL_MESSAGES,
+)
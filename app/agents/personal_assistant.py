@@ -1,37 +1,230 @@
-import os
-
-from dotenv import load_dotenv
-# Load environment variables from .env file
-_  =load_dotenv()
-
 #import required libraries
-from typing import Literal
-import uuid
+from typing import Annotated, Literal
+import asyncio
 
 from datetime import datetime
-from trustcall import create_extractor
+from functools import cache
 
 from langchain_core.runnables import RunnableConfig
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, merge_message_runs
+from langchain_core.runnables.config import merge_configs
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, RemoveMessage, get_buffer_string, merge_message_runs, messages_to_dict
+from langchain_core.messages.utils import count_tokens_approximately
 
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.store.base import BaseStore
+from langgraph.store.base import BaseStore, PutOp
 from langgraph.store.memory import InMemoryStore
 
 
 from langgraph.graph import StateGraph, MessagesState, END, START
 
-from core.llm import model
+from core.llm import get_chat_model, with_fallbacks
+from core.metrics import metrics_callbacks, node_span
+from config.settings import settings
 
 from agents.prompts import *
-from agents.utilities import extract_tool_info
+from agents.utilities import changed_memory_ops, extract_tool_info, extraction_window, asearch_all, top_k_relevant
+from agents.utilities import asearch_relevant
+from memory.embeddings import get_index_config
 from agents.tools import Profile, ToDo, UpdateMemory
 
-from agents.utilities import profile_extractor, todo_extractor, spy
+from agents.utilities import create_assistant_model, get_profile_extractor, get_todo_extractor, ToolCallCollector
+from agents.write_behind import MemoryUpdateQueue
+from agents.cache import MemorySnapshot, memory_cache, response_cache
+
+
+@cache
+def get_assistant_model():
+    """
+    The assistant's model with the UpdateMemory tool bound once, instead of on every turn.
+    With parallel tool calls it can request several memory updates in one message
+    """
+    return with_fallbacks(get_chat_model("assistant"), create_assistant_model)
+
+
+@cache
+def get_memory_model():
+    """The model of the instructions updates and the conversation summaries"""
+    return with_fallbacks(get_chat_model("extraction"))
+
+# UpdateMemory type -> update node
+UPDATE_NODES = {
+    "user": "update_profile",
+    "todo": "update_todos",
+    "instructions": "update_instructions",
+}
+
+
+##State definition
+def merge_cursors(left: dict[str, str], right: dict[str, str]) -> dict[str, str]:
+    """Merge extraction cursors, newer values win."""
+    return {**left, **right}
+
+
+class AssistantState(MessagesState):
+    """Chat history plus, per memory type, the id of the last message it was extracted from."""
+    extraction_cursors: Annotated[dict[str, str], merge_cursors]
+    # running summary of the turns that were removed from the chat history
+    summary: str
+    # number of messages removed from the chat history, the position of its first message in the thread
+    transcript_length: int
+
+
+def extraction_cursors_namespace(user_id: str) -> tuple[str, str]:
+    """Store namespace of the extraction cursors of the background memory updates, by thread"""
+    return ("extraction_cursors", user_id)
+
+
+# Positions of a thread's messages per transcript chunk
+TRANSCRIPT_CHUNK_SIZE = 50
+
+
+def transcript_namespace(user_id: str, thread_id: str) -> tuple[str, str, str]:
+    """Store namespace of the messages the summaries removed from a thread's state, by chunk of positions"""
+    return ("transcripts", user_id, thread_id)
+
+
+def transcript_chunk_key(position: int) -> str:
+    """Key of the transcript chunk holding the message at `position` in the thread, keys sort in thread order"""
+    return f"{position // TRANSCRIPT_CHUNK_SIZE:010d}"
+
+
+async def save_transcript(store: BaseStore, namespace: tuple[str, ...], start: int, messages: list):
+    """
+    Store the messages removed from the state, the first of them at position `start`
+    of the thread. Saving the same messages again overwrites them.
+    """
+    if not messages:
+        return
+    dicts = messages_to_dict(messages)
+    # the first chunk may already hold the end of the previous summary
+    existing = await store.aget(namespace, transcript_chunk_key(start)) if start % TRANSCRIPT_CHUNK_SIZE else None
+    ops = []
+    for chunk_start in range(start - start % TRANSCRIPT_CHUNK_SIZE, start + len(dicts), TRANSCRIPT_CHUNK_SIZE):
+        low = max(start, chunk_start)
+        part = dicts[low - start:chunk_start + TRANSCRIPT_CHUNK_SIZE - start]
+        value = {"start": low, "messages": part}
+        if existing is not None and low == start:
+            value = {"start": existing.value["start"],
+                     "messages": existing.value["messages"][:start - existing.value["start"]] + part}
+        ops.append(PutOp(namespace, transcript_chunk_key(low), value, index=False))
+    await store.abatch(ops)
+
+
+def get_extraction_messages(state: AssistantState, memory_type: str) -> tuple[list, bool, dict]:
+    """Return the messages the memory update for `memory_type` should see, and the cursor update to save once it ran."""
+
+    # The last message is the tool call that requested the update
+    messages = state["messages"][:-1]
+    cursor = state.get("extraction_cursors", {}).get(memory_type) if settings.EXTRACTION_SINCE_LAST else None
+    window, truncated = extraction_window(messages, cursor, settings.EXTRACTION_MAX_TURNS)
+
+    cursor_update = {memory_type: messages[-1].id} if messages else {}
+    return window, truncated, cursor_update
+
+
+def get_trustcall_messages(state: AssistantState, memory_type: str) -> tuple[list, dict]:
+    """Merge the extraction window and the Trustcall instruction."""
+
+    window, truncated, cursor_update = get_extraction_messages(state, memory_type)
+    # Static instructions first, the parts that change between calls last
+    instruction = TRUSTCALL_INSTRUCTION
+    if truncated:
+        instruction += EXTRACTION_WINDOW_NOTE
+    if state.get("summary"):
+        instruction += CONVERSATION_SUMMARY.format(summary=state["summary"])
+    instruction += SYSTEM_TIME.format(time=datetime.now().isoformat())
+    updated_messages = list(merge_message_runs(messages=[SystemMessage(content=instruction)] + window))
+    return updated_messages, cursor_update
+
+
+def get_update_calls(state: AssistantState, update_type: str) -> list[dict]:
+    """Return the UpdateMemory tool calls of the last message requesting an update of `update_type`."""
+    return [tool_call for tool_call in state["messages"][-1].tool_calls
+            if tool_call["args"]["update_type"] == update_type]
+
+
+def split_conversation(messages: list, keep_turns: int) -> tuple[list, list]:
+    """Split the chat history into the older messages to summarize and the last `keep_turns` user turns."""
+
+    human_indexes = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+    if len(human_indexes) <= keep_turns:
+        return [], messages
+    # Split on a user message, so tool calls stay together with their results
+    split = human_indexes[-keep_turns] if keep_turns else len(messages)
+    return messages[:split], messages[split:]
 
 
 ##Node definitions
-def task_assistant(state: MessagesState, config: RunnableConfig, store: BaseStore):
+async def summarize_conversation(state: AssistantState, config: RunnableConfig, store: BaseStore):
+
+    """Fold the older turns of the thread into the running summary and remove them from the state."""
+
+    older_messages, _ = split_conversation(state["messages"], settings.SUMMARY_KEEP_TURNS)
+
+    # Summarize a plain transcript, so the summary call needs no tool definitions
+    conversation = get_buffer_string(older_messages)
+    summary = state.get("summary")
+    if summary:
+        prompt = EXTEND_SUMMARY.format(summary=summary, conversation=conversation)
+    else:
+        prompt = CREATE_SUMMARY.format(conversation=conversation)
+    response = await get_memory_model().ainvoke([HumanMessage(content=prompt)])
+
+    # Keep the removed messages for the thread's history, at their positions in the thread
+    configurable = config["configurable"]
+    transcript_length = state.get("transcript_length", 0)
+    await save_transcript(store, transcript_namespace(configurable["user_id"], configurable["thread_id"]),
+                          transcript_length, older_messages)
+
+    return {"summary": response.content,
+            "messages": [RemoveMessage(id=message.id) for message in older_messages],
+            "transcript_length": transcript_length + len(older_messages)}
+
+
+def retrieve_todos(top_k: int) -> bool:
+    """Whether ToDos are retrieved by relevance from the store's index instead of listed."""
+    return settings.MEMORY_INDEX_ENABLED and top_k > 0
+
+
+async def load_memory_snapshot(store: BaseStore, user_id: str) -> MemorySnapshot:
+    """Load the user's profile, ToDo list and instructions from the store concurrently."""
+
+    # When the ToDos are retrieved per message, the list is not loaded at all
+    list_todos = not retrieve_todos(settings.TODO_PROMPT_TOP_K)
+    profile_memories, todo_memories, instruction_memories = await asyncio.gather(
+        store.asearch(("profile", user_id)),
+        asearch_all(store, ("todo", user_id)) if list_todos else asyncio.sleep(0, result=[]),
+        store.asearch(("instructions", user_id)),
+    )
+
+    user_profile = profile_memories[0].value if profile_memories else None
+    todos = [mem.value for mem in todo_memories]
+    instructions = instruction_memories[0].value if instruction_memories else ""
+
+    return MemorySnapshot(user_profile=user_profile, todos=todos, instructions=instructions)
+
+
+def format_todos(todos: list[dict], query: str) -> str:
+    """Format the ToDo list for the system prompt, keeping the most relevant tasks of very large lists."""
+
+    top_k = settings.TODO_PROMPT_TOP_K
+    if not top_k or len(todos) <= top_k:
+        return "\n".join(f"{todo}" for todo in todos)
+
+    relevant = top_k_relevant(todos, query, top_k)
+    return (f"(showing the {len(relevant)} of {len(todos)} tasks most relevant to the conversation)\n"
+            + "\n".join(f"{todo}" for todo in relevant))
+
+
+def format_retrieved_todos(todos: list[dict]) -> str:
+    """Format the ToDos retrieved from the index for the system prompt."""
+
+    statuses = ", ".join(settings.TODO_ACTIVE_STATUSES) or "all"
+    return (f"(showing the {len(todos)} tasks most relevant to the conversation, with status: {statuses})\n"
+            + "\n".join(f"{todo}" for todo in todos))
+
+
+async def task_assistant(state: AssistantState, config: RunnableConfig, store: BaseStore):
 
     """Load memories from the store and use them to personalize the chatbot's response."""
     
@@ -45,36 +238,46 @@ def task_assistant(state: MessagesState, config: RunnableConfig, store: BaseStor
     user_id = config['configurable']['user_id']
 
 
-   # Retrieve profile memory from the store
-    namespace = ("profile", user_id)
-    memories = store.search(namespace)
-    if memories:
-        user_profile = memories[0].value
-    else:
-        user_profile = None
-
-    # Retrieve people memory from the store
-    namespace = ("todo", user_id)
-    memories = store.search(namespace)
-    todo = "\n".join(f"{mem.value}" for mem in memories)
-
-    # Retrieve custom instructions
-    namespace = ("instructions", user_id)
-    memories = store.search(namespace)
-    if memories:
-        instructions = memories[0].value
+    # Retrieve profile, ToDo list and custom instructions, from the cache if possible
+    snapshot = memory_cache.get(user_id)
+    if snapshot is None:
+        generation = memory_cache.generation
+        snapshot = await load_memory_snapshot(store, user_id)
+        memory_cache.set(user_id, snapshot, generation=generation)
+    
+    # Rank the ToDo list against the user's latest message
+    query = next((m.content for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), "")
+    if retrieve_todos(settings.TODO_PROMPT_TOP_K):
+        todo_items = await asearch_relevant(store, ("todo", user_id), query, settings.TODO_PROMPT_TOP_K, settings.TODO_ACTIVE_STATUSES)
+        todo = format_retrieved_todos([item.value for item in todo_items])
     else:
-        instructions = ""
+        todo = format_todos(snapshot.todos, query)
     
-    system_msg = MODEL_SYSTEM_MESSAGE.format(user_profile=user_profile, todo=todo, instructions=instructions)
+    # The static instructions come first, so the prompt prefix is the same for every turn and user
+    system_msg = MODEL_SYSTEM_MESSAGE + MODEL_MEMORY_CONTEXT.format(user_profile=snapshot.user_profile, todo=todo, instructions=snapshot.instructions)
+    if state.get("summary"):
+        system_msg += CONVERSATION_SUMMARY.format(summary=state["summary"])
+
+    # A new user message (rather than the reply after memory updates) may have been answered
+    # before, with the same memories and the same end of the conversation
+    cache_key = None
+    if response_cache.enabled and isinstance(state["messages"][-1], HumanMessage):
+        cache_key = response_cache.make_key(system_msg, state["messages"][:-1], query)
+        reply = response_cache.get(user_id, cache_key)
+        if reply is not None:
+            return {"messages": [AIMessage(content=reply)]}
 
     # Respond using memory as well as the chat history
-    response = model.bind_tools([UpdateMemory], parallel_tool_calls=False).invoke([SystemMessage(content=system_msg)]+state["messages"])
+    response = await get_assistant_model().ainvoke([SystemMessage(content=system_msg)]+state["messages"])
+
+    # Read-only turns, which update no memory, can be answered again from the cache
+    if cache_key is not None and not response.tool_calls:
+        response_cache.set(user_id, cache_key, response.content)
 
     return {"messages": [response]}
 
 
-def update_profile(state: MessagesState, config: RunnableConfig, store: BaseStore):
+async def update_profile(state: AssistantState, config: RunnableConfig, store: BaseStore):
 
     """Reflect on the chat history and update the memory collection."""
     
@@ -85,7 +288,7 @@ def update_profile(state: MessagesState, config: RunnableConfig, store: BaseStor
     namespace = ("profile", user_id)
 
     # Retrieve the most recent memories for context
-    existing_items = store.search(namespace)
+    existing_items = await store.asearch(namespace)
 
     # Format the existing memories for the Trustcall extractor
     tool_name = "Profile"
@@ -95,26 +298,28 @@ def update_profile(state: MessagesState, config: RunnableConfig, store: BaseStor
                           else None
                         )
 
-    # Merge the chat history and the instruction
-    TRUSTCALL_INSTRUCTION_FORMATTED=TRUSTCALL_INSTRUCTION.format(time=datetime.now().isoformat())
-    updated_messages=list(merge_message_runs(messages=[SystemMessage(content=TRUSTCALL_INSTRUCTION_FORMATTED)] + state["messages"][:-1]))
+    # Merge the recent chat history and the instruction
+    updated_messages, cursor_update = get_trustcall_messages(state, "profile")
 
     # Invoke the extractor
-    result = profile_extractor.invoke({"messages": updated_messages, 
-                                         "existing": existing_memories})
-
-    # Save save the memories from Trustcall to the store
-    for r, rmeta in zip(result["responses"], result["response_metadata"]):
-        store.put(namespace,
-                  rmeta.get("json_doc_id", str(uuid.uuid4())),
-                  r.model_dump(mode="json"),
-            )
-    tool_calls = state['messages'][-1].tool_calls
+    result = await get_profile_extractor().ainvoke({"messages": updated_messages, 
+                                         "existing": existing_memories},
+                                      config=config)
+
+    # Save the new and changed memories from Trustcall to the store in a single batch
+    put_ops = changed_memory_ops(namespace, result, existing_items)
+    if put_ops:
+        await store.abatch(put_ops)
+        memory_cache.invalidate(user_id)
+        response_cache.invalidate(user_id)
+
+    tool_calls = get_update_calls(state, "user")
     # Return tool message with update verification
-    return {"messages": [{"role": "tool", "content": "updated profile", "tool_call_id":tool_calls[0]['id']}]}
+    return {"messages": [{"role": "tool", "content": "updated profile", "tool_call_id":tool_call['id']} for tool_call in tool_calls],
+            "extraction_cursors": cursor_update}
 
 
-def update_todos(state: MessagesState, config: RunnableConfig, store: BaseStore):
+async def update_todos(state: AssistantState, config: RunnableConfig, store: BaseStore):
 
     """Reflect on the chat history and update the memory collection."""
     
@@ -124,8 +329,16 @@ def update_todos(state: MessagesState, config: RunnableConfig, store: BaseStore)
     # Define the namespace for the memories
     namespace = ("todo", user_id)
 
-    # Retrieve the most recent memories for context
-    existing_items = store.search(namespace)
+    # Merge the recent chat history and the instruction
+    updated_messages, cursor_update = get_trustcall_messages(state, "todo")
+
+    # Retrieve the existing ToDos, so Trustcall patches them instead of inserting duplicates:
+    # all of them, or only the ones most relevant to the conversation when there is an index
+    if retrieve_todos(settings.TODO_EXTRACTION_TOP_K):
+        query = "\n".join(m.content for m in updated_messages if isinstance(m, HumanMessage))
+        existing_items = await asearch_relevant(store, namespace, query, settings.TODO_EXTRACTION_TOP_K, settings.TODO_ACTIVE_STATUSES)
+    else:
+        existing_items = await asearch_all(store, namespace)
 
     # Format the existing memories for the Trustcall extractor
     tool_name = "ToDo"
@@ -135,30 +348,28 @@ def update_todos(state: MessagesState, config: RunnableConfig, store: BaseStore)
                           else None
                         )
 
-    # Merge the chat history and the instruction
-    TRUSTCALL_INSTRUCTION_FORMATTED=TRUSTCALL_INSTRUCTION.format(time=datetime.now().isoformat())
-    updated_messages=list(merge_message_runs(messages=[SystemMessage(content=TRUSTCALL_INSTRUCTION_FORMATTED)] + state["messages"][:-1]))
-
-
-    # Invoke the extractor
-    result = todo_extractor.invoke({"messages": updated_messages, 
-                                         "existing": existing_memories})
-
-    # Save save the memories from Trustcall to the store
-    for r, rmeta in zip(result["responses"], result["response_metadata"]):
-        store.put(namespace,
-                  rmeta.get("json_doc_id", str(uuid.uuid4())),
-                  r.model_dump(mode="json"),
-            )
+    # Invoke the extractor, collecting the tool calls Trustcall makes during this run
+    collector = ToolCallCollector()
+    result = await get_todo_extractor().ainvoke({"messages": updated_messages, 
+                                         "existing": existing_memories},
+                                   config=merge_configs(config, {"callbacks": [collector]}))
+
+    # Save the new and changed memories from Trustcall to the store in a single batch
+    put_ops = changed_memory_ops(namespace, result, existing_items)
+    if put_ops:
+        await store.abatch(put_ops)
+        memory_cache.invalidate(user_id)
+        response_cache.invalidate(user_id)
         
     # Respond to the tool call made in task_mAIstro, confirming the update    
-    tool_calls = state['messages'][-1].tool_calls
+    tool_calls = get_update_calls(state, "todo")
 
     # Extract the changes made by Trustcall and add the the ToolMessage returned to task_mAIstro
-    todo_update_msg = extract_tool_info(spy.called_tools, tool_name)
-    return {"messages": [{"role": "tool", "content": todo_update_msg, "tool_call_id":tool_calls[0]['id']}]}
+    todo_update_msg = extract_tool_info(collector.called_tools, tool_name)
+    return {"messages": [{"role": "tool", "content": todo_update_msg, "tool_call_id":tool_call['id']} for tool_call in tool_calls],
+            "extraction_cursors": cursor_update}
 
-def update_instructions(state: MessagesState, config: RunnableConfig, store: BaseStore):
+async def update_instructions(state: AssistantState, config: RunnableConfig, store: BaseStore):
 
     """Reflect on the chat history and update the memory collection."""
     
@@ -167,61 +378,178 @@ def update_instructions(state: MessagesState, config: RunnableConfig, store: Bas
     
     namespace = ("instructions", user_id)
 
-    existing_memory = store.get(namespace, "user_instructions")
+    existing_memory = await store.aget(namespace, "user_instructions")
         
     # Format the memory in the system prompt
-    system_msg = CREATE_INSTRUCTIONS.format(current_instructions=existing_memory.value if existing_memory else None)
-    new_memory = model.invoke([SystemMessage(content=system_msg)]+state['messages'][:-1] + [HumanMessage(content="Please update the instructions based on the conversation")])
-
-    # Overwrite the existing memory in the store 
+    window, truncated, cursor_update = get_extraction_messages(state, "instructions")
+    system_msg = CREATE_INSTRUCTIONS
+    if truncated:
+        system_msg += EXTRACTION_WINDOW_NOTE
+    system_msg += CURRENT_INSTRUCTIONS.format(current_instructions=existing_memory.value if existing_memory else None)
+    if state.get("summary"):
+        system_msg += CONVERSATION_SUMMARY.format(summary=state["summary"])
+    new_memory = await get_memory_model().ainvoke([SystemMessage(content=system_msg)] + window + [HumanMessage(content="Please update the instructions based on the conversation")])
+
+    # Overwrite the existing memory in the store, if it changed
     key = "user_instructions"
-    store.put(namespace, key, {"memory": new_memory.content})
-    tool_calls = state['messages'][-1].tool_calls
+    value = {"memory": new_memory.content}
+    if existing_memory is None or existing_memory.value != value:
+        # the instructions are always read by key, they don't need an embedding
+        await store.aput(namespace, key, value, index=False)
+        memory_cache.invalidate(user_id)
+        response_cache.invalidate(user_id)
+
+    tool_calls = get_update_calls(state, "instructions")
     # Return tool message with update verification
-    return {"messages": [{"role": "tool", "content": "updated instructions", "tool_call_id":tool_calls[0]['id']}]}
+    return {"messages": [{"role": "tool", "content": "updated instructions", "tool_call_id":tool_call['id']} for tool_call in tool_calls],
+            "extraction_cursors": cursor_update}
 
-# Conditional edge
-def route_message(state: MessagesState, config: RunnableConfig, store: BaseStore) -> Literal[END, "update_todos", "update_instructions", "update_profile"]:
+# Conditional edges
+def should_summarize(state: AssistantState) -> Literal["summarize_conversation", "task_assistant"]:
 
-    """Reflect on the memories and chat history to decide whether to update the memory collection."""
+    """Summarize the older turns first when the thread is over its message or token budget."""
+    messages = state['messages']
+    over_budget = ((settings.SUMMARY_MAX_MESSAGES and len(messages) > settings.SUMMARY_MAX_MESSAGES)
+                   or (settings.SUMMARY_MAX_TOKENS and count_tokens_approximately(messages) > settings.SUMMARY_MAX_TOKENS))
+    if over_budget and split_conversation(messages, settings.SUMMARY_KEEP_TURNS)[0]:
+        return "summarize_conversation"
+    return "task_assistant"
+
+
+def route_message(state: AssistantState, config: RunnableConfig, store: BaseStore) -> Literal[END] | list[Literal["update_todos", "update_instructions", "update_profile"]]:
+
+    """
+    Reflect on the memories and chat history to decide whether to update the memory collection.
+
+    Every memory type the assistant asked to update gets its update node, the
+    nodes run in parallel and the assistant replies once they are all done.
+    """
     message = state['messages'][-1]
     if len(message.tool_calls) ==0:
         return END
-    else:
-        tool_call = message.tool_calls[0]
-        if tool_call['args']['update_type'] == "user":
-            return "update_profile"
-        elif tool_call['args']['update_type'] == "todo":
-            return "update_todos"
-        elif tool_call['args']['update_type'] == "instructions":
-            return "update_instructions"
-        else:
-            raise ValueError
+
+    nodes = []
+    for tool_call in message.tool_calls:
+        update_type = tool_call['args']['update_type']
+        if update_type not in UPDATE_NODES:
+            raise ValueError(f"Unknown memory update type: {update_type}")
+        if UPDATE_NODES[update_type] not in nodes:
+            nodes.append(UPDATE_NODES[update_type])
+    return nodes
         
 
-def create_agent_graph(checkpointer, store) -> StateGraph:
-    """Create the agent graph for the personal assistant."""
+def create_schedule_memory_update(memory_queue: MemoryUpdateQueue):
+    """Create the node that hands memory updates over to the background queue."""
+
+    # UpdateMemory type -> (update node, memory type used for the extraction cursor)
+    update_nodes = {
+        "user": (update_profile, "profile"),
+        "todo": (update_todos, "todo"),
+        "instructions": (update_instructions, "instructions"),
+    }
+
+    async def schedule_memory_update(state: AssistantState, config: RunnableConfig, store: BaseStore):
+
+        """Schedule the memory updates in the background so the assistant can reply right away."""
+
+        # Get the user ID from the config
+        user_id = config['configurable']['user_id']
+
+        # The updates run after this turn is over, so they get their own copy of the
+        # state and a config without the callbacks of the current run
+        snapshot = {"messages": list(state["messages"]),
+                    "extraction_cursors": dict(state.get("extraction_cursors", {})),
+                    "summary": state.get("summary", "")}
+        configurable = {"user_id": user_id, "thread_id": config['configurable'].get('thread_id')}
+
+        def create_job(update_node):
+            async def job():
+                # The cursors of the updates that committed: a failed update leaves its cursor
+                # where it was, so the next update of that memory extracts the missed turns too.
+                # The jobs of a user run one after the other, so no other job moves them meanwhile
+                namespace = extraction_cursors_namespace(user_id)
+                committed = await store.aget(namespace, configurable["thread_id"])
+                cursors = committed.value if committed else snapshot["extraction_cursors"]
+                with node_span(update_node.__name__, write_behind=True) as span:
+                    update_config = {"configurable": configurable,
+                                     "callbacks": metrics_callbacks(span, node=update_node.__name__)}
+                    result = await update_node({**snapshot, "extraction_cursors": cursors}, update_config, store)
+                await store.aput(namespace, configurable["thread_id"],
+                                 merge_cursors(cursors, result["extraction_cursors"]), index=False)
+            return job
+
+        messages, scheduled = [], set()
+        for tool_call in state['messages'][-1].tool_calls:
+            update_type = tool_call['args']['update_type']
+            update_node, memory_type = update_nodes[update_type]
+
+            # One job per memory type, even if the assistant asked for it more than once
+            if memory_type not in scheduled:
+                memory_queue.submit(user_id, create_job(update_node))
+                scheduled.add(memory_type)
+
+            # Return tool message so the assistant can answer without waiting for the update
+            messages.append({"role": "tool", "content": f"{update_type} memory update scheduled", "tool_call_id":tool_call['id']})
+
+        # the cursors are only moved by the jobs, once their update is saved
+        return {"messages": messages}
+
+    return schedule_memory_update
+
+
+def create_agent_graph(checkpointer, store, memory_queue: MemoryUpdateQueue | None = None) -> StateGraph:
+    """
+    Create the agent graph for the personal assistant.
+
+    If a memory queue is given, memory updates are run in the background
+    (write-behind) instead of before the assistant's reply.
+    """
 
     # Create the graph + all nodes
-    builder = StateGraph(MessagesState)
+    builder = StateGraph(AssistantState)
 
     # Define the flow of the memory extraction process
+    builder.add_node(summarize_conversation)
     builder.add_node(task_assistant)
-    builder.add_node(update_todos)
-    builder.add_node(update_profile)
-    builder.add_node(update_instructions)
 
-    # Define the flow 
-    builder.add_edge(START, "task_assistant")
-    builder.add_conditional_edges("task_assistant", route_message)
-    builder.add_edge("update_todos", "task_assistant")
-    builder.add_edge("update_profile", "task_assistant")
-    builder.add_edge("update_instructions", "task_assistant")
+    # Keep long threads bounded before the assistant sees them
+    builder.add_conditional_edges(START, should_summarize)
+    builder.add_edge("summarize_conversation", "task_assistant")
+
+    if memory_queue is None:
+        builder.add_node(update_todos)
+        builder.add_node(update_profile)
+        builder.add_node(update_instructions)
+
+        # Define the flow, the update nodes requested in one message run in parallel
+        # and the assistant runs once after all of them. The path map is explicit, LangGraph
+        # can't infer it from route_message's return annotation
+        builder.add_conditional_edges("task_assistant", route_message, {
+            END: END,
+            "update_todos": "update_todos",
+            "update_profile": "update_profile",
+            "update_instructions": "update_instructions",
+        })
+        builder.add_edge("update_todos", "task_assistant")
+        builder.add_edge("update_profile", "task_assistant")
+        builder.add_edge("update_instructions", "task_assistant")
+
+    else:
+        builder.add_node("schedule_memory_update", create_schedule_memory_update(memory_queue))
+
+        # Every memory update goes through the background queue
+        builder.add_conditional_edges("task_assistant", route_message, {
+            END: END,
+            "update_todos": "schedule_memory_update",
+            "update_profile": "schedule_memory_update",
+            "update_instructions": "schedule_memory_update",
+        })
+        builder.add_edge("schedule_memory_update", "task_assistant")
 
 
     if checkpointer is None:
         checkpointer = MemorySaver()
     if store is None:
-        store = InMemoryStore()
+        store = InMemoryStore(index=get_index_config())
     # Compile the graph with the checkpointer and store
     return builder.compile(checkpointer=checkpointer, store=store)
\ No newline at end of file
@@ -1,4 +1,6 @@
-# Chatbot instruction for choosing what to update and what tools to call 
+# Chatbot instruction for choosing what to update and what tools to call.
+# The message is static so it stays byte-identical across turns and users (and
+# the provider can cache it), the current memories follow in MODEL_MEMORY_CONTEXT
 MODEL_SYSTEM_MESSAGE = """You are a personal assistant chatbot that helps users manage their ToDo list.
 
 You have a long term memory which keeps track of three things:
@@ -6,20 +8,7 @@ You have a long term memory which keeps track of three things:
 2. The user's ToDo list
 3. General instructions for updating the ToDo list
 
-Here is the current User Profile (may be empty if no information has been collected yet):
-<user_profile>
-{user_profile}
-</user_profile>
-
-Here is the current ToDo List (may be empty if no tasks have been added yet):
-<todo>
-{todo}
-</todo>
-
-Here are the current user-specified preferences for updating the ToDo list (may be empty if no preferences have been specified yet):
-<instructions>
-{instructions}
-</instructions>
+The current content of your long term memory is shown at the end of this message.
 
 Here are your instructions for reasoning about the user's messages:
 
@@ -39,21 +28,48 @@ Here are your instructions for reasoning about the user's messages:
 
 5. Respond naturally to user user after a tool call was made to save memories, or if no tool call was made."""
 
+# The user's memories, appended to MODEL_SYSTEM_MESSAGE
+MODEL_MEMORY_CONTEXT = """
+
+Here is the current User Profile (may be empty if no information has been collected yet):
+<user_profile>
+{user_profile}
+</user_profile>
+
+Here is the current ToDo List (may be empty if no tasks have been added yet):
+<todo>
+{todo}
+</todo>
+
+Here are the current user-specified preferences for updating the ToDo list (may be empty if no preferences have been specified yet):
+<instructions>
+{instructions}
+</instructions>"""
+
 
 
-# Trustcall instruction
+# Trustcall instruction, the system time is appended last to keep the instruction itself static
 TRUSTCALL_INSTRUCTION = """Reflect on following interaction. 
 
 Use the provided tools to retain any necessary memories about the user. 
 
-Use parallel tool calling to handle updates and insertions simultaneously.
+Use parallel tool calling to handle updates and insertions simultaneously."""
+
+SYSTEM_TIME = """
 
 System Time: {time}"""
 
-# Instructions for updating the ToDo list
+# Added to the extraction instructions when older messages are not resent
+EXTRACTION_WINDOW_NOTE = """
+
+Only the most recent part of the conversation is shown. Earlier messages have already been reflected in the existing memories, keep what they contain unless the conversation below changes it."""
+
+# Instructions for updating the ToDo list, followed by CURRENT_INSTRUCTIONS
 CREATE_INSTRUCTIONS = """Reflect on the following interaction.
 
-Based on this interaction, update your instructions for how to update ToDo list items. Use any feedback from the user to update how they like to have items added, etc.
+Based on this interaction, update your instructions for how to update ToDo list items. Use any feedback from the user to update how they like to have items added, etc."""
+
+CURRENT_INSTRUCTIONS = """
 
 Your current instructions are:
 
@@ -61,4 +77,33 @@ Your current instructions are:
 {current_instructions}
 </current_instructions>"""
 
+# Running summary of the older part of the conversation, appended to the system message
+CONVERSATION_SUMMARY = """
+
+Here is a summary of the earlier part of the conversation, older messages are no longer shown:
+<conversation_summary>
+{summary}
+</conversation_summary>"""
+
+# Instructions for summarizing the older part of the conversation
+CREATE_SUMMARY = """Here is the earlier part of a conversation between a user and their personal assistant:
+
+<conversation>
+{conversation}
+</conversation>
+
+Summarize it concisely. Keep the facts about the user, the decisions that were made, open questions and anything the assistant promised to do."""
+
+EXTEND_SUMMARY = """This is a summary of the conversation between a user and their personal assistant so far:
+
+<conversation_summary>
+{summary}
+</conversation_summary>
+
+Here are the messages that followed:
+
+<conversation>
+{conversation}
+</conversation>
 
+Extend the summary with these messages and keep it concise. Keep the facts about the user, the decisions that were made, open questions and anything the assistant promised to do."""
@@ -1,24 +1,40 @@
 # Inspect the tool calls for Trustcall
 
-from core.llm import model
-from trustcall import create_extractor
-from agents.tools import ToDo, Profile
+import asyncio
+import re
+import uuid
 
+from functools import cache
+
+from core.llm import get_chat_model, with_fallbacks
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
+from langchain_core.outputs import LLMResult
+from langgraph.store.base import BaseStore, Item, PutOp, SearchItem
+from agents.tools import ToDo, Profile, UpdateMemory
+from config.settings import settings
+
+
+class ToolCallCollector(BaseCallbackHandler):
+    """Collect the tool calls made by the chat models of a single Trustcall run.
+
+    Pass a fresh collector in the config of each extractor call, so the
+    captured tool calls belong to that call only.
+    """
+
+    # called in the event loop rather than in an executor thread by async runs
+    run_inline = True
 
-class Spy:
     def __init__(self):
         self.called_tools = []
 
-    def __call__(self, run):
-        q = [run]
-        while q:
-            r = q.pop()
-            if r.child_runs:
-                q.extend(r.child_runs)
-            if r.run_type == "chat_model":
-                self.called_tools.append(
-                    r.outputs["generations"][0][0]["message"]["kwargs"]["tool_calls"]
-                )
+    def on_llm_end(self, response: LLMResult, **kwargs):
+        if not response.generations or not response.generations[0]:
+            return
+        message = getattr(response.generations[0][0], "message", None)
+        if isinstance(message, AIMessage):
+            self.called_tools.append(message.tool_calls)
 
 
 # Extract information from tool calls for both patches and new memories in Trustcall
@@ -78,21 +94,169 @@ def extract_tool_info(tool_calls, schema_name="Memory"):
     
     return "\n\n".join(result_parts)
 
-# Initialize the spy for visibility into the tool calls made by Trustcall
-spy = Spy()
+# Read whole namespaces instead of stopping at the store's default search limit
+async def asearch_all(store: BaseStore, namespace: tuple[str, ...], page_size: int | None = None) -> list[Item]:
+    """Return every item in a namespace, reading it page by page.
+    
+    Args:
+        store: The store to read from
+        namespace: Namespace to list
+        page_size: Number of items per round-trip (defaults to MEMORY_SEARCH_PAGE_SIZE)
+    """
+    page_size = page_size or settings.MEMORY_SEARCH_PAGE_SIZE
+    items = []
+    while len(items) < settings.MEMORY_SEARCH_MAX_ITEMS:
+        page = await store.asearch(namespace, limit=page_size, offset=len(items))
+        items.extend(page)
+        if len(page) < page_size:
+            break
+    return items
+
+
+def _by_score(pages: list[list[SearchItem]], k: int) -> list[SearchItem]:
+    items = [item for page in pages for item in page]
+    # stores without an index return no score, they keep their order
+    items.sort(key=lambda item: item.score if item.score is not None else float("-inf"), reverse=True)
+    return items[:k]
+
+
+async def asearch_relevant(store: BaseStore, namespace: tuple[str, ...], query: str, k: int, statuses: list[str] | None = None) -> list[SearchItem]:
+    """Return the k items of a namespace most relevant to the query, using the store's embedding index.
+    
+    Args:
+        store: The store to search, configured with an index
+        namespace: Namespace to search
+        query: Text to rank against, usually the user's latest message
+        k: Number of items to return
+        statuses: Only return items whose `status` is one of these, searched
+            concurrently with one equality filter each since that is what every
+            store supports
+    """
+    if not statuses:
+        return await store.asearch(namespace, query=query, limit=k)
+    pages = await asyncio.gather(*(store.asearch(namespace, query=query, filter={"status": status}, limit=k)
+                                   for status in statuses))
+    return _by_score(list(pages), k)
+
+
+def _tokenize(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def top_k_relevant(values: list[dict], query: str, k: int) -> list[dict]:
+    """Return the k memory values that share the most words with the query.
+    
+    Ties keep the original order, so with an empty query this is simply the
+    first k values.
+
+    Args:
+        values: Memory values to rank (e.g. ToDo items)
+        query: Text to rank against, usually the user's latest message
+        k: Number of values to keep
+    """
+    if len(values) <= k:
+        return values
+    query_tokens = _tokenize(query)
+    scores = [len(query_tokens & _tokenize(str(value))) for value in values]
+    ranked = sorted(range(len(values)), key=lambda i: scores[i], reverse=True)[:k]
+    return [values[i] for i in sorted(ranked)]
+
+
+# Collapse Trustcall's results into a single batch of writes
+def changed_memory_ops(namespace: tuple[str, ...], result: dict, existing_items: list[Item]) -> list[PutOp]:
+    """Return the PutOps for the documents Trustcall created or changed.
+    
+    Documents whose value is identical to the one already in the store are
+    skipped, and so are repeated copies of the same new document. Patches of
+    existing documents are always kept, even when two of them end up equal.
+
+    Args:
+        namespace: Namespace the documents belong to
+        result: Output of a Trustcall extractor
+        existing_items: Items that were passed to the extractor as existing documents
+    """
+    existing_values = {item.key: item.value for item in existing_items}
+    ops = []
+    inserted_values = []
+    for r, rmeta in zip(result["responses"], result["response_metadata"]):
+        value = r.model_dump(mode="json")
+        if "json_doc_id" in rmeta:
+            key = rmeta["json_doc_id"]
+            if existing_values.get(key) == value:
+                continue
+        else:
+            if value in inserted_values:
+                continue
+            key = str(uuid.uuid4())
+            inserted_values.append(value)
+        ops.append(PutOp(namespace, key, value))
+    return ops
+
+
+# Select the part of the conversation an extractor needs to see
+def extraction_window(messages: list[AnyMessage], cursor: str | None = None, max_turns: int = 0) -> tuple[list[AnyMessage], bool]:
+    """Return the messages to extract memories from and whether older messages were left out.
+
+    The window starts after the message with id `cursor` (the last message seen
+    by the previous extraction) and is capped to the last `max_turns` user turns.
+    It always starts on a user message and contains at least the latest user turn.
+
+    Args:
+        messages: Chat history, without the message that requested the update
+        cursor: Id of the last message of the previous extraction, if any
+        max_turns: Maximum number of user turns to keep, 0 for no limit
+    """
+    human_indexes = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+
+    start = 0
+    if cursor is not None:
+        start = next((i + 1 for i, message in enumerate(messages) if message.id == cursor), 0)
+    if max_turns and len(human_indexes) > max_turns:
+        start = max(start, human_indexes[-max_turns])
+
+    # Start on a user message, so the window never opens with a dangling tool call
+    # (the same memory type can be updated twice in one turn, keep that turn)
+    if human_indexes:
+        start = next((i for i in human_indexes if i >= start), human_indexes[-1])
+
+    return messages[start:], start > 0
+
+
+def create_assistant_model(llm: BaseChatModel):
+    """Bind the UpdateMemory tool to the assistant's model, allowing several memory updates per message if enabled"""
+    return llm.bind_tools([UpdateMemory], parallel_tool_calls=settings.MEMORY_PARALLEL_UPDATES)
+
+
+def create_todo_extractor(llm: BaseChatModel):
+    """Create the Trustcall extractor for updating the ToDo list"""
+    from trustcall import create_extractor
+
+    return create_extractor(
+        llm,
+        tools=[ToDo],
+        tool_choice= "ToDo",
+        enable_inserts=True
+    )
+
+
+def create_profile_extractor(llm: BaseChatModel):
+    """Create the Trustcall extractor for updating the user's profile"""
+    from trustcall import create_extractor
+
+    return create_extractor(
+        llm,
+        tools = [Profile],
+        tool_choice="Profile"
+    )
+
 
-# Create the Trustcall extractor for updating the ToDo list 
-todo_extractor = create_extractor(
-model,
-tools=[ToDo],
-tool_choice= "ToDo",
-enable_inserts=True
-).with_listeners(on_end=spy)
+@cache
+def get_todo_extractor():
+    """The Trustcall extractor for updating the ToDo list, on the extraction model, created on first use"""
+    return with_fallbacks(get_chat_model("extraction"), create_todo_extractor)
 
 
-#Trustcall extractor for updating the user's profile
-profile_extractor = create_extractor(
-    model,
-    tools = [Profile],
-    tool_choice="Profile"
-)
\ No newline at end of file
+@cache
+def get_profile_extractor():
+    """The Trustcall extractor for updating the user's profile, created on first use"""
+    return with_fallbacks(get_chat_model("extraction"), create_profile_extractor)
@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+import logging
+from collections.abc import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryUpdateQueue:
+    """
+    Background queue that runs memory updates off the critical path of a turn.
+
+    Every user gets its own FIFO queue and worker task, so updates to the same
+    user's namespaces are applied in the order they were scheduled while
+    different users are processed concurrently. A worker exits as soon as its
+    queue is empty, so idle users do not hold on to a task.
+    """
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queues: dict[str, asyncio.Queue] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._closed = False
+
+    async def start(self):
+        """Bind the queue to the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._closed = False
+
+    def submit(self, user_id: str, job: Callable[[], Awaitable[None]]):
+        """
+        Schedule a memory update job for a user.
+
+        Safe to call from the event loop as well as from the worker threads
+        that LangGraph runs sync nodes on.
+        """
+        if self._loop is None or self._closed:
+            raise RuntimeError("Memory update queue is not running")
+        # run the workers in a fresh context, so jobs don't inherit the callbacks
+        # and tracing of the graph run that scheduled them
+        self._loop.call_soon_threadsafe(self._enqueue, user_id, job, context=contextvars.Context())
+
+    def pending(self, user_id: str | None = None) -> int:
+        """Number of jobs waiting to run, for one user or for everybody"""
+        if user_id is not None:
+            queue = self._queues.get(user_id)
+            return queue.qsize() if queue else 0
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def flush(self, user_id: str | None = None):
+        """Wait until the pending updates of a user (or of all users) are applied"""
+        if user_id is not None:
+            workers = [self._workers[user_id]] if user_id in self._workers else []
+        else:
+            workers = list(self._workers.values())
+        if workers:
+            await asyncio.gather(*(asyncio.shield(worker) for worker in workers))
+
+    async def close(self):
+        """Stop accepting new jobs and drain the ones already scheduled"""
+        self._closed = True
+        # let submissions already handed to the loop land in their queues
+        await asyncio.sleep(0)
+        await self.flush()
+
+    def _enqueue(self, user_id: str, job: Callable[[], Awaitable[None]]):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = asyncio.Queue()
+            self._workers[user_id] = asyncio.create_task(self._worker(user_id, queue))
+        queue.put_nowait(job)
+
+    async def _worker(self, user_id: str, queue: asyncio.Queue):
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                del self._queues[user_id]
+                del self._workers[user_id]
+                return
+
+            try:
+                await job()
+            except Exception:
+                logger.exception("Background memory update failed for user %s", user_id)
+            finally:
+                queue.task_done()
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+from pydantic import PrivateAttr
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from benchmarks.scenarios import Turn
+
+
+# Existing documents as Trustcall lists them in its system message
+INSTANCE_PATTERN = re.compile(r'<instance id=(\S+) schema_type="(\w+)">\n(.*?)\n</instance>', re.DOTALL)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic local chat model that plays scripted conversations.
+
+    The script maps every user message to a `Turn`, which says which memory
+    updates the assistant requests and what the Trustcall extractors return.
+    Every call sleeps for `latency` seconds to stand in for the provider, and
+    the number of calls and (approximate) tokens sent and received is counted.
+    """
+
+    script: dict[str, Turn] = {}
+    latency: float = 0.0
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _ids: Any = PrivateAttr(default_factory=itertools.count)
+    _stats: dict = PrivateAttr(default_factory=lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+
+    @classmethod
+    def from_turns(cls, turns: list[Turn], latency: float = 0.0) -> "ScriptedChatModel":
+        return cls(script={turn.message: turn for turn in turns}, latency=latency)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-chat-model"
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages, **kwargs))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages, **kwargs))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for chunk in self._chunks(self._respond(messages, **kwargs)):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(self._respond(messages, **kwargs)):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    @staticmethod
+    def _chunks(message: AIMessage):
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[
+                    {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                    for i, call in enumerate(message.tool_calls)
+                ],
+                usage_metadata=message.usage_metadata,
+            ))
+            return
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            text = word if i == len(words) - 1 else word + " "
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=text,
+                usage_metadata=message.usage_metadata if i == 0 else None,
+            ))
+
+    def _respond(self, messages: list[BaseMessage], tools=None, tool_choice=None, parallel_tool_calls=None, **kwargs) -> AIMessage:
+        tool_names = {tool["function"]["name"] for tool in tools or []}
+        turn = self._current_turn(messages)
+
+        if "UpdateMemory" in tool_names:
+            response = self._assistant_response(messages, turn, parallel_tool_calls is not False)
+        elif tool_names:
+            response = self._extraction_response(messages, turn, tool_names)
+        else:
+            # instructions and conversation summaries are plain text
+            response = AIMessage(content="Add a deadline and a time estimate to every task.")
+
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([response])
+        response.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                   "total_tokens": input_tokens + output_tokens}
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["input_tokens"] += input_tokens
+            self._stats["output_tokens"] += output_tokens
+        return response
+
+    def _current_turn(self, messages: list[BaseMessage]) -> Turn:
+        message = next((m for m in reversed(messages) if isinstance(m, HumanMessage)), None)
+        if message is None or message.content not in self.script:
+            return Turn(message="")
+        return self.script[message.content]
+
+    def _tool_call(self, name: str, args: dict) -> dict:
+        with self._lock:
+            return {"name": name, "args": args, "id": f"call_{next(self._ids)}", "type": "tool_call"}
+
+    def _assistant_response(self, messages: list[BaseMessage], turn: Turn, parallel: bool) -> AIMessage:
+        # updates already requested since the user's message
+        last_human = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage)) if turn.message else len(messages)
+        requested = sum(len(m.tool_calls) for m in messages[last_human:] if isinstance(m, AIMessage))
+        pending = turn.updates[requested:]
+        if not pending:
+            return AIMessage(content=turn.reply)
+        if not parallel:
+            pending = pending[:1]
+        return AIMessage(content="", tool_calls=[self._tool_call("UpdateMemory", {"update_type": update}) for update in pending])
+
+    def _extraction_response(self, messages: list[BaseMessage], turn: Turn, tool_names: set[str]) -> AIMessage:
+        system = next((m.content for m in messages if isinstance(m, SystemMessage)), "")
+        existing = INSTANCE_PATTERN.findall(system)
+        calls = []
+
+        if "ToDo" in tool_names:
+            calls += [self._tool_call("ToDo", {"task": task, "time_to_complete": "30", "solutions": ["do it"]})
+                      for task in turn.todos]
+            for task, changes in turn.todo_patches.items():
+                doc_id = next((doc_id for doc_id, _, doc in existing if task in doc), None)
+                if doc_id is not None:
+                    calls.append(self._patch_call(doc_id, changes))
+
+        elif "Profile" in tool_names:
+            calls.append(self._tool_call("Profile", dict(turn.profile)))
+
+        elif existing and turn.profile:
+            calls.append(self._patch_call(existing[0][0], turn.profile))
+
+        if not calls and existing:
+            # nothing to change, answer with an empty patch like a real model would
+            calls.append(self._patch_call(existing[0][0], {}))
+        elif not calls:
+            calls.append(self._tool_call("ToDo", {"task": turn.message or "follow up", "time_to_complete": "30", "solutions": ["do it"]}))
+        return AIMessage(content="", tool_calls=calls)
+
+    def _patch_call(self, doc_id: str, changes: dict) -> dict:
+        patches = [{"op": "replace", "path": f"/{field}", "value": value} for field, value in changes.items()]
+        return self._tool_call("PatchDoc", {"json_doc_id": doc_id, "planned_edits": "Apply the changes from the conversation.", "patches": patches})
+
+
+@contextmanager
+def install_fake_llm(model: BaseChatModel):
+    """Swap the assistant's, memory and Trustcall extractors' models for `model` while the block runs"""
+    import agents.personal_assistant as assistant
+    from agents.utilities import create_assistant_model, create_todo_extractor, create_profile_extractor
+
+    assistant_model = create_assistant_model(model)
+    todo_extractor = create_todo_extractor(model)
+    profile_extractor = create_profile_extractor(model)
+    # the cached providers of the models are swapped for ones returning the fake model
+    replacements = {
+        "get_assistant_model": lambda: assistant_model,
+        "get_memory_model": lambda: model,
+        "get_todo_extractor": lambda: todo_extractor,
+        "get_profile_extractor": lambda: profile_extractor,
+    }
+    originals = {name: getattr(assistant, name) for name in replacements}
+    for name, value in replacements.items():
+        setattr(assistant, name, value)
+    try:
+        yield model
+    finally:
+        for name, value in originals.items():
+            setattr(assistant, name, value)
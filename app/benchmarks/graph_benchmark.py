@@ -0,0 +1,255 @@
+"""
+Benchmark the agent graph with a scripted local LLM instead of Groq.
+
+Every LLM call is answered by `ScriptedChatModel` after a fixed latency, so the
+numbers show the overhead of the graph itself: per-node latency, store
+round-trips, tokens sent to the model and throughput with N concurrent users.
+
+    cd app
+    python -m benchmarks.graph_benchmark --users 20
+    python -m benchmarks.graph_benchmark --users 50 --latency 0.2 --write-behind
+    python -m benchmarks.graph_benchmark --backend postgres --scenario mixed_updates --json
+
+`--max-p95-ms` makes the run exit with status 1 when the p95 turn latency is
+over budget, so CI can catch regressions in graph overhead.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from collections.abc import Iterable
+from contextlib import asynccontextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.base import BaseStore, Op, Result
+from langgraph.store.memory import InMemoryStore
+
+from agents.cache import memory_cache, response_cache
+from agents.personal_assistant import create_agent_graph
+from agents.write_behind import MemoryUpdateQueue
+from benchmarks.fake_llm import ScriptedChatModel, install_fake_llm
+from benchmarks.scenarios import SCENARIOS, Turn
+from memory.embeddings import get_index_config
+from config.settings import settings, DatabaseType
+
+
+class CountingStore(BaseStore):
+    """Store wrapper counting round-trips (batch calls) and operations"""
+
+    def __init__(self, store: BaseStore):
+        self.store = store
+        self.round_trips = 0
+        self.operations = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _count(self, ops: list[Op]):
+        with self._lock:
+            self.round_trips += 1
+            self.operations += len(ops)
+
+    def batch(self, ops: Iterable[Op]) -> list[Result]:
+        ops = list(ops)
+        self._count(ops)
+        return self.store.batch(ops)
+
+    async def abatch(self, ops: Iterable[Op]) -> list[Result]:
+        ops = list(ops)
+        self._count(ops)
+        return await self.store.abatch(ops)
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Callback recording the latency of every graph node run"""
+
+    run_inline = True
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self._started: dict = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        metadata = metadata or {}
+        node = metadata.get("langgraph_node")
+        # only the nodes of the agent graph, not those of the subgraphs running inside
+        # them (Trustcall's extractors), whose checkpoint namespace is nested with "|",
+        # nor LangGraph's internal ones (__start__), like MetricsCallbackHandler
+        top_level = "|" not in metadata.get("langgraph_checkpoint_ns", "")
+        if node and kwargs.get("name") == node and not node.startswith("__") and top_level:
+            self._started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            node, start = started
+            with self._lock:
+                self.latencies[node].append(time.perf_counter() - start)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(values: list[float]) -> dict:
+    """Latency summary in milliseconds"""
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "max_ms": round(max(values, default=0.0) * 1000, 2),
+    }
+
+
+@asynccontextmanager
+async def open_backend(backend: str):
+    """Yield a (checkpointer, store) pair for the requested backend"""
+    if backend == "memory":
+        yield MemorySaver(), InMemoryStore(index=get_index_config())
+        return
+
+    from memory import initialize_memory
+    settings.DATABASE_TYPE = DatabaseType(backend)
+    async with initialize_memory() as (saver, store):
+        yield saver, store
+
+
+async def run_user(agent, turns: list[Turn], user_id: str, timer: NodeTimer, turn_latencies: list[float]):
+    """Play the scenario as one user on one thread, turn after turn"""
+    config = {"configurable": {"thread_id": f"{user_id}_bench", "user_id": user_id}, "callbacks": [timer]}
+    for turn in turns:
+        start = time.perf_counter()
+        await agent.ainvoke({"messages": [HumanMessage(content=turn.message)]}, config=config)
+        turn_latencies.append(time.perf_counter() - start)
+
+
+async def run_benchmark(scenario: str = "daily_planning", users: int = 10, latency: float = 0.0,
+                        backend: str = "memory", write_behind: bool = False) -> dict:
+    """Run the scenario for `users` concurrent users and return the report"""
+    turns = SCENARIOS[scenario]
+    model = ScriptedChatModel.from_turns(turns, latency=latency)
+    timer = NodeTimer()
+    turn_latencies: list[float] = []
+    memory_cache.clear()
+    response_cache.clear()
+
+    async with open_backend(backend) as (saver, store):
+        store = CountingStore(store)
+        memory_queue = None
+        if write_behind:
+            memory_queue = MemoryUpdateQueue()
+            await memory_queue.start()
+
+        with install_fake_llm(model):
+            agent = create_agent_graph(checkpointer=saver, store=store, memory_queue=memory_queue)
+            # fresh user ids, so persistent backends start from empty memories
+            run_id = uuid.uuid4().hex[:8]
+
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                run_user(agent, turns, f"bench-{run_id}-{i}", timer, turn_latencies) for i in range(users)
+            ))
+            wall_time = time.perf_counter() - start
+
+            drain_time = 0.0
+            if memory_queue is not None:
+                start = time.perf_counter()
+                await memory_queue.close()
+                drain_time = time.perf_counter() - start
+
+    total_turns = users * len(turns)
+    llm = model.stats
+    return {
+        "scenario": scenario,
+        "backend": backend,
+        "users": users,
+        "turns": total_turns,
+        "llm_latency_ms": latency * 1000,
+        "write_behind": write_behind,
+        "wall_time_s": round(wall_time, 3),
+        "write_behind_drain_s": round(drain_time, 3),
+        "throughput_turns_per_s": round(total_turns / wall_time, 2) if wall_time else 0.0,
+        "turn_latency": summarize(turn_latencies),
+        "nodes": {node: summarize(values) for node, values in sorted(timer.latencies.items())},
+        "store": {
+            "round_trips": store.round_trips,
+            "operations": store.operations,
+            "round_trips_per_turn": round(store.round_trips / total_turns, 2),
+        },
+        "llm": {
+            **llm,
+            "calls_per_turn": round(llm["calls"] / total_turns, 2),
+            "input_tokens_per_turn": round(llm["input_tokens"] / total_turns, 1),
+        },
+        "memory_cache": memory_cache.stats(),
+        "response_cache": response_cache.stats(),
+    }
+
+
+def print_report(report: dict):
+    print(f"scenario={report['scenario']} backend={report['backend']} users={report['users']} "
+          f"turns={report['turns']} llm_latency={report['llm_latency_ms']:.0f}ms write_behind={report['write_behind']}")
+    print(f"wall time {report['wall_time_s']}s, throughput {report['throughput_turns_per_s']} turns/s")
+    latency = report["turn_latency"]
+    print(f"turn latency  mean {latency['mean_ms']}ms  p50 {latency['p50_ms']}ms  p95 {latency['p95_ms']}ms  max {latency['max_ms']}ms")
+    print()
+    print(f"{'node':<24}{'runs':>8}{'mean ms':>12}{'p95 ms':>12}")
+    for node, stats in report["nodes"].items():
+        print(f"{node:<24}{stats['count']:>8}{stats['mean_ms']:>12}{stats['p95_ms']:>12}")
+    print()
+    store, llm = report["store"], report["llm"]
+    print(f"store: {store['round_trips']} round-trips ({store['round_trips_per_turn']} per turn), {store['operations']} operations")
+    print(f"llm: {llm['calls']} calls ({llm['calls_per_turn']} per turn), "
+          f"{llm['input_tokens']} input tokens ({llm['input_tokens_per_turn']} per turn), {llm['output_tokens']} output tokens")
+    print(f"memory cache: {report['memory_cache']}")
+    print(f"response cache: {report['response_cache']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the agent graph with a scripted local LLM")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="daily_planning")
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent users")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every fake LLM call takes")
+    parser.add_argument("--backend", choices=["memory", "postgres", "mongo"], default="memory")
+    parser.add_argument("--write-behind", action="store_true", help="run memory updates in the background queue")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="fail when the p95 turn latency is higher")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(
+        scenario=args.scenario,
+        users=args.users,
+        latency=args.latency,
+        backend=args.backend,
+        write_behind=args.write_behind,
+    ))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.max_p95_ms is not None and report["turn_latency"]["p95_ms"] > args.max_p95_ms:
+        print(f"p95 turn latency {report['turn_latency']['p95_ms']}ms is over the budget of {args.max_p95_ms}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
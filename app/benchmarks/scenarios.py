@@ -0,0 +1,54 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Turn:
+    """One scripted user message and what the fake LLM does with it"""
+    message: str
+    # UpdateMemory types the assistant calls for this message ("user", "todo", "instructions")
+    updates: list[str] = field(default_factory=list)
+    # Profile fields the profile extractor sets
+    profile: dict = field(default_factory=dict)
+    # New tasks the ToDo extractor inserts
+    todos: list[str] = field(default_factory=list)
+    # Existing tasks the ToDo extractor patches, task name -> changed fields
+    todo_patches: dict[str, dict] = field(default_factory=dict)
+    reply: str = "Sure, I have taken care of that for you. Let me know if there is anything else you need."
+
+
+# A week of a typical user: profile facts, bursts of new tasks, task updates,
+# instruction changes and read-only questions
+DAILY_PLANNING = [
+    Turn("Hi, I'm Sam, I'm a software engineer living in Berlin.",
+         updates=["user"], profile={"name": "Sam", "job": "software engineer", "location": "Berlin"}),
+    Turn("Remind me to book flights to Lisbon, renew my passport and call mum on Sunday.",
+         updates=["todo"], todos=["book flights to Lisbon", "renew passport", "call mum"]),
+    Turn("What's on my list today?"),
+    Turn("Always add a deadline and a time estimate to my tasks.", updates=["instructions"]),
+    Turn("I also need to buy a birthday present for Alex, prepare the quarterly review and fix the bike.",
+         updates=["todo"], todos=["buy birthday present for Alex", "prepare quarterly review", "fix the bike"]),
+    Turn("I booked the flights to Lisbon.", updates=["todo"], todo_patches={"book flights to Lisbon": {"status": "done"}}),
+    Turn("By the way, I love climbing and my sister Mia lives in Hamburg.",
+         updates=["user"], profile={"interests": ["climbing"], "connections": ["Mia (sister, Hamburg)"]}),
+    Turn("Can you suggest how to approach the quarterly review?"),
+    Turn("I'm working on the quarterly review now.",
+         updates=["todo"], todo_patches={"prepare quarterly review": {"status": "in progress"}}),
+    Turn("Add: schedule dentist appointment, pay rent, and water the plants.",
+         updates=["todo"], todos=["schedule dentist appointment", "pay rent", "water the plants"]),
+    Turn("What should I focus on this afternoon?"),
+    Turn("Thanks, that's all for now."),
+]
+
+# Short scenario hitting every memory type in one turn
+MIXED_UPDATES = [
+    Turn("I'm Sam from Berlin, remind me to book flights, and always add deadlines.",
+         updates=["user", "todo", "instructions"], profile={"name": "Sam", "location": "Berlin"},
+         todos=["book flights"]),
+    Turn("What's on my list?"),
+]
+
+
+SCENARIOS = {
+    "daily_planning": DAILY_PLANNING,
+    "mixed_updates": MIXED_UPDATES,
+}
@@ -0,0 +1,135 @@
+"""
+Benchmark the cold start of the service: how long `import service.service` takes.
+
+Every run imports the service in a fresh interpreter with `python -X importtime`
+and without any API key, so the numbers are those of a new replica booting.
+It reports the import time, the slowest modules, and the heavy modules that
+must only be imported on first use (LLM clients, Trustcall, database drivers).
+
+    cd app
+    python -m benchmarks.startup_benchmark
+    python -m benchmarks.startup_benchmark --runs 10 --max-ms 1500 --json
+
+The run exits with status 1 when one of the lazy modules is imported at
+startup, or when the median import time is over `--max-ms` (DEFAULT_MAX_MS by
+default, 0 turns the budget off). Most of the import time is FastAPI and
+LangGraph themselves, which take about 1.3s on a small VM.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+# Budget of the median import time, with headroom over the ~1.0-1.4s measured on a small VM
+DEFAULT_MAX_MS = 2000.0
+
+# Imported on first use only: the LLM providers, Trustcall and the database drivers
+LAZY_MODULES = (
+    "groq",
+    "langchain_groq",
+    "langchain_openai",
+    "openai",
+    "trustcall",
+    "langgraph.checkpoint.postgres",
+    "langgraph.store.postgres",
+    "psycopg_pool",
+    "langgraph.checkpoint.mongodb",
+    "pymongo",
+    "streamlit",
+)
+
+IMPORT_SCRIPT = f"""
+import json, sys
+import service.service
+print(json.dumps(sorted(m for m in {LAZY_MODULES!r} if m in sys.modules)))
+"""
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """(module, self µs, cumulative µs) of every line of the `-X importtime` output"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def import_service() -> dict:
+    """Import the service in a fresh interpreter, without the API keys"""
+    env = {key: value for key, value in os.environ.items() if not key.endswith("_API_KEY")}
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+                            cwd=APP_DIR, env=env, capture_output=True, text=True)
+    wall_time = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing the service failed:\n{result.stderr[-2000:]}")
+
+    modules = parse_importtime(result.stderr)
+    import_us = next(cumulative for name, _, cumulative in reversed(modules) if name == "service.service")
+    return {"wall_time_s": wall_time, "import_us": import_us, "modules": modules,
+            "lazy_imported": json.loads(result.stdout.strip().splitlines()[-1])}
+
+
+def run_benchmark(runs: int = 5, top: int = 15) -> dict:
+    results = [import_service() for _ in range(runs)]
+    import_ms = [result["import_us"] / 1000 for result in results]
+    wall_ms = [result["wall_time_s"] * 1000 for result in results]
+    slowest = sorted(results[-1]["modules"], key=lambda module: module[1], reverse=True)[:top]
+    return {
+        "runs": runs,
+        "import_ms": {"median": round(statistics.median(import_ms), 1), "min": round(min(import_ms), 1),
+                      "max": round(max(import_ms), 1)},
+        "process_ms": {"median": round(statistics.median(wall_ms), 1)},
+        "slowest_modules": [{"module": name, "self_ms": round(self_us / 1000, 1), "cumulative_ms": round(cumulative_us / 1000, 1)}
+                            for name, self_us, cumulative_us in slowest],
+        "lazy_modules_imported": results[-1]["lazy_imported"],
+    }
+
+
+def print_report(report: dict):
+    imports = report["import_ms"]
+    print(f"import service.service over {report['runs']} runs: median {imports['median']}ms "
+          f"(min {imports['min']}ms, max {imports['max']}ms), whole process {report['process_ms']['median']}ms")
+    print()
+    print(f"{'module':<48}{'self ms':>10}{'cumul. ms':>12}")
+    for module in report["slowest_modules"]:
+        print(f"{module['module']:<48}{module['self_ms']:>10}{module['cumulative_ms']:>12}")
+    print()
+    print(f"lazy modules imported at startup: {report['lazy_modules_imported'] or 'none'}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the service")
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters to import the service in")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules to report")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-ms", type=float, default=DEFAULT_MAX_MS,
+                        help="fail when the median import time is higher, 0 turns the budget off")
+    args = parser.parse_args()
+
+    report = run_benchmark(runs=args.runs, top=args.top)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if report["lazy_modules_imported"]:
+        print(f"modules that should be imported on first use were imported at startup: {report['lazy_modules_imported']}", file=sys.stderr)
+        return 1
+    if args.max_ms and report["import_ms"]["median"] > args.max_ms:
+        print(f"median import time {report['import_ms']['median']}ms is over the budget of {args.max_ms}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
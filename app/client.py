@@ -1,8 +1,16 @@
-import requests
 import json
 import logging
+import random
+import time
+import asyncio
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass
 from typing import Dict, Optional
 
+import httpx
+
+from config.settings import settings
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -14,74 +22,368 @@ class ChatAPIError(Exception):
     """Custom exception for chat API related errors"""
     pass
 
+
+# The service's admission rejections: the turn did not run, so a chat request can safely be sent again
+RETRY_STATUS_CODES = {429, 503}
+# A gateway error may come after the turn ran, only the read requests are also retried on them
+IDEMPOTENT_RETRY_STATUS_CODES = RETRY_STATUS_CODES | {502, 504}
+
+
+@dataclass
+class ChatEvent:
+    """A server-sent event of the streaming endpoint: `token`, `memory_update` or `end`"""
+    event: str
+    data: dict
+
+
+class _SSEParser:
+    """Incremental parser of server-sent event lines"""
+
+    def __init__(self):
+        self.event = "message"
+        self.data: list[str] = []
+
+    def feed(self, line: str) -> Optional[ChatEvent]:
+        """Feed one line, return the event it completes if any"""
+        if not line:
+            if not self.data:
+                return None
+            event = ChatEvent(self.event, json.loads("\n".join(self.data)))
+            self.event, self.data = "message", []
+            if event.event == "error":
+                raise ChatAPIError(f"Chat failed: {event.data.get('detail')}")
+            return event
+        field, _, value = line.partition(":")
+        value = value.removeprefix(" ")
+        if field == "event":
+            self.event = value
+        elif field == "data":
+            self.data.append(value)
+        return None
+
+
+class _BaseChatClient:
+
+    def __init__(self,
+                 base_url: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None,
+                 backoff: Optional[float] = None,
+                 max_connections: Optional[int] = None):
+        self.base_url = base_url or settings.CLIENT_BASE_URL
+        self.max_retries = settings.CLIENT_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = settings.CLIENT_RETRY_BACKOFF_SECONDS if backoff is None else backoff
+        # memory update turns can take long, the read timeout applies between two chunks of a stream
+        self.timeout = httpx.Timeout(timeout or settings.CLIENT_TIMEOUT_SECONDS,
+                                     connect=connect_timeout or settings.CLIENT_CONNECT_TIMEOUT_SECONDS)
+        self.limits = httpx.Limits(max_connections=max_connections or settings.CLIENT_MAX_CONNECTIONS)
+
+    @staticmethod
+    def _payload(message: str, user_id: str, thread_id: str, flush_memory: bool) -> dict:
+        return {"thread_id": thread_id, "user_id": user_id, "message": message, "flush_memory": flush_memory}
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> Optional[float]:
+        """Seconds to wait before sending the request again, None when it should not be retried"""
+        if attempt >= self.max_retries:
+            return None
+        if response is not None:
+            retry_status_codes = IDEMPOTENT_RETRY_STATUS_CODES if response.request.method == "GET" else RETRY_STATUS_CODES
+            if response.status_code not in retry_status_codes:
+                return None
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return float(retry_after)
+        # exponential backoff with jitter, so clients throttled together don't come back together
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    @staticmethod
+    def _error(response: httpx.Response) -> ChatAPIError:
+        try:
+            detail = response.json().get("detail", response.text)
+        except json.JSONDecodeError:
+            detail = response.text
+        logger.error(f"API request failed with status {response.status_code}: {detail}")
+        return ChatAPIError(f"API request failed with status {response.status_code}: {detail}")
+
+
+class ChatClient(_BaseChatClient):
+    """
+    Client of the assistant's service.
+
+    It keeps one pool of keep-alive connections for all its requests and can
+    be shared between threads. Requests that did not reach the agent
+    (connection errors, 429 and 503 responses) are retried with exponential
+    backoff, honouring the service's Retry-After header. Chat requests are not
+    retried on 502 and 504, the turn may have run behind the gateway.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+
+    def close(self):
+        self._client.close()
+
+    def __enter__(self) -> "ChatClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = self._client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    logger.error("Failed to connect to the server")
+                    raise ChatAPIError("Failed to connect to the server") from e
+            except httpx.TimeoutException as e:
+                logger.error("Request timed out")
+                raise ChatAPIError("Request timed out") from e
+            except httpx.HTTPError as e:
+                logger.error(f"API request failed: {str(e)}")
+                raise ChatAPIError(f"API request failed: {str(e)}") from e
+            else:
+                if response.is_success:
+                    return response
+                if stream:
+                    response.read()
+                    response.close()
+                delay = self._retry_delay(attempt, response)
+                if delay is None:
+                    raise self._error(response)
+            attempt += 1
+            logger.info(f"Retrying {request.url.path} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def chat(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> Dict:
+        """Send a chat message to the agent and return the response."""
+        request = self._client.build_request("POST", "/chat", json=self._payload(message, user_id, thread_id, flush_memory))
+        try:
+            return self._send(request).json()
+        except json.JSONDecodeError:
+            logger.error("Failed to parse API response")
+            raise ChatAPIError("Failed to parse API response")
+
+    def chat_stream(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> Iterator[ChatEvent]:
+        """
+        Send a chat message to the streaming endpoint and yield its events as they arrive.
+
+        Raises ChatAPIError if the turn fails.
+        """
+        request = self._client.build_request("POST", "/chat_stream", json=self._payload(message, user_id, thread_id, flush_memory))
+        response = self._send(request, stream=True)
+        parser = _SSEParser()
+        try:
+            for line in response.iter_lines():
+                event = parser.feed(line)
+                if event is not None:
+                    yield event
+        except httpx.HTTPError as e:
+            logger.error(f"Stream interrupted: {str(e)}")
+            raise ChatAPIError(f"Stream interrupted: {str(e)}") from e
+        finally:
+            response.close()
+
+    def stream_tokens(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> Iterator[str]:
+        """Yield the chunks of the assistant's reply as they arrive, e.g. for `st.write_stream`"""
+        for event in self.chat_stream(message, user_id, thread_id, flush_memory):
+            if event.event == "token":
+                yield event.data["content"]
+
+    def chat_batch(self, requests: list[Dict]) -> list[Dict]:
+        """
+        Run many chat turns (dicts with `message`, `user_id` and `thread_id`) in one
+        request and return their results in order. The service answers once every
+        turn is done, prefer `chat_batch_stream` for long batches.
+        """
+        request = self._client.build_request("POST", "/chat/batch", json={"requests": requests})
+        return self._send(request).json()["results"]
+
+    def chat_batch_stream(self, requests: list[Dict]) -> Iterator[Dict]:
+        """Run many chat turns in one request and yield their results, with their `index`, as they finish"""
+        request = self._client.build_request("POST", "/chat/batch", json={"requests": requests, "stream": True})
+        response = self._send(request, stream=True)
+        try:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        except httpx.HTTPError as e:
+            logger.error(f"Stream interrupted: {str(e)}")
+            raise ChatAPIError(f"Stream interrupted: {str(e)}") from e
+        finally:
+            response.close()
+
+    def list_threads(self, user_id: str, limit: int = 20, offset: int = 0) -> Dict:
+        """A page of the user's threads, the most recently used first"""
+        request = self._client.build_request("GET", f"/threads/{user_id}", params={"limit": limit, "offset": offset})
+        return self._send(request).json()
+
+    def get_history(self, user_id: str, thread_id: str, limit: int = 20, before: Optional[int] = None) -> Dict:
+        """The `limit` latest messages of a thread, or those before the position `before` (returned with the page)"""
+        params = {"limit": limit} if before is None else {"limit": limit, "before": before}
+        request = self._client.build_request("GET", f"/history/{user_id}/{thread_id}", params=params)
+        return self._send(request).json()
+
+
+class AsyncChatClient(_BaseChatClient):
+    """
+    Asynchronous client of the assistant's service, to run many chats concurrently.
+
+    Same connection pooling and retries as `ChatClient`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def __aenter__(self) -> "AsyncChatClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self._client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    logger.error("Failed to connect to the server")
+                    raise ChatAPIError("Failed to connect to the server") from e
+            except httpx.TimeoutException as e:
+                logger.error("Request timed out")
+                raise ChatAPIError("Request timed out") from e
+            except httpx.HTTPError as e:
+                logger.error(f"API request failed: {str(e)}")
+                raise ChatAPIError(f"API request failed: {str(e)}") from e
+            else:
+                if response.is_success:
+                    return response
+                if stream:
+                    await response.aread()
+                    await response.aclose()
+                delay = self._retry_delay(attempt, response)
+                if delay is None:
+                    raise self._error(response)
+            attempt += 1
+            logger.info(f"Retrying {request.url.path} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def chat(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> Dict:
+        """Send a chat message to the agent and return the response."""
+        request = self._client.build_request("POST", "/chat", json=self._payload(message, user_id, thread_id, flush_memory))
+        try:
+            return (await self._send(request)).json()
+        except json.JSONDecodeError:
+            logger.error("Failed to parse API response")
+            raise ChatAPIError("Failed to parse API response")
+
+    async def chat_stream(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> AsyncIterator[ChatEvent]:
+        """
+        Send a chat message to the streaming endpoint and yield its events as they arrive.
+
+        Raises ChatAPIError if the turn fails.
+        """
+        request = self._client.build_request("POST", "/chat_stream", json=self._payload(message, user_id, thread_id, flush_memory))
+        response = await self._send(request, stream=True)
+        parser = _SSEParser()
+        try:
+            async for line in response.aiter_lines():
+                event = parser.feed(line)
+                if event is not None:
+                    yield event
+        except httpx.HTTPError as e:
+            logger.error(f"Stream interrupted: {str(e)}")
+            raise ChatAPIError(f"Stream interrupted: {str(e)}") from e
+        finally:
+            await response.aclose()
+
+    async def stream_tokens(self, message: str, user_id: str, thread_id: str, flush_memory: bool = False) -> AsyncIterator[str]:
+        """Yield the chunks of the assistant's reply as they arrive"""
+        async for event in self.chat_stream(message, user_id, thread_id, flush_memory):
+            if event.event == "token":
+                yield event.data["content"]
+
+    async def chat_batch(self, requests: list[Dict]) -> list[Dict]:
+        """Run many chat turns in one request and return their results in order"""
+        request = self._client.build_request("POST", "/chat/batch", json={"requests": requests})
+        return (await self._send(request)).json()["results"]
+
+    async def chat_batch_stream(self, requests: list[Dict]) -> AsyncIterator[Dict]:
+        """Run many chat turns in one request and yield their results, with their `index`, as they finish"""
+        request = self._client.build_request("POST", "/chat/batch", json={"requests": requests, "stream": True})
+        response = await self._send(request, stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+        except httpx.HTTPError as e:
+            logger.error(f"Stream interrupted: {str(e)}")
+            raise ChatAPIError(f"Stream interrupted: {str(e)}") from e
+        finally:
+            await response.aclose()
+
+    async def list_threads(self, user_id: str, limit: int = 20, offset: int = 0) -> Dict:
+        """A page of the user's threads, the most recently used first"""
+        request = self._client.build_request("GET", f"/threads/{user_id}", params={"limit": limit, "offset": offset})
+        return (await self._send(request)).json()
+
+    async def get_history(self, user_id: str, thread_id: str, limit: int = 20, before: Optional[int] = None) -> Dict:
+        """The `limit` latest messages of a thread, or those before the position `before` (returned with the page)"""
+        params = {"limit": limit} if before is None else {"limit": limit, "before": before}
+        request = self._client.build_request("GET", f"/history/{user_id}/{thread_id}", params=params)
+        return (await self._send(request)).json()
+
+
+_default_client: Optional[ChatClient] = None
+
+
+def get_client() -> ChatClient:
+    """The client shared by the module's functions, created on first use"""
+    global _default_client
+    if _default_client is None:
+        _default_client = ChatClient()
+    return _default_client
+
+
 def chat_with_agent(message: str, user_id: str, thread_id: str) -> Dict:
     """
     Send a chat message to the agent and return the response.
-    
+
     Args:
         message (str): The message to send
         user_id (str): The user identifier
         thread_id (str): The thread identifier
-    
+
     Returns:
         Dict: The response from the agent
-    
+
     Raises:
         ChatAPIError: If there's an error communicating with the API
     """
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "thread_id": thread_id,
-        "user_id": user_id,
-        "message": message
-    }
-
-    try:
-        json_data = json.dumps(payload)
-        response = requests.post(
-            url="http://localhost:8080/chat",
-            data=json_data,
-            headers=headers,
-            timeout=30  # Add timeout
-        )
-        
-        response.raise_for_status()  # Raise exception for non-200 status codes
-        return response.json()
-        
-    except requests.exceptions.Timeout:
-        logger.error("Request timed out")
-        raise ChatAPIError("Request timed out")
-        
-    except requests.exceptions.ConnectionError:
-        logger.error("Failed to connect to the server")
-        raise ChatAPIError("Failed to connect to the server")
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"API request failed: {str(e)}")
-        raise ChatAPIError(f"API request failed: {str(e)}")
-        
-    except json.JSONDecodeError:
-        logger.error("Failed to parse API response")
-        raise ChatAPIError("Failed to parse API response")
-        
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        raise ChatAPIError(f"Unexpected error: {str(e)}")
+    return get_client().chat(message, user_id, thread_id)
 
 def main():
     user_id = "user123"
     thread_id = "thread456"
     message = "Hello, My name is Harshad and I am a software engineer."
-    
+
     try:
         response = chat_with_agent(message, user_id, thread_id)
         logger.info(f"Response received: {response}")
-        
+
     except ChatAPIError as e:
         logger.error(f"Chat error occurred: {str(e)}")
-        
+
 if __name__ == "__main__":
     main()
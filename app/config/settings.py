@@ -1,9 +1,14 @@
-from dotenv import find_dotenv
+from dotenv import find_dotenv, load_dotenv
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr
 from enum import StrEnum
 
+# The only place the .env file is loaded: besides the settings below, it holds the
+# variables read by the libraries themselves (GROQ_API_KEY, LANGSMITH_*)
+_ = load_dotenv(find_dotenv())
+
+
 class DatabaseType(StrEnum):
     POSTGRES = "postgres"
     MONGO = "mongo"
@@ -27,6 +32,98 @@ class Settings(BaseSettings):
     SERVICE_PORT : int | None = None
     DEV : bool = True
 
+    # Production mode (DEV=false): worker processes, each with its own database pools,
+    # and seconds the open requests get to finish on shutdown
+    SERVICE_WORKERS: int = 1
+    SERVICE_GRACEFUL_SHUTDOWN_SECONDS: float = 30.0
+    # Seconds the readiness check waits for the database
+    SERVICE_HEALTH_TIMEOUT_SECONDS: float = 2.0
+
+    # Agent runs executing at once over all threads, and requests allowed to wait
+    # for a run slot before the service answers 429 (0 for no limit)
+    SERVICE_MAX_CONCURRENT_RUNS: int = 8
+    SERVICE_MAX_QUEUED_RUNS: int = 64
+    # Requests accepted by /chat/batch, and threads of a batch running at once
+    SERVICE_BATCH_MAX_REQUESTS: int = 500
+    SERVICE_BATCH_CONCURRENCY: int = 4
+
+    # LLMs as <provider>:<model> (groq or openai): the model answering the user, and the one
+    # for memory extraction, instructions updates and summaries, the assistant's when empty.
+    # A smaller model (e.g. groq:llama-3.1-8b-instant) is cheaper and faster but patches memories less reliably
+    LLM_ASSISTANT_MODEL: str = "groq:llama-3.3-70b-versatile"
+    LLM_EXTRACTION_MODEL: str = ""
+    # Models tried in order once the retries of a model are exhausted on a rate limit or server error
+    LLM_FALLBACK_MODELS: list[str] = []
+    # Retries of an LLM call, waiting for the provider's Retry-After delay or an exponential backoff with jitter
+    LLM_MAX_RETRIES: int = 2
+    LLM_TIMEOUT_SECONDS: float = 60.0
+    # Keep-alive connections to the LLM providers, shared by every model
+    LLM_MAX_CONNECTIONS: int = 20
+    LLM_KEEPALIVE_SECONDS: float = 30.0
+
+    # Python client of the service (client.py): timeouts in seconds, a memory update turn can take long.
+    # Requests the agent did not run (connection errors, 429/503) are retried with exponential backoff
+    CLIENT_BASE_URL: str = "http://localhost:8080"
+    CLIENT_TIMEOUT_SECONDS: float = 120.0
+    CLIENT_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    CLIENT_MAX_RETRIES: int = 3
+    CLIENT_RETRY_BACKOFF_SECONDS: float = 0.5
+    CLIENT_MAX_CONNECTIONS: int = 20
+
+    # Run memory updates in a background queue instead of before the assistant's reply
+    MEMORY_WRITE_BEHIND: bool = False
+    # Let the assistant request several memory updates in one message, run in parallel
+    MEMORY_PARALLEL_UPDATES: bool = True
+
+    # Per-user memory snapshot cache in front of the store, set the size to 0 to disable it
+    MEMORY_CACHE_MAX_SIZE: int = 1024
+    MEMORY_CACHE_TTL_SECONDS: float = 300.0
+
+    # Cache the replies of read-only turns (no memory update), keyed on the user's memories, the last
+    # RESPONSE_CACHE_TAIL_MESSAGES messages of the thread and the normalized message. A size of 0 disables it
+    RESPONSE_CACHE_MAX_SIZE: int = 0
+    RESPONSE_CACHE_TTL_SECONDS: float = 600.0
+    RESPONSE_CACHE_TAIL_MESSAGES: int = 2
+
+    # Namespaces are read page by page, up to a hard cap of items
+    MEMORY_SEARCH_PAGE_SIZE: int = 100
+    MEMORY_SEARCH_MAX_ITEMS: int = 10_000
+    # Only put the K ToDos most relevant to the user's message in the prompt, 0 keeps the whole list
+    TODO_PROMPT_TOP_K: int = 0
+
+    # Embedding index over the memories (PostgreSQL and in-memory stores), using a local hashing embedding
+    MEMORY_INDEX_ENABLED: bool = False
+    MEMORY_INDEX_DIMS: int = 256
+    # With the index, only the K most relevant ToDos are given to the ToDo extractor (0 gives it every task)
+    TODO_EXTRACTION_TOP_K: int = 0
+    # Statuses of the ToDos retrieved through the index, the others (done, archived) are left out
+    TODO_ACTIVE_STATUSES: list[str] = ["not started", "in progress"]
+
+    # Memory extractors only see the messages since their previous run, capped to the last N user turns (0 for no cap)
+    EXTRACTION_SINCE_LAST: bool = True
+    EXTRACTION_MAX_TURNS: int = 10
+
+    # Fold older turns into a running summary once a thread is over either budget (0 disables that budget)
+    SUMMARY_MAX_MESSAGES: int = 40
+    SUMMARY_MAX_TOKENS: int = 8000
+    # Number of most recent user turns kept verbatim when summarizing
+    SUMMARY_KEEP_TURNS: int = 4
+
+    # Record per-node, LLM and store metrics (exported on /metrics) and trace spans
+    METRICS_ENABLED: bool = True
+
+
+    # Checkpoint retention: checkpoints kept per thread, days after which an idle thread is
+    # deleted (0 keeps them), and seconds a thread must be quiet before it is pruned
+    CHECKPOINT_KEEP_LAST: int = 10
+    CHECKPOINT_MAX_IDLE_DAYS: float = 0
+    CHECKPOINT_RETENTION_GRACE_SECONDS: float = 300.0
+    # Threads pruned per batch and seconds between batches, so pruning never holds the database for long
+    CHECKPOINT_RETENTION_BATCH_SIZE: int = 100
+    CHECKPOINT_RETENTION_BATCH_PAUSE_SECONDS: float = 0.1
+    # Seconds between the service's retention passes, 0 leaves it to `python -m memory.retention`
+    CHECKPOINT_RETENTION_INTERVAL_SECONDS: float = 0
+
 
     # Database Configuration
     DATABASE_TYPE: DatabaseType = (
@@ -40,8 +137,15 @@ class Settings(BaseSettings):
     POSTGRES_PORT: int | None = None
     POSTGRES_DB: str | None = None
     POSTGRES_APPLICATION_NAME: str = "personal-ai-assistant"
-    POSTGRES_MIN_CONNECTIONS_PER_POOL: int = 1
-    POSTGRES_MAX_CONNECTIONS_PER_POOL: int = 1
+    POSTGRES_MIN_CONNECTIONS_PER_POOL: int = 2
+    POSTGRES_MAX_CONNECTIONS_PER_POOL: int = 10
+    # Share one pool between the checkpointer and the store
+    POSTGRES_SHARED_POOL: bool = True
+    # Seconds a request waits for a free connection, and an idle connection is kept open
+    POSTGRES_POOL_TIMEOUT: float = 30.0
+    POSTGRES_POOL_MAX_IDLE: float = 600.0
+    # Maximum number of requests waiting for a connection, 0 for no limit
+    POSTGRES_POOL_MAX_WAITING: int = 0
 
 
     # MongoDB Configuration
@@ -1,13 +1,156 @@
 import os
-from dotenv import load_dotenv
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import cache
+from typing import Literal
 
-_ = load_dotenv()
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable
 
-# from langchain_openai import ChatOpenAI
-# openai_model = ChatOpenAI(model= 'gpt-4o', temperature=0.0)
+from config.settings import settings
+from core.metrics import LLM_RETRIES
 
-from langchain_groq import ChatGroq
 
-model = ChatGroq(model='llama-3.3-70b-versatile', 
-                 api_key=os.environ.get("GROQ_API_KEY"),
-                 temperature=0.0)
\ No newline at end of file
+# The models, their HTTP clients and the provider SDKs are only created on first use,
+# so importing the agent is fast and needs no API key
+
+
+# The provider SDKs retry inside their HTTP calls, where LangChain's callbacks don't see it
+def count_retry(request):
+    """Count the requests the provider SDK sends again, which it marks with their retry number"""
+    if request.headers.get("x-stainless-retry-count", "0") != "0":
+        LLM_RETRIES.labels(host=request.url.host).inc()
+
+
+async def acount_retry(request):
+    count_retry(request)
+
+
+@cache
+def get_http_clients():
+    """One keep-alive connection pool shared by every model, instead of one per client"""
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+        keepalive_expiry=settings.LLM_KEEPALIVE_SECONDS,
+    )
+    return (httpx.Client(limits=limits, timeout=settings.LLM_TIMEOUT_SECONDS, event_hooks={"request": [count_retry]}),
+            httpx.AsyncClient(limits=limits, timeout=settings.LLM_TIMEOUT_SECONDS, event_hooks={"request": [acount_retry]}))
+
+
+@dataclass(frozen=True)
+class Provider:
+    """How to create the chat models of a provider"""
+    create: Callable[[str], BaseChatModel]
+    # errors on which the next model of the fallback chain is tried (rate limits, server and connection errors)
+    fallback_errors: Callable[[], tuple[type[Exception], ...]]
+
+
+def _create_groq(model_name: str) -> BaseChatModel:
+    from langchain_groq import ChatGroq
+
+    http_client, http_async_client = get_http_clients()
+    # the Groq client retries rate limits and server errors itself, waiting for the
+    # Retry-After delay of the response or an exponential backoff with jitter
+    return ChatGroq(model=model_name,
+                    api_key=os.environ.get("GROQ_API_KEY"),
+                    temperature=0.0,
+                    max_retries=settings.LLM_MAX_RETRIES,
+                    timeout=settings.LLM_TIMEOUT_SECONDS,
+                    http_client=http_client,
+                    http_async_client=http_async_client)
+
+
+def _create_openai(model_name: str) -> BaseChatModel:
+    from langchain_openai import ChatOpenAI
+
+    http_client, http_async_client = get_http_clients()
+    return ChatOpenAI(model=model_name,
+                      temperature=0.0,
+                      max_retries=settings.LLM_MAX_RETRIES,
+                      timeout=settings.LLM_TIMEOUT_SECONDS,
+                      http_client=http_client,
+                      http_async_client=http_async_client)
+
+
+def _groq_errors() -> tuple[type[Exception], ...]:
+    import groq
+
+    return (groq.RateLimitError, groq.InternalServerError, groq.APIConnectionError)
+
+
+def _openai_errors() -> tuple[type[Exception], ...]:
+    import openai
+
+    return (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+PROVIDERS: dict[str, Provider] = {
+    "groq": Provider(_create_groq, _groq_errors),
+    "openai": Provider(_create_openai, _openai_errors),
+}
+
+
+def register_provider(name: str, provider: Provider):
+    """Make a provider available to the `<provider>:<model>` settings"""
+    PROVIDERS[name] = provider
+
+
+def _get_provider(spec: str) -> tuple[Provider, str]:
+    provider_name, _, model_name = spec.partition(":")
+    if not model_name or provider_name not in PROVIDERS:
+        raise ValueError(f"Invalid model '{spec}', expected <provider>:<model> with a provider among {list(PROVIDERS)}")
+    return PROVIDERS[provider_name], model_name
+
+
+def create_chat_model(spec: str) -> BaseChatModel:
+    """Create the chat model of a `<provider>:<model>` setting, e.g. `groq:llama-3.3-70b-versatile`"""
+    provider, model_name = _get_provider(spec)
+    return provider.create(model_name)
+
+
+@cache
+def get_chat_model(role: Literal["assistant", "extraction"]) -> BaseChatModel:
+    """
+    The chat model of a role, created on first use: the model answering the
+    user, or the one doing the memory extraction, instructions updates and
+    summaries (the assistant's unless LLM_EXTRACTION_MODEL is set).
+    """
+    return create_chat_model(_model_spec(role))
+
+
+def _model_spec(role: Literal["assistant", "extraction"]) -> str:
+    if role == "extraction" and settings.LLM_EXTRACTION_MODEL:
+        return settings.LLM_EXTRACTION_MODEL
+    return settings.LLM_ASSISTANT_MODEL
+
+
+@cache
+def get_fallback_models() -> list[BaseChatModel]:
+    """Models tried in order when the provider is throttled or failing"""
+    return [create_chat_model(spec) for spec in settings.LLM_FALLBACK_MODELS]
+
+
+def _fallback_errors() -> tuple[type[Exception], ...]:
+    errors = set()
+    for spec in [_model_spec("assistant"), _model_spec("extraction"), *settings.LLM_FALLBACK_MODELS]:
+        errors.update(_get_provider(spec)[0].fallback_errors())
+    return tuple(errors)
+
+
+def with_fallbacks(llm: BaseChatModel, build: Callable[[BaseChatModel], Runnable] = lambda llm: llm) -> Runnable:
+    """
+    Build a runnable on `llm` (its tools bound, an extractor...) that falls back
+    to the same runnable built on the fallback models.
+
+    The fallbacks are only tried once the model's own retries are exhausted on a
+    rate limit, server or connection error, other errors are raised as they are.
+    """
+    runnable = build(llm)
+    fallback_models = get_fallback_models()
+    if not fallback_models:
+        return runnable
+    return runnable.with_fallbacks([build(fallback) for fallback in fallback_models],
+                                   exceptions_to_handle=_fallback_errors())
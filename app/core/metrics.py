@@ -0,0 +1,352 @@
+import time
+import threading
+from collections.abc import Iterable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any
+from uuid import UUID
+
+from prometheus_client import Counter, Gauge, Histogram
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.trace import Span, Status, StatusCode
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langgraph.store.base import BaseStore, GetOp, ListNamespacesOp, Op, PutOp, Result, SearchOp
+
+from config.settings import settings
+
+
+tracer = trace.get_tracer("personal-ai-assistant")
+
+
+# Prometheus metrics, exported on the service's /metrics endpoint. With several workers,
+# PROMETHEUS_MULTIPROC_DIR makes every worker write them there and /metrics adds them up
+REQUEST_LATENCY = Histogram(
+    "assistant_request_duration_seconds", "Latency of the chat requests", ["endpoint", "status"],
+)
+RUNS_RUNNING = Gauge(
+    "assistant_runs_running", "Agent runs in progress",
+    multiprocess_mode="livesum",
+)
+RUNS_QUEUED = Gauge(
+    "assistant_runs_queued", "Requests waiting for their thread or a free run slot",
+    multiprocess_mode="livesum",
+)
+REQUESTS_REJECTED = Counter(
+    "assistant_requests_rejected_total", "Requests rejected because too many runs were queued",
+)
+REQUESTS_COALESCED = Counter(
+    "assistant_requests_coalesced_total", "Requests that shared the run of an identical request on the same thread",
+)
+MEMORY_CACHE_REQUESTS = Counter(
+    "assistant_memory_cache_requests_total", "Lookups of the per-user memory snapshot cache", ["result"],
+)
+MEMORY_CACHE_EVICTIONS = Counter(
+    "assistant_memory_cache_evictions_total", "Snapshots dropped from the memory cache", ["reason"],
+)
+MEMORY_CACHE_SIZE = Gauge(
+    "assistant_memory_cache_size", "Snapshots in the memory cache",
+    multiprocess_mode="livesum",
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "assistant_response_cache_requests_total", "Lookups of the read-only turn response cache", ["result"],
+)
+RESPONSE_CACHE_EVICTIONS = Counter(
+    "assistant_response_cache_evictions_total", "Replies dropped from the response cache", ["reason"],
+)
+RESPONSE_CACHE_SIZE = Gauge(
+    "assistant_response_cache_size", "Replies in the response cache",
+    multiprocess_mode="livesum",
+)
+NODE_LATENCY = Histogram(
+    "assistant_node_duration_seconds", "Latency of the agent graph nodes", ["node"],
+)
+NODE_ERRORS = Counter(
+    "assistant_node_errors_total", "Agent graph node runs that raised an exception", ["node"],
+)
+ROUTE_DECISIONS = Counter(
+    "assistant_route_decisions_total", "Decisions of the graph's conditional edges", ["router", "route"],
+)
+LLM_LATENCY = Histogram(
+    "assistant_llm_duration_seconds", "Latency of the LLM calls, including the Trustcall extractors",
+    ["node", "model"], buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+LLM_TOKENS = Counter(
+    "assistant_llm_tokens_total", "Tokens sent to (prompt) and received from (completion) the LLM",
+    ["node", "model", "type"],
+)
+LLM_ERRORS = Counter(
+    "assistant_llm_errors_total", "LLM calls that raised an exception", ["node", "model"],
+)
+LLM_RETRIES = Counter(
+    "assistant_llm_retries_total", "Requests to the LLM providers sent again by their SDK after a rate limit, server or connection error",
+    ["host"],
+)
+STORE_LATENCY = Histogram(
+    "assistant_store_duration_seconds", "Latency of the store round-trips", ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+STORE_OPERATIONS = Counter(
+    "assistant_store_operations_total", "Operations sent to the store", ["operation"],
+)
+STORE_ERRORS = Counter(
+    "assistant_store_errors_total", "Store round-trips that raised an exception", ["operation"],
+)
+CHECKPOINT_ROWS_RECLAIMED = Counter(
+    "assistant_checkpoint_rows_reclaimed_total", "Checkpoint rows (documents) deleted by the retention policy", ["table"],
+)
+CHECKPOINT_THREADS_DROPPED = Counter(
+    "assistant_checkpoint_threads_dropped_total", "Idle threads whose checkpoints were deleted by the retention policy",
+)
+CHECKPOINT_RETENTION_LATENCY = Histogram(
+    "assistant_checkpoint_retention_batch_duration_seconds", "Latency of a batch of the checkpoint retention",
+)
+
+# The conditional edges whose decisions are counted
+ROUTERS = ("route_message", "should_summarize")
+
+
+@dataclass
+class _Run:
+    name: str | None
+    # the graph node the run belongs to
+    node: str | None
+    # context new spans of child runs are started in
+    context: Context | None
+    span: Span | None = None
+    model: str = ""
+    start: float = 0.0
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler recording the metrics and trace spans of one agent run.
+
+    Every node of the agent graph gets a span and a latency sample, every LLM
+    call (the assistant's and the Trustcall extractors') a span, a latency sample
+    and its token counts, labelled with the node it was made from. Use one handler
+    per run: `parent_span` is the span of the request, and `node` labels the runs
+    of an update node called outside of the graph (write-behind).
+    """
+
+    run_inline = True
+
+    def __init__(self, parent_span: Span | None = None, node: str | None = None):
+        self.default_node = node
+        self.context = trace.set_span_in_context(parent_span) if parent_span is not None else None
+        self._runs: dict[UUID, _Run] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, run_id: UUID | None) -> _Run | None:
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def _add(self, run_id: UUID, run: _Run):
+        with self._lock:
+            self._runs[run_id] = run
+
+    def _pop(self, run_id: UUID) -> _Run | None:
+        with self._lock:
+            return self._runs.pop(run_id, None)
+
+    # Graph and nodes
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        name = kwargs.get("name")
+        node = (metadata or {}).get("langgraph_node")
+        parent = self._get(parent_run_id)
+
+        if parent is None:
+            # the graph (or extractor) run itself
+            self._add(run_id, _Run(name, self.default_node, self.context))
+        elif parent.node is None and node == name and node and not node.startswith("__"):
+            # a node of the agent graph
+            span = tracer.start_span(f"node {node}", context=parent.context, attributes={"langgraph.node": node})
+            self._add(run_id, _Run(name, node, trace.set_span_in_context(span), span, start=time.perf_counter()))
+        else:
+            # anything running inside a node is accounted to that node
+            self._add(run_id, _Run(name, parent.node, parent.context))
+
+    def on_chain_end(self, outputs, *, run_id, parent_run_id=None, **kwargs):
+        run = self._pop(run_id)
+        if run is None:
+            return
+        if run.name in ROUTERS and isinstance(outputs, (str, list)):
+            # a router returns one node or the list of nodes to run in parallel
+            routes = [outputs] if isinstance(outputs, str) else [str(route) for route in outputs]
+            for route in routes:
+                ROUTE_DECISIONS.labels(router=run.name, route=route).inc()
+            parent = self._get(parent_run_id)
+            if parent is not None and parent.span is not None:
+                parent.span.set_attribute(f"langgraph.{run.name}", routes)
+        if run.span is not None:
+            NODE_LATENCY.labels(node=run.node).observe(time.perf_counter() - run.start)
+            run.span.end()
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        run = self._pop(run_id)
+        if run is None or run.span is None:
+            return
+        NODE_ERRORS.labels(node=run.node).inc()
+        NODE_LATENCY.labels(node=run.node).observe(time.perf_counter() - run.start)
+        run.span.record_exception(error)
+        run.span.set_status(Status(StatusCode.ERROR, str(error)))
+        run.span.end()
+
+    # LLM calls
+
+    def _start_llm(self, run_id: UUID, parent_run_id: UUID | None, metadata: dict | None):
+        parent = self._get(parent_run_id)
+        node = (parent.node if parent else self.default_node) or ""
+        model = (metadata or {}).get("ls_model_name", "")
+        span = tracer.start_span(
+            "llm", context=parent.context if parent else self.context,
+            attributes={"langgraph.node": node, "gen_ai.request.model": model},
+        )
+        self._add(run_id, _Run("llm", node, None, span, model, time.perf_counter()))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start_llm(run_id, parent_run_id, metadata)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start_llm(run_id, parent_run_id, metadata)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        run = self._pop(run_id)
+        if run is None:
+            return
+        LLM_LATENCY.labels(node=run.node, model=run.model).observe(time.perf_counter() - run.start)
+
+        prompt_tokens, completion_tokens = token_usage(response)
+        if prompt_tokens:
+            LLM_TOKENS.labels(node=run.node, model=run.model, type="prompt").inc(prompt_tokens)
+        if completion_tokens:
+            LLM_TOKENS.labels(node=run.node, model=run.model, type="completion").inc(completion_tokens)
+        run.span.set_attribute("gen_ai.usage.input_tokens", prompt_tokens)
+        run.span.set_attribute("gen_ai.usage.output_tokens", completion_tokens)
+        run.span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._pop(run_id)
+        if run is None:
+            return
+        LLM_ERRORS.labels(node=run.node, model=run.model).inc()
+        LLM_LATENCY.labels(node=run.node, model=run.model).observe(time.perf_counter() - run.start)
+        run.span.record_exception(error)
+        run.span.set_status(Status(StatusCode.ERROR, str(error)))
+        run.span.end()
+
+
+def token_usage(response: LLMResult) -> tuple[int, int]:
+    """Prompt and completion tokens of an LLM result"""
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+    if not (prompt_tokens or completion_tokens):
+        # providers that only report the usage of the whole call
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+@contextmanager
+def _timed_span(name: str, histogram: Histogram, labels: dict, errors: Counter | None = None,
+                with_status: bool = False, **attributes: Any):
+    span = tracer.start_span(name, attributes=attributes)
+    start = time.perf_counter()
+    status = "success"
+    try:
+        yield span
+    except Exception as e:
+        status = "error"
+        if errors is not None:
+            errors.labels(**labels).inc()
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        if with_status:
+            labels = {**labels, "status": status}
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+        span.end()
+
+
+def request_span(endpoint: str, **attributes: Any):
+    """
+    Span and latency of one chat request.
+
+    The span is not made current (it is handed to `MetricsCallbackHandler`
+    instead), so it can also be used across the yields of a streaming response.
+    """
+    return _timed_span(endpoint, REQUEST_LATENCY, {"endpoint": endpoint}, with_status=True, **attributes)
+
+
+def node_span(node: str, **attributes: Any):
+    """Span and latency of a graph node run outside of the graph, like the write-behind memory updates"""
+    return _timed_span(f"node {node}", NODE_LATENCY, {"node": node}, NODE_ERRORS, **{"langgraph.node": node, **attributes})
+
+
+def metrics_callbacks(parent_span: Span | None = None, node: str | None = None) -> list[BaseCallbackHandler]:
+    """Callbacks to add to the config of an agent run, none when metrics are disabled"""
+    if not settings.METRICS_ENABLED:
+        return []
+    return [MetricsCallbackHandler(parent_span=parent_span, node=node)]
+
+
+class InstrumentedStore(BaseStore):
+    """Store wrapper recording the latency, operations and errors of every round-trip"""
+
+    def __init__(self, store: BaseStore):
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @staticmethod
+    def _operations(ops: list[Op]) -> list[str]:
+        names = []
+        for op in ops:
+            if isinstance(op, GetOp):
+                names.append("get")
+            elif isinstance(op, SearchOp):
+                names.append("search")
+            elif isinstance(op, PutOp):
+                names.append("delete" if op.value is None else "put")
+            elif isinstance(op, ListNamespacesOp):
+                names.append("list_namespaces")
+            else:
+                names.append(type(op).__name__)
+        return names
+
+    @contextmanager
+    def _record(self, ops: list[Op]):
+        names = self._operations(ops)
+        for name in names:
+            STORE_OPERATIONS.labels(operation=name).inc()
+        # a round-trip with several kinds of operations is labelled "batch"
+        operation = names[0] if len(set(names)) == 1 else "batch"
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            STORE_ERRORS.labels(operation=operation).inc()
+            raise
+        finally:
+            STORE_LATENCY.labels(operation=operation).observe(time.perf_counter() - start)
+
+    def batch(self, ops: Iterable[Op]) -> list[Result]:
+        ops = list(ops)
+        with self._record(ops):
+            return self.store.batch(ops)
+
+    async def abatch(self, ops: Iterable[Op]) -> list[Result]:
+        ops = list(ops)
+        with self._record(ops):
+            return await self.store.abatch(ops)
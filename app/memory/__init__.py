@@ -1,14 +1,17 @@
+from contextlib import asynccontextmanager
+
 from config.settings import settings, DatabaseType
 
-from memory.mongodb import get_mongodb_saver, get_mongodb_store
-from memory.postgres import get_postgres_saver, get_postgres_store
+# The drivers of the database backends are imported on first use, only the configured one is loaded
 
 
 def initialize_database():
     """Initialize appropriate database checkpointer"""
     if settings.DATABASE_TYPE == DatabaseType.POSTGRES:
+        from memory.postgres import get_postgres_saver
         return get_postgres_saver()
     elif settings.DATABASE_TYPE == DatabaseType.MONGO:
+        from memory.mongodb import get_mongodb_saver
         return get_mongodb_saver()
     else:
         raise ValueError("Unsupported database type")
@@ -17,10 +20,57 @@ def initialize_database():
 def initialize_store():
     """Initialize appropriate database checkpointer"""
     if settings.DATABASE_TYPE == DatabaseType.MONGO:
+        from memory.mongodb import get_mongodb_store
         return get_mongodb_store()
     elif settings.DATABASE_TYPE == DatabaseType.POSTGRES:
+        from memory.postgres import get_postgres_store
         return get_postgres_store()
     else:
         raise ValueError("Unsupported database type")
 
-__all__ = ["initialize_database", "initialize_store"]
\ No newline at end of file
+
+@asynccontextmanager
+async def initialize_memory():
+    """Initialize the checkpointer and the store of the configured database, set up and ready to use"""
+    if settings.DATABASE_TYPE == DatabaseType.POSTGRES:
+        from memory.postgres import get_postgres_memory
+        async with get_postgres_memory() as (saver, store):
+            yield saver, store
+    elif settings.DATABASE_TYPE == DatabaseType.MONGO:
+        from memory.mongodb import get_mongodb_saver, get_mongodb_store
+        async with get_mongodb_saver() as saver, get_mongodb_store() as store:
+            yield saver, store
+    else:
+        raise ValueError("Unsupported database type")
+
+
+def get_pool_stats() -> dict:
+    """Statistics of the PostgreSQL connection pools opened by this process"""
+    if settings.DATABASE_TYPE != DatabaseType.POSTGRES:
+        return {}
+    from memory.postgres import get_pool_stats
+    return get_pool_stats()
+
+
+async def check_pools(timeout: float) -> dict[str, str]:
+    """Health of the PostgreSQL connection pools, "ok" or the error by pool name"""
+    if settings.DATABASE_TYPE != DatabaseType.POSTGRES:
+        return {}
+    from memory.postgres import check_pools
+    return await check_pools(timeout)
+
+
+def get_checkpoint_pruner(saver):
+    """The pruner of the configured database's checkpoints, for the retention passes"""
+    if settings.DATABASE_TYPE == DatabaseType.POSTGRES:
+        from memory.postgres import PostgresCheckpointPruner
+        return PostgresCheckpointPruner(saver)
+    elif settings.DATABASE_TYPE == DatabaseType.MONGO:
+        from memory.mongodb import MongoCheckpointPruner
+        return MongoCheckpointPruner(saver)
+    else:
+        raise ValueError("Unsupported database type")
+
+
+__all__ = ["initialize_database", "initialize_store", "initialize_memory", "get_pool_stats", "check_pools",
+           "get_checkpoint_pruner"]
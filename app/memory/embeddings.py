@@ -0,0 +1,49 @@
+import hashlib
+import math
+import re
+from collections.abc import Sequence
+
+from langgraph.store.base import IndexConfig
+
+from config.settings import settings
+
+
+def _features(text: str):
+    """Words, word pairs and character trigrams of a text, with their weights"""
+    words = re.findall(r"\w+", text.lower())
+    for word in words:
+        yield word, 1.0
+        # trigrams let "booked" match "book"
+        padded = f"#{word}#"
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3], 0.25
+    for first, second in zip(words, words[1:]):
+        yield f"{first} {second}", 0.5
+
+
+def _embed(text: str, dims: int) -> list[float]:
+    vector = [0.0] * dims
+    for feature, weight in _features(text):
+        # a stable hash, the vectors are persisted across processes
+        digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+        vector[digest % dims] += weight if digest >> 63 else -weight
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+
+def hashing_embed(texts: Sequence[str]) -> list[list[float]]:
+    """
+    Embed texts locally with the hashing trick.
+
+    Words, word pairs and character trigrams are hashed into MEMORY_INDEX_DIMS
+    signed buckets, so texts sharing words end up close to each other. It needs
+    no model or network access, at the price of matching words rather than meaning.
+    """
+    return [_embed(text, settings.MEMORY_INDEX_DIMS) for text in texts]
+
+
+def get_index_config() -> IndexConfig | None:
+    """Embedding index configuration of the store, None when the index is disabled"""
+    if not settings.MEMORY_INDEX_ENABLED:
+        return None
+    return {"dims": settings.MEMORY_INDEX_DIMS, "embed": hashing_embed, "fields": ["$"]}
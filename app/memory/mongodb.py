@@ -1,7 +1,12 @@
+from contextlib import asynccontextmanager
+
 from config.settings import settings
 
-from langgraph.store.mongodb import MongoDBStore
 from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
+from pymongo import DeleteMany
+
+from memory.mongodb_store import AsyncMongoDBStore
+from memory.retention import CheckpointPruner
 
 
 def get_mongodb_saver():
@@ -13,9 +18,66 @@ def get_mongodb_saver():
             )
 
 
-def get_mongodb_store(): 
-    return MongoDBStore.from_conn_string(
+@asynccontextmanager
+async def get_mongodb_store():
+    "Initializes and return an asynchronous MongoDB store with its indexes created"
+    async with AsyncMongoDBStore.from_conn_string(
             conn_string=settings.MONGO_URI,
             db_name=settings.MONGO_DB_NAME,
             collection_name=settings.MONGO_STATE_STORE_COLLECTION
-            )
+            ) as store:
+        await store.setup()
+        yield store
+
+
+class MongoCheckpointPruner(CheckpointPruner):
+    """
+    Prunes the collections of an `AsyncMongoDBSaver`. The channel values are stored
+    in the checkpoint documents, so only checkpoints and writes are deleted.
+    """
+
+    def __init__(self, saver: AsyncMongoDBSaver):
+        self.checkpoints = saver.checkpoint_collection
+        self.writes = saver.writes_collection
+
+    async def latest_checkpoints(self, after: str, limit: int) -> dict[str, str]:
+        # the next threads, read from the (thread_id, checkpoint_ns, checkpoint_id) index
+        # motor's aggregate() returns the cursor, it is not awaited
+        threads = [doc["_id"] async for doc in self.checkpoints.aggregate([
+            {"$match": {"thread_id": {"$gt": after}}},
+            {"$sort": {"thread_id": 1}},
+            {"$group": {"_id": "$thread_id"}},
+            # $group doesn't keep the order, sorted again so the batch is the next threads
+            {"$sort": {"_id": 1}},
+            {"$limit": limit},
+        ])]
+        latest = {doc["_id"]: doc["checkpoint_id"] async for doc in self.checkpoints.aggregate([
+            {"$match": {"thread_id": {"$in": threads}}},
+            {"$group": {"_id": "$thread_id", "checkpoint_id": {"$max": "$checkpoint_id"}}},
+        ])}
+        return {thread_id: latest[thread_id] for thread_id in sorted(latest)}
+
+    async def drop_threads(self, thread_ids: list[str]) -> dict[str, int]:
+        query = {"thread_id": {"$in": thread_ids}}
+        writes = await self.writes.delete_many(query)
+        checkpoints = await self.checkpoints.delete_many(query)
+        return {"checkpoints": checkpoints.deleted_count, "checkpoint_writes": writes.deleted_count}
+
+    async def compact_threads(self, thread_ids: list[str], keep_last: int) -> dict[str, int]:
+        # the oldest checkpoint kept in every namespace of the threads
+        deletes = []
+        async for doc in self.checkpoints.aggregate([
+            {"$match": {"thread_id": {"$in": thread_ids}}},
+            {"$sort": {"thread_id": 1, "checkpoint_ns": 1, "checkpoint_id": -1}},
+            {"$group": {"_id": {"thread_id": "$thread_id", "checkpoint_ns": "$checkpoint_ns"},
+                        "checkpoint_ids": {"$push": "$checkpoint_id"}}},
+            {"$project": {"oldest_kept": {"$arrayElemAt": ["$checkpoint_ids", keep_last - 1]}}},
+            {"$match": {"oldest_kept": {"$exists": True}}},
+        ]):
+            deletes.append(DeleteMany({**doc["_id"], "checkpoint_id": {"$lt": doc["oldest_kept"]}}))
+        if not deletes:
+            return {}
+        # the writes of the deleted checkpoints go with them
+        writes = await self.writes.bulk_write(deletes, ordered=False)
+        checkpoints = await self.checkpoints.bulk_write(deletes, ordered=False)
+        return {"checkpoints": checkpoints.deleted_count, "checkpoint_writes": writes.deleted_count}
@@ -0,0 +1,202 @@
+import asyncio
+from collections.abc import Iterable
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any
+
+from pymongo import AsyncMongoClient, DeleteOne, UpdateOne, ASCENDING, DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+
+from langgraph.store.base import (
+    BaseStore,
+    GetOp,
+    Item,
+    ListNamespacesOp,
+    MatchCondition,
+    Op,
+    PutOp,
+    Result,
+    SearchItem,
+    SearchOp,
+)
+
+# The search index of the earlier versions, replaced by one with a tiebreaker
+SEARCH_INDEX_WITHOUT_TIEBREAKER = "namespace_prefix_1_updated_at_-1"
+
+
+class AsyncMongoDBStore(BaseStore):
+    """
+    Asynchronous MongoDB store built on pymongo's asyncio client.
+
+    Items are stored in the same shape as `langgraph.store.mongodb.MongoDBStore`
+    (namespace, key, value, created_at, updated_at), plus a denormalized
+    `namespace_prefix` list so prefix searches can use an index: every prefix of
+    the namespace, its parts joined with `sep` after escaping `sep` in them, so
+    ("a/b",) and ("a", "b") get different keys.
+
+    `abatch` groups the operations it is given: all gets are read with a single
+    query, searches run concurrently and all puts/deletes are written with a
+    single `bulk_write`. TTLs are not supported, and neither is semantic search:
+    there is no vector index, the `query` of a search is ignored and the items
+    come most recently updated first, then in insertion order.
+    """
+
+    sep = "/"
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+        # sync calls from LangGraph's worker threads are run on this loop
+        self.loop = asyncio.get_running_loop()
+
+    @classmethod
+    @asynccontextmanager
+    async def from_conn_string(cls, conn_string: str, db_name: str, collection_name: str):
+        """Create a store on a new client, closed again on exit"""
+        client = AsyncMongoClient(conn_string)
+        try:
+            yield cls(client[db_name][collection_name])
+        finally:
+            await client.close()
+
+    async def setup(self):
+        """
+        Create the indexes of the store and backfill `namespace_prefix` on the items
+        written by MongoDBStore, or before the separator was escaped in it
+        """
+        await self.collection.create_index([("namespace", ASCENDING), ("key", ASCENDING)], unique=True)
+        # the puts of a batch share their updated_at, _id orders them so pages don't overlap
+        await self.collection.create_index([("namespace_prefix", ASCENDING), ("updated_at", DESCENDING), ("_id", ASCENDING)])
+        if SEARCH_INDEX_WITHOUT_TIEBREAKER in await self.collection.index_information():
+            await self.collection.drop_index(SEARCH_INDEX_WITHOUT_TIEBREAKER)
+
+        writes = []
+        outdated = {"$or": [{"namespace_prefix": {"$exists": False}},
+                            {"namespace": {"$regex": "[/\\\\]"}}]}
+        async for doc in self.collection.find(outdated, {"namespace": 1}):
+            writes.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"namespace_prefix": self._prefixes(doc["namespace"])}}))
+            if len(writes) >= 1000:
+                await self.collection.bulk_write(writes, ordered=False)
+                writes = []
+        if writes:
+            await self.collection.bulk_write(writes, ordered=False)
+
+    def batch(self, ops: Iterable[Op]) -> list[Result]:
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                raise asyncio.InvalidStateError(
+                    "Synchronous calls to AsyncMongoDBStore detected in the main event loop. "
+                    "Use the async methods (aget, asearch, aput...) instead."
+                )
+        except RuntimeError:
+            pass
+        return asyncio.run_coroutine_threadsafe(self.abatch(ops), self.loop).result()
+
+    async def abatch(self, ops: Iterable[Op]) -> list[Result]:
+        ops = list(ops)
+        results: list[Result] = [None] * len(ops)
+
+        gets = [(i, op) for i, op in enumerate(ops) if isinstance(op, GetOp)]
+        reads = [self._batch_get(gets, results)]
+        for i, op in enumerate(ops):
+            if isinstance(op, SearchOp):
+                reads.append(self._search(i, op, results))
+            elif isinstance(op, ListNamespacesOp):
+                reads.append(self._list_namespaces(i, op, results))
+        # reads see the state from before the writes of this batch
+        await asyncio.gather(*reads)
+
+        # the last put wins for every namespace/key
+        puts = {(op.namespace, op.key): op for op in ops if isinstance(op, PutOp)}
+        await self._batch_put(list(puts.values()))
+        return results
+
+    @classmethod
+    def _join(cls, parts: Iterable[str]) -> str:
+        """Key of a namespace prefix, the separator and escape character in the parts are escaped"""
+        return cls.sep.join(part.replace("\\", "\\\\").replace(cls.sep, "\\" + cls.sep) for part in parts)
+
+    def _prefixes(self, namespace: Iterable[str]) -> list[str]:
+        namespace = list(namespace)
+        return [self._join(namespace[:i]) for i in range(1, len(namespace) + 1)]
+
+    async def _batch_get(self, gets: list[tuple[int, GetOp]], results: list[Result]):
+        if not gets:
+            return
+        query = {"$or": [{"namespace": list(op.namespace), "key": op.key} for _, op in gets]}
+        found = {}
+        async for doc in self.collection.find(query):
+            found[(tuple(doc["namespace"]), doc["key"])] = doc
+        for i, op in gets:
+            doc = found.get((op.namespace, op.key))
+            results[i] = Item(
+                value=doc["value"],
+                key=doc["key"],
+                namespace=tuple(doc["namespace"]),
+                created_at=doc["created_at"],
+                updated_at=doc["updated_at"],
+            ) if doc else None
+
+    async def _search(self, i: int, op: SearchOp, results: list[Result]):
+        query: dict[str, Any] = {}
+        if op.namespace_prefix:
+            query["namespace_prefix"] = self._join(op.namespace_prefix)
+        for field, condition in (op.filter or {}).items():
+            # equality or the comparison operators, which use the same names in MongoDB
+            query[f"value.{field}"] = condition
+
+        # op.query is ignored, without a vector index the latest items come first
+        cursor = (self.collection.find(query)
+                  .sort([("updated_at", DESCENDING), ("_id", ASCENDING)])
+                  .skip(op.offset).limit(op.limit))
+        results[i] = [
+            SearchItem(
+                namespace=tuple(doc["namespace"]),
+                key=doc["key"],
+                value=doc["value"],
+                created_at=doc["created_at"],
+                updated_at=doc["updated_at"],
+            )
+            async for doc in cursor
+        ]
+
+    async def _list_namespaces(self, i: int, op: ListNamespacesOp, results: list[Result]):
+        query: dict[str, Any] = {}
+        for condition in op.match_conditions or ():
+            # a prefix without wildcards can use the namespace_prefix index
+            if condition.match_type == "prefix" and condition.path and "*" not in condition.path:
+                query["namespace_prefix"] = self._join(condition.path)
+
+        namespaces = set()
+        async for doc in await self.collection.aggregate([{"$match": query}, {"$group": {"_id": "$namespace"}}]):
+            namespace = tuple(doc["_id"])
+            if all(self._matches(namespace, condition) for condition in op.match_conditions or ()):
+                namespaces.add(namespace[:op.max_depth] if op.max_depth is not None else namespace)
+
+        results[i] = sorted(namespaces)[op.offset:op.offset + op.limit]
+
+    @staticmethod
+    def _matches(namespace: tuple[str, ...], condition: MatchCondition) -> bool:
+        path = tuple(condition.path)
+        if len(path) > len(namespace):
+            return False
+        part = namespace[:len(path)] if condition.match_type == "prefix" else namespace[len(namespace) - len(path):]
+        return all(p == "*" or p == n for p, n in zip(path, part))
+
+    async def _batch_put(self, puts: list[PutOp]):
+        if not puts:
+            return
+        now = datetime.now(tz=timezone.utc)
+        writes = []
+        for op in puts:
+            if op.value is None:
+                writes.append(DeleteOne({"namespace": list(op.namespace), "key": op.key}))
+            else:
+                writes.append(UpdateOne(
+                    {"namespace": list(op.namespace), "key": op.key},
+                    {
+                        "$set": {"value": op.value, "updated_at": now, "namespace_prefix": self._prefixes(op.namespace)},
+                        "$setOnInsert": {"created_at": now},
+                    },
+                    upsert=True,
+                ))
+        await self.collection.bulk_write(writes, ordered=False)
@@ -4,11 +4,24 @@ from langgraph.store.postgres.aio import AsyncPostgresStore
 from contextlib import asynccontextmanager
 
 from config.settings import settings
+from memory.embeddings import get_index_config
+from memory.retention import CheckpointPruner
 
+from psycopg import AsyncConnection
 from psycopg.rows import dict_row
 from psycopg_pool import AsyncConnectionPool
 
 
+# Pools opened by this process, by name, so their statistics can be reported
+_pools: dict[str, AsyncConnectionPool] = {}
+
+# Advisory lock held while running the migrations, so the workers and replicas
+# starting together run them one after the other instead of all at once
+SETUP_LOCK_KEY = 0x61692D7365747570  # "ai-setup"
+# Advisory lock held during a checkpoint retention pass, so a single worker prunes at a time
+RETENTION_LOCK_KEY = 0x61692D7072756E65  # "ai-prune"
+
+
 def get_postgres_connection_string() ->str:
     """Build and return the PostgreSQL connection string from settings."""
     if settings.POSTGRES_PASSWORD is None:
@@ -20,48 +33,189 @@ def get_postgres_connection_string() ->str:
         f"{settings.POSTGRES_DB}"
     )
 
+
 @asynccontextmanager
-async def get_postgres_saver():
-    "Initializes and return a postgreSQL saver instance using connection pool for resilent connection"""
+async def get_postgres_pool(name: str):
+    """Open a connection pool sized from settings and register it for pool statistics"""
 
-    application_name = settings.POSTGRES_APPLICATION_NAME + "-" + "saver"
+    application_name = settings.POSTGRES_APPLICATION_NAME + "-" + name
 
     async with AsyncConnectionPool(
         get_postgres_connection_string(),
         min_size=settings.POSTGRES_MIN_CONNECTIONS_PER_POOL,
         max_size=settings.POSTGRES_MAX_CONNECTIONS_PER_POOL,
+        timeout=settings.POSTGRES_POOL_TIMEOUT,
+        max_idle=settings.POSTGRES_POOL_MAX_IDLE,
+        max_waiting=settings.POSTGRES_POOL_MAX_WAITING,
+        name=name,
+        open=False,
 
         kwargs={"autocommit": True, "row_factory": dict_row, "application_name": application_name},
 
         check=AsyncConnectionPool.check_connection,
     ) as pool:
+        _pools[name] = pool
         try:
-            checkpointer = AsyncPostgresSaver(pool)
-            await checkpointer.setup()
-            yield checkpointer
+            yield pool
 
         finally:
-            await pool.close()
+            _pools.pop(name, None)
+
+
+def get_pool_stats() -> dict[str, dict[str, int]]:
+    """Return the statistics (size, waiting clients, errors...) of every open pool"""
+    return {name: pool.get_stats() for name, pool in _pools.items()}
+
+
+async def check_pools(timeout: float) -> dict[str, str]:
+    """Run a trivial query through every open pool, return "ok" or the error by pool name"""
+    results = {}
+    for name, pool in list(_pools.items()):
+        try:
+            async with pool.connection(timeout=timeout) as conn:
+                await conn.execute("SELECT 1")
+            results[name] = "ok"
+        except Exception as e:
+            results[name] = f"error: {e!r}"
+    return results
+
+
+async def run_setup(*components):
+    """Run the `setup()` migrations of the saver and store under the advisory lock"""
+    # on its own connection, the pools may be too small to spare one while setup() runs
+    async with await AsyncConnection.connect(get_postgres_connection_string(), autocommit=True) as conn:
+        await conn.execute("SELECT pg_advisory_lock(%s)", (SETUP_LOCK_KEY,))
+        try:
+            for component in components:
+                await component.setup()
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (SETUP_LOCK_KEY,))
+
 
 @asynccontextmanager
-async def get_postgres_store():
-    "Initializes and return a postgreSQL store instance using connection pool for resilent connection"
+async def get_postgres_saver():
+    "Initializes and return a postgreSQL saver instance using connection pool for resilent connection"""
 
-    application_name = settings.POSTGRES_APPLICATION_NAME + "-" + "store"
+    async with get_postgres_pool("saver") as pool:
+        checkpointer = AsyncPostgresSaver(pool)
+        await run_setup(checkpointer)
+        yield checkpointer
 
-    async with AsyncConnectionPool(
-        get_postgres_connection_string(),
-        min_size=settings.POSTGRES_MIN_CONNECTIONS_PER_POOL,
-        max_size=settings.POSTGRES_MAX_CONNECTIONS_PER_POOL,
 
-        kwargs={"autocommit": True, "row_factory": dict_row, "application_name": application_name},
+@asynccontextmanager
+async def get_postgres_store():
+    "Initializes and return a postgreSQL store instance using connection pool for resilent connection"
 
-        check=AsyncConnectionPool.check_connection,
-    ) as pool:
-        try:
-            store = AsyncPostgresStore(pool)
-            await store.setup()
-            yield store
+    async with get_postgres_pool("store") as pool:
+        store = AsyncPostgresStore(pool, index=get_index_config())
+        await run_setup(store)
+        yield store
 
-        finally:
-            await pool.close()
\ No newline at end of file
+
+@asynccontextmanager
+async def get_postgres_memory():
+    """
+    Initializes and return the postgreSQL saver and store.
+
+    Both share a single connection pool unless POSTGRES_SHARED_POOL is disabled,
+    in which case each gets its own pool of the configured size.
+    """
+
+    if not settings.POSTGRES_SHARED_POOL:
+        async with get_postgres_saver() as checkpointer, get_postgres_store() as store:
+            yield checkpointer, store
+        return
+
+    async with get_postgres_pool("shared") as pool:
+        checkpointer = AsyncPostgresSaver(pool)
+        store = AsyncPostgresStore(pool, index=get_index_config())
+        await run_setup(checkpointer, store)
+        yield checkpointer, store
+
+
+# The latest checkpoint of the next threads, walking the thread_id index
+LATEST_CHECKPOINTS_SQL = """
+SELECT thread_id, max(checkpoint_id) AS checkpoint_id
+FROM checkpoints
+WHERE thread_id IN (
+    SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id > %s ORDER BY thread_id LIMIT %s
+)
+GROUP BY thread_id
+ORDER BY thread_id
+"""
+
+DELETE_OLD_CHECKPOINTS_SQL = """
+DELETE FROM checkpoints c
+USING (
+    SELECT thread_id, checkpoint_ns, checkpoint_id,
+           row_number() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position
+    FROM checkpoints
+    WHERE thread_id = ANY(%(threads)s)
+) old
+WHERE old.position > %(keep_last)s
+    AND c.thread_id = old.thread_id
+    AND c.checkpoint_ns = old.checkpoint_ns
+    AND c.checkpoint_id = old.checkpoint_id
+"""
+
+# Pending writes of checkpoints that no longer exist
+DELETE_ORPHAN_WRITES_SQL = """
+DELETE FROM checkpoint_writes w
+WHERE w.thread_id = ANY(%(threads)s)
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints c
+        WHERE c.thread_id = w.thread_id AND c.checkpoint_ns = w.checkpoint_ns AND c.checkpoint_id = w.checkpoint_id
+    )
+"""
+
+# Channel values no remaining checkpoint points to
+DELETE_ORPHAN_BLOBS_SQL = """
+DELETE FROM checkpoint_blobs b
+WHERE b.thread_id = ANY(%(threads)s)
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints c, jsonb_each_text(c.checkpoint -> 'channel_versions') v
+        WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+            AND v.key = b.channel AND v.value = b.version
+    )
+"""
+
+
+class PostgresCheckpointPruner(CheckpointPruner):
+    """Prunes the tables of an `AsyncPostgresSaver`, every batch in a single transaction"""
+
+    def __init__(self, saver: AsyncPostgresSaver):
+        self.pool: AsyncConnectionPool = saver.conn
+
+    async def latest_checkpoints(self, after: str, limit: int) -> dict[str, str]:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(LATEST_CHECKPOINTS_SQL, (after, limit))
+            return {row["thread_id"]: row["checkpoint_id"] for row in await cursor.fetchall()}
+
+    async def drop_threads(self, thread_ids: list[str]) -> dict[str, int]:
+        rows = {}
+        async with self.pool.connection() as conn, conn.transaction():
+            for table in ("checkpoint_writes", "checkpoint_blobs", "checkpoints"):
+                cursor = await conn.execute(f"DELETE FROM {table} WHERE thread_id = ANY(%s)", (thread_ids,))
+                rows[table] = cursor.rowcount
+        return rows
+
+    async def compact_threads(self, thread_ids: list[str], keep_last: int) -> dict[str, int]:
+        params = {"threads": thread_ids, "keep_last": keep_last}
+        async with self.pool.connection() as conn, conn.transaction():
+            checkpoints = await conn.execute(DELETE_OLD_CHECKPOINTS_SQL, params)
+            writes = await conn.execute(DELETE_ORPHAN_WRITES_SQL, params)
+            blobs = await conn.execute(DELETE_ORPHAN_BLOBS_SQL, params)
+            return {"checkpoints": checkpoints.rowcount, "checkpoint_writes": writes.rowcount,
+                    "checkpoint_blobs": blobs.rowcount}
+
+    @asynccontextmanager
+    async def exclusive(self):
+        # on its own connection, which releases the lock if the process dies mid-pass
+        async with await AsyncConnection.connect(get_postgres_connection_string(), autocommit=True) as conn:
+            cursor = await conn.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_KEY,))
+            acquired = (await cursor.fetchone())[0]
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    await conn.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_KEY,))
@@ -0,0 +1,243 @@
+"""
+Retention of the checkpoints: LangGraph saves a checkpoint for every super-step of
+every thread, so the checkpoint tables grow by several rows per turn forever.
+
+A pass walks the threads in batches of CHECKPOINT_RETENTION_BATCH_SIZE. It keeps the
+latest CHECKPOINT_KEEP_LAST checkpoints of every thread with the writes and channel
+values they use, and deletes the threads idle for more than CHECKPOINT_MAX_IDLE_DAYS.
+The service runs a pass every CHECKPOINT_RETENTION_INTERVAL_SECONDS, or run one from a
+cron job:
+
+    cd app
+    python -m memory.retention
+    python -m memory.retention --keep-last 5 --max-idle-days 90
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from langgraph.checkpoint.base.id import UUID
+
+from config.settings import settings
+from core.metrics import CHECKPOINT_RETENTION_LATENCY, CHECKPOINT_ROWS_RECLAIMED, CHECKPOINT_THREADS_DROPPED
+
+
+logger = logging.getLogger(__name__)
+
+# 100-ns intervals between the UUID epoch 1582-10-15 and the Unix epoch
+_UUID_EPOCH = 0x01B21DD213814000
+
+
+def checkpoint_id_at(moment: datetime) -> str:
+    """
+    The smallest checkpoint id LangGraph can create at `moment`. Checkpoint ids are
+    time-ordered UUIDv6, so the checkpoints saved before `moment` have lower ids.
+    """
+    timestamp = int(moment.timestamp() * 10**7) + _UUID_EPOCH
+    uuid_int = ((timestamp >> 12) & 0xFFFFFFFFFFFF) << 80 | (timestamp & 0x0FFF) << 64
+    return str(UUID(int=uuid_int, version=6))
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """What a retention pass keeps"""
+    # latest checkpoints kept per thread and checkpoint namespace
+    keep_last: int
+    # threads without a checkpoint for longer are deleted, None keeps them
+    max_idle: timedelta | None
+    # threads with a more recent checkpoint are left alone, a run may be writing to them
+    grace: timedelta
+    batch_size: int
+
+    def __post_init__(self):
+        if self.keep_last < 1:
+            raise ValueError("keep_last must be at least 1, the latest checkpoint holds the thread's state")
+        if self.batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+    @classmethod
+    def from_settings(cls, **overrides) -> "RetentionPolicy":
+        values = {
+            "keep_last": settings.CHECKPOINT_KEEP_LAST,
+            "max_idle": timedelta(days=settings.CHECKPOINT_MAX_IDLE_DAYS) if settings.CHECKPOINT_MAX_IDLE_DAYS > 0 else None,
+            "grace": timedelta(seconds=settings.CHECKPOINT_RETENTION_GRACE_SECONDS),
+            "batch_size": settings.CHECKPOINT_RETENTION_BATCH_SIZE,
+        }
+        return cls(**(values | overrides))
+
+
+@dataclass
+class PruneResult:
+    threads: int = 0
+    dropped_threads: int = 0
+    # rows (documents) deleted by table (collection)
+    rows: dict[str, int] = field(default_factory=dict)
+
+    def add(self, other: "PruneResult"):
+        self.threads += other.threads
+        self.dropped_threads += other.dropped_threads
+        self.add_rows(other.rows)
+
+    def add_rows(self, rows: dict[str, int]):
+        for table, count in rows.items():
+            self.rows[table] = self.rows.get(table, 0) + count
+
+
+class CheckpointPruner:
+    """
+    Deletes the checkpoints of a saver's database, a batch of threads at a time.
+
+    The backends implement how to read the latest checkpoint of the threads and
+    how to delete threads, old checkpoints and the rows they leave behind.
+    """
+
+    async def latest_checkpoints(self, after: str, limit: int) -> dict[str, str]:
+        """The latest checkpoint id of the `limit` first threads after `after`, in the database's order"""
+        raise NotImplementedError
+
+    async def drop_threads(self, thread_ids: list[str]) -> dict[str, int]:
+        """Delete everything saved for the threads, return the rows deleted by table"""
+        raise NotImplementedError
+
+    async def compact_threads(self, thread_ids: list[str], keep_last: int) -> dict[str, int]:
+        """Delete all but the latest `keep_last` checkpoints of the threads and the rows only they used"""
+        raise NotImplementedError
+
+    @asynccontextmanager
+    async def exclusive(self):
+        """Whether this process may run the pass, backends can keep workers from pruning at the same time"""
+        yield True
+
+    async def prune_batch(self, after: str, policy: RetentionPolicy, now: datetime) -> tuple[str | None, PruneResult]:
+        """Prune the next batch of threads, return the thread to continue after (None at the end)"""
+        latest = await self.latest_checkpoints(after, policy.batch_size)
+        if not latest:
+            return None, PruneResult()
+
+        idle_before = checkpoint_id_at(now - policy.max_idle) if policy.max_idle else None
+        quiet_before = checkpoint_id_at(now - policy.grace)
+        quiet = [thread_id for thread_id, checkpoint_id in latest.items() if checkpoint_id < quiet_before]
+        dropped = [thread_id for thread_id in quiet if idle_before is not None and latest[thread_id] < idle_before]
+        compacted = [thread_id for thread_id in quiet if thread_id not in dropped]
+
+        result = PruneResult(threads=len(latest), dropped_threads=len(dropped))
+        if dropped:
+            result.add_rows(await self.drop_threads(dropped))
+        if compacted:
+            result.add_rows(await self.compact_threads(compacted, policy.keep_last))
+        return next(reversed(latest)), result
+
+
+async def prune_checkpoints(pruner: CheckpointPruner,
+                            policy: RetentionPolicy,
+                            pause: float = 0.0,
+                            forget_idle: Callable[[datetime], Awaitable[int]] | None = None) -> PruneResult:
+    """
+    Run a retention pass over every thread, sleeping `pause` seconds between the
+    batches. `forget_idle` is called with the idle cutoff once the idle threads are
+    deleted, to drop them from other indexes (e.g. the users' thread lists).
+    """
+    total = PruneResult()
+    async with pruner.exclusive() as acquired:
+        if not acquired:
+            logger.info("Checkpoint retention is already running in another process")
+            return total
+
+        now = datetime.now(timezone.utc)
+        after = ""
+        while after is not None:
+            start = time.perf_counter()
+            after, result = await pruner.prune_batch(after, policy, now)
+            CHECKPOINT_RETENTION_LATENCY.observe(time.perf_counter() - start)
+            CHECKPOINT_THREADS_DROPPED.inc(result.dropped_threads)
+            for table, count in result.rows.items():
+                CHECKPOINT_ROWS_RECLAIMED.labels(table=table).inc(count)
+            total.add(result)
+            if after is not None and pause:
+                await asyncio.sleep(pause)
+
+        if forget_idle is not None and policy.max_idle is not None:
+            await forget_idle(now - policy.max_idle)
+
+    logger.info("Checkpoint retention: %d threads, %d dropped, rows deleted %s",
+                total.threads, total.dropped_threads, total.rows)
+    return total
+
+
+class CheckpointRetention:
+    """Background task running a retention pass every `interval` seconds"""
+
+    def __init__(self,
+                 pruner: CheckpointPruner,
+                 policy: RetentionPolicy,
+                 interval: float,
+                 pause: float = 0.0,
+                 forget_idle: Callable[[datetime], Awaitable[int]] | None = None):
+        self.pruner = pruner
+        self.policy = policy
+        self.interval = interval
+        self.pause = pause
+        self.forget_idle = forget_idle
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the task, a batch in progress is rolled back"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            # the first pass waits too, so it doesn't slow down the startup
+            await asyncio.sleep(self.interval)
+            try:
+                await prune_checkpoints(self.pruner, self.policy, self.pause, self.forget_idle)
+            except Exception:
+                logger.exception("Checkpoint retention pass failed")
+
+
+async def _main(args: argparse.Namespace):
+    from memory import get_checkpoint_pruner, initialize_memory
+    from service.history import forget_idle_threads
+
+    overrides = {}
+    if args.keep_last is not None:
+        overrides["keep_last"] = args.keep_last
+    if args.max_idle_days is not None:
+        overrides["max_idle"] = timedelta(days=args.max_idle_days) if args.max_idle_days > 0 else None
+    if args.batch_size is not None:
+        overrides["batch_size"] = args.batch_size
+    policy = RetentionPolicy.from_settings(**overrides)
+
+    async with initialize_memory() as (saver, store):
+        result = await prune_checkpoints(get_checkpoint_pruner(saver), policy,
+                                         pause=settings.CHECKPOINT_RETENTION_BATCH_PAUSE_SECONDS,
+                                         forget_idle=lambda idle_before: forget_idle_threads(store, idle_before))
+    print(json.dumps(asdict(result), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete the old checkpoints and idle threads of the configured database")
+    parser.add_argument("--keep-last", type=int, help="checkpoints kept per thread (CHECKPOINT_KEEP_LAST)")
+    parser.add_argument("--max-idle-days", type=float, help="delete threads idle for longer, 0 keeps them (CHECKPOINT_MAX_IDLE_DAYS)")
+    parser.add_argument("--batch-size", type=int, help="threads pruned per batch (CHECKPOINT_RETENTION_BATCH_SIZE)")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,48 @@
-import asyncio
-import sys
+import os
+import shutil
+import tempfile
+from pathlib import Path
 import uvicorn
 from config.settings import settings
 
 
+def run_production():
+    """
+    Serve with SERVICE_WORKERS processes. Each one runs the lifespan and opens
+    its own database pools, and on shutdown stops accepting connections and
+    gives the open requests SERVICE_GRACEFUL_SHUTDOWN_SECONDS to finish.
+
+    The workers don't share their in-memory state: the memory and response
+    caches are turned off, and the per-thread ordering of the requests and the
+    write-behind queue only hold within a worker.
+    """
+    created_metrics_dir = None
+    if settings.SERVICE_WORKERS > 1:
+        # the workers write their metrics there, so /metrics reports the whole service
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            # the files of a previous run would be added to this one's
+            for path in Path(os.environ["PROMETHEUS_MULTIPROC_DIR"]).glob("*.db"):
+                path.unlink()
+        else:
+            created_metrics_dir = tempfile.mkdtemp(prefix="assistant-metrics-")
+            os.environ["PROMETHEUS_MULTIPROC_DIR"] = created_metrics_dir
+
+    try:
+        uvicorn.run("service:app",
+                    host=settings.SERVICE_HOST,
+                    port=settings.SERVICE_PORT,
+                    workers=settings.SERVICE_WORKERS,
+                    # a worker whose initialization fails exits instead of serving without an agent
+                    lifespan="on",
+                    timeout_graceful_shutdown=settings.SERVICE_GRACEFUL_SHUTDOWN_SECONDS,
+                    log_level="info")
+    finally:
+        if created_metrics_dir is not None:
+            shutil.rmtree(created_metrics_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
-    uvicorn.run("service:app", host=settings.SERVICE_HOST, port=settings.SERVICE_PORT, reload=settings.DEV, log_level="info")
+    if settings.DEV:
+        uvicorn.run("service:app", host=settings.SERVICE_HOST, port=settings.SERVICE_PORT, reload=settings.DEV, log_level="info")
+    else:
+        run_production()
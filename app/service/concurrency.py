@@ -0,0 +1,194 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+from contextlib import asynccontextmanager, nullcontext
+from typing import TypeVar
+
+from core.metrics import REQUESTS_COALESCED, REQUESTS_REJECTED, RUNS_QUEUED, RUNS_RUNNING
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+E = TypeVar("E")
+
+
+class ServiceOverloaded(Exception):
+    """Raised when a request is not admitted because too many runs are already waiting"""
+
+
+class RunCoordinator:
+    """
+    Admission and ordering of the agent runs of the service.
+
+    - Runs on the same thread are serialized in arrival order, so two requests
+      never race on the thread's checkpoint.
+    - A request identical to one already queued or running on the thread (a
+      double submit or a client retry) shares that run and its result instead
+      of paying for its own LLM calls.
+    - At most `max_concurrent` runs execute at once over all threads, which
+      protects the database pool and the LLM rate limit. At most `max_queued`
+      requests wait for their turn, further requests raise `ServiceOverloaded`.
+
+    A limit of 0 disables it. The runs are tasks of their own, a client going
+    away does not cancel them: a run stopped mid-turn would leave tool calls
+    without their results in the thread's checkpoint.
+    """
+
+    def __init__(self, max_concurrent: int = 0, max_queued: int = 0):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+        self._thread_locks: dict[str, asyncio.Lock] = {}
+        self._thread_requests: dict[str, int] = {}
+        self._inflight: dict[tuple[str, Hashable], asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.queued = 0
+        self.running = 0
+
+    def check_admission(self):
+        """Raise `ServiceOverloaded` if no more requests can be queued"""
+        if self.max_queued and self.queued >= self.max_queued:
+            REQUESTS_REJECTED.inc()
+            raise ServiceOverloaded(f"Too many requests in progress ({self.running} running, {self.queued} queued)")
+
+    @asynccontextmanager
+    async def slot(self, thread_id: str):
+        """Wait for the previous runs of the thread and a free run slot, and hold them while the block runs"""
+        self.check_admission()
+
+        lock = self._thread_locks.get(thread_id)
+        if lock is None:
+            lock = self._thread_locks[thread_id] = asyncio.Lock()
+        self._thread_requests[thread_id] = self._thread_requests.get(thread_id, 0) + 1
+        self._set_queued(1)
+        queued = True
+
+        try:
+            # asyncio locks wake their waiters in FIFO order
+            async with lock, self._semaphore or nullcontext():
+                self._set_queued(-1)
+                queued = False
+                self._set_running(1)
+                try:
+                    yield
+                finally:
+                    self._set_running(-1)
+        finally:
+            if queued:
+                self._set_queued(-1)
+            self._thread_requests[thread_id] -= 1
+            if not self._thread_requests[thread_id]:
+                del self._thread_requests[thread_id]
+                del self._thread_locks[thread_id]
+
+    async def run(self, thread_id: str, key: Hashable, run: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `run()` in a slot of the thread and return its result.
+
+        If a request with the same `key` is already queued or running on the
+        thread, its result is returned instead of running again.
+        """
+        inflight_key = (thread_id, key)
+        task = self._inflight.get(inflight_key)
+
+        if task is None or task.done():
+            self.check_admission()
+
+            async def run_in_slot():
+                async with self.slot(thread_id):
+                    return await run()
+
+            task = self._inflight[inflight_key] = self._start(run_in_slot())
+            task.add_done_callback(lambda done: self._forget(inflight_key, done))
+        else:
+            REQUESTS_COALESCED.inc()
+
+        # a client going away does not cancel the run the other requests wait for
+        return await asyncio.shield(task)
+
+    async def stream(self, thread_id: str, run: Callable[[Callable[[E], None]], Awaitable[None]]) -> AsyncIterator[E]:
+        """
+        Run `run(emit)` in a slot of the thread and yield the events it emits, as
+        they come. The exception of the run is raised once its events are yielded.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def run_in_slot():
+            try:
+                async with self.slot(thread_id):
+                    await run(events.put_nowait)
+            finally:
+                events.put_nowait(done)
+
+        task = self._start(run_in_slot())
+        # the consumer going away stops reading the events, not the run
+        while (event := await events.get()) is not done:
+            yield event
+        await task
+
+    async def drain(self):
+        """Wait for the runs still in progress, e.g. those whose client went away, on shutdown"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self, coroutine: Awaitable[T]) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        # referenced until done, so a run nobody awaits anymore is not garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled():
+            # retrieved, the client that would have received it may be gone
+            task.exception()
+
+    def _forget(self, key: tuple[str, Hashable], task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def _set_queued(self, delta: int):
+        self.queued += delta
+        RUNS_QUEUED.inc(delta)
+
+    def _set_running(self, delta: int):
+        self.running += delta
+        RUNS_RUNNING.inc(delta)
+
+
+async def run_grouped(items: list[T],
+                      key: Callable[[T], Hashable],
+                      run: Callable[[T], Awaitable[R]],
+                      concurrency: int) -> AsyncIterator[tuple[int, R | Exception]]:
+    """
+    Run `run(item)` for every item and yield `(position, result)` as they finish,
+    the result being the exception when the run raised one.
+
+    Items with the same key run one after the other in their order, and the
+    groups of items run concurrently, at most `concurrency` at once.
+    """
+    groups: dict[Hashable, list[int]] = {}
+    for position, item in enumerate(items):
+        groups.setdefault(key(item), []).append(position)
+    # shared by the workers, each takes the next group when it is done with one
+    pending = iter(groups.values())
+    results: asyncio.Queue[tuple[int, R | Exception]] = asyncio.Queue()
+
+    async def worker():
+        for group in pending:
+            for position in group:
+                try:
+                    result = await run(items[position])
+                except Exception as e:
+                    result = e
+                results.put_nowait((position, result))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(max(concurrency, 1), len(groups)))]
+    try:
+        for _ in items:
+            yield await results.get()
+    finally:
+        # the consumer went away, e.g. the client of a stream disconnected
+        for task in workers:
+            task.cancel()
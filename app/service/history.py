@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, messages_from_dict
+from langgraph.store.base import BaseStore, PutOp
+
+from agents.personal_assistant import transcript_chunk_key, transcript_namespace
+from agents.utilities import asearch_all
+from config.settings import settings
+from service.schemas import ChatMessage, HistoryPage, ThreadInfo, ThreadPage
+
+
+def threads_namespace(user_id: str) -> tuple[str, str]:
+    """Store namespace of the index of a user's threads"""
+    return ("threads", user_id)
+
+
+async def record_thread(store: BaseStore, user_id: str, thread_id: str):
+    """Add the thread to the user's thread index, or mark it as just used"""
+    await store.aput(threads_namespace(user_id), thread_id,
+                     {"thread_id": thread_id, "updated_at": datetime.now(timezone.utc).isoformat()},
+                     index=False)
+
+
+async def list_threads(store: BaseStore, user_id: str, limit: int, offset: int) -> ThreadPage:
+    """A page of the user's threads, the most recently used first"""
+    items = await asearch_all(store, threads_namespace(user_id))
+    threads = sorted((item.value for item in items), key=lambda thread: thread["updated_at"], reverse=True)
+    page = threads[offset:offset + limit]
+    return ThreadPage(threads=[ThreadInfo(**thread) for thread in page],
+                      next_offset=offset + limit if offset + limit < len(threads) else None)
+
+
+async def forget_idle_threads(store: BaseStore, idle_before: datetime) -> int:
+    """Remove the threads unused since `idle_before` from the users' thread index, once their checkpoints are deleted"""
+    idle = []
+    page_size = settings.MEMORY_SEARCH_PAGE_SIZE
+    offset = 0
+    while True:
+        page = await store.asearch(("threads",), limit=page_size, offset=offset)
+        idle += [item for item in page if datetime.fromisoformat(item.value["updated_at"]) < idle_before]
+        if len(page) < page_size:
+            break
+        offset += page_size
+    # deleted once every page is read, so the offsets don't move while paging
+    for start in range(0, len(idle), page_size):
+        await store.abatch([PutOp(item.namespace, item.key, None) for item in idle[start:start + page_size]])
+    for item in idle:
+        user_id = item.namespace[1]
+        transcript = await asearch_all(store, transcript_namespace(user_id, user_id + "_" + item.key))
+        if transcript:
+            await store.abatch([PutOp(part.namespace, part.key, None) for part in transcript])
+    return len(idle)
+
+
+def chat_messages(messages: list[AnyMessage], start: int = 0) -> list[ChatMessage]:
+    """
+    The user messages and assistant replies among `messages`, the first of them
+    at position `start` of the thread, without the tool calls and tool messages
+    """
+    chat = []
+    for position, message in enumerate(messages, start):
+        if isinstance(message, HumanMessage):
+            chat.append(ChatMessage(id=message.id, position=position, role="user", content=message.content))
+        elif isinstance(message, AIMessage) and not message.tool_calls and message.content:
+            chat.append(ChatMessage(id=message.id, position=position, role="assistant", content=message.content))
+    return chat
+
+
+async def history_page(store: BaseStore, user_id: str, thread_id: str, values: dict,
+                       limit: int, before: int | None) -> HistoryPage:
+    """
+    The `limit` chat messages of a thread before position `before` (the latest
+    ones when None), oldest first, with the position to ask for the page before
+    them. `values` is the thread's state: the messages the summaries removed from
+    it are read from the store, only the transcript chunks the page needs.
+    Raises KeyError when `before` is past the end of the thread.
+    """
+    offset = values.get("transcript_length", 0)
+    messages = values.get("messages", [])
+    end = offset + len(messages) if before is None else before
+    if end > offset + len(messages):
+        raise KeyError(before)
+
+    chat = chat_messages(messages[:max(end - offset, 0)], offset)
+    namespace = transcript_namespace(user_id, thread_id)
+    position = min(end, offset)
+    # one message more than the page, to know whether there are older ones
+    while len(chat) <= limit and position > 0:
+        chunk = await store.aget(namespace, transcript_chunk_key(position - 1))
+        if chunk is None:
+            break
+        start = chunk.value["start"]
+        chat = chat_messages(messages_from_dict(chunk.value["messages"])[:position - start], start) + chat
+        position = start
+    page = chat[-limit:]
+    return HistoryPage(messages=page, before=page[0].position if len(chat) > limit else None)
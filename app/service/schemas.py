@@ -5,9 +5,47 @@ class UserInput(BaseModel):
     message:str
     user_id: str
     thread_id: str
+    # wait for this user's pending background memory updates before running the turn
+    flush_memory: bool = False
 
 class ResponseModel(BaseModel):
     response: str
     thread_id: str
     user_id: str
-    status: str
\ No newline at end of file
+    status: str
+
+class BatchInput(BaseModel):
+    requests: list[UserInput]
+    # stream the results as NDJSON lines as they finish, instead of returning them all in order
+    stream: bool = False
+
+class BatchResult(ResponseModel):
+    # position of the request in the batch
+    index: int
+    # why the turn failed; "rejected" turns were not run, the service was overloaded
+    detail: str | None = None
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+
+class ThreadInfo(BaseModel):
+    thread_id: str
+    # ISO 8601 time of the thread's last turn
+    updated_at: str
+
+class ThreadPage(BaseModel):
+    threads: list[ThreadInfo]
+    # offset of the next page, None on the last page
+    next_offset: int | None = None
+
+class ChatMessage(BaseModel):
+    id: str | None = None
+    # position of the message in the thread, counting the tool calls and tool messages
+    position: int | None = None
+    role: str
+    content: str
+
+class HistoryPage(BaseModel):
+    messages: list[ChatMessage]
+    # position of the oldest message, pass it as `before` to get the older ones; None when there are none
+    before: int | None = None
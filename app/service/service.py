@@ -1,43 +1,97 @@
-from fastapi import FastAPI, Request, HTTPException
+import asyncio
+import json
+import os
+
+from fastapi import FastAPI, Request, HTTPException, Query
 from fastapi.responses import JSONResponse
 from fastapi.responses import StreamingResponse
+from fastapi.responses import Response
 
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 
 from agents.personal_assistant import create_agent_graph
+from agents.write_behind import MemoryUpdateQueue
 
-from service.schemas import UserInput, ResponseModel
+from service.schemas import UserInput, ResponseModel, ThreadPage, HistoryPage, BatchInput, BatchResult, BatchResponse
+from service.history import forget_idle_threads, history_page, list_threads, record_thread
+from service.concurrency import RunCoordinator, ServiceOverloaded, run_grouped
 
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 
-from memory import initialize_database, initialize_store
+from memory import initialize_memory, get_pool_stats, check_pools, get_checkpoint_pruner
+from memory.retention import CheckpointRetention, RetentionPolicy
+from core.metrics import InstrumentedStore, metrics_callbacks, request_span
+from config.settings import settings
 
 
 @asynccontextmanager
 async def lifespan(app:FastAPI) -> AsyncGenerator:
     """
     initializes database checkpointer and store based on settings
+
+    An initialization error is raised again, so the worker fails to start
+    instead of serving requests without an agent.
     """
+    app.state.ready = False
     try:
-        async with initialize_database() as saver, initialize_store() as store:
-
-            if hasattr(saver, "setup"):
-                await saver.setup()
-            if hasattr(store, "setup"):
-                await store.setup()
-
-            agent = create_agent_graph(checkpointer=saver,store=store)
+        # the checkpointer and store come back already set up
+        async with initialize_memory() as (saver, store):
+
+            # time and count every store round-trip
+            if settings.METRICS_ENABLED:
+                store = InstrumentedStore(store)
+
+            # memory updates run in the background when write-behind is enabled
+            memory_queue = None
+            if settings.MEMORY_WRITE_BEHIND:
+                memory_queue = MemoryUpdateQueue()
+                await memory_queue.start()
+            app.state.memory_queue = memory_queue
+
+            # serializes the runs of a thread and bounds the runs of the whole service
+            app.state.run_coordinator = RunCoordinator(
+                max_concurrent=settings.SERVICE_MAX_CONCURRENT_RUNS,
+                max_queued=settings.SERVICE_MAX_QUEUED_RUNS,
+            )
+
+            agent = create_agent_graph(checkpointer=saver,store=store, memory_queue=memory_queue)
             #need to store the agent in the app state for access in routes
             app.state.agent = agent
 
-            yield
+            # prune the old checkpoints and idle threads in the background
+            retention = None
+            if settings.CHECKPOINT_RETENTION_INTERVAL_SECONDS > 0:
+                retention = CheckpointRetention(
+                    get_checkpoint_pruner(saver),
+                    RetentionPolicy.from_settings(),
+                    interval=settings.CHECKPOINT_RETENTION_INTERVAL_SECONDS,
+                    pause=settings.CHECKPOINT_RETENTION_BATCH_PAUSE_SECONDS,
+                    forget_idle=lambda idle_before: forget_idle_threads(store, idle_before),
+                )
+                await retention.start()
+            app.state.ready = True
+
+            try:
+                yield
+            finally:
+                # uvicorn has already drained the open requests, no longer report ready
+                app.state.ready = False
+                if retention is not None:
+                    await retention.close()
+                # the turns whose client went away finish before the store is closed
+                await app.state.run_coordinator.drain()
+                # apply the scheduled memory updates before the store is closed
+                if memory_queue is not None:
+                    await memory_queue.close()
 
     except Exception as e:
         print(f"Error during database or store initialization: {e}")
+        raise
     
     finally:
         # The code here runs on shutdown.
@@ -45,6 +99,20 @@ async def lifespan(app:FastAPI) -> AsyncGenerator:
 
 app = FastAPI(lifespan=lifespan)
 
+# Seconds a client is asked to wait before retrying a rejected request
+RETRY_AFTER_SECONDS = 1
+
+
+def overloaded(e: ServiceOverloaded) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+async def flush_memory_updates(request: UserInput):
+    """Wait for the user's pending background memory updates if the request asks for it"""
+    memory_queue = getattr(app.state, "memory_queue", None)
+    if request.flush_memory and memory_queue is not None:
+        await memory_queue.flush(request.user_id)
+
 
 # CORS middleware setup
 app.add_middleware(
@@ -55,37 +123,109 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-@app.post("/chat")
-async def chat(request:UserInput) -> ResponseModel:
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Prometheus metrics: per-node, LLM, store and request latencies, token counts, errors and route decisions"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # the metrics of every worker process, added up
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/health/live")
+async def live() -> dict:
+    """Liveness: the worker is up and its event loop answers"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def ready() -> JSONResponse:
+    """Readiness: the agent is initialized and not shutting down, the database pools and the store answer"""
+    if not getattr(app.state, "ready", False):
+        return JSONResponse({"status": "unavailable", "checks": {"agent": "not initialized or shutting down"}}, status_code=503)
+
+    timeout = settings.SERVICE_HEALTH_TIMEOUT_SECONDS
+    checks = await check_pools(timeout)
+    try:
+        await asyncio.wait_for(app.state.agent.store.asearch(("health",), limit=1), timeout)
+        checks["store"] = "ok"
+    except Exception as e:
+        checks["store"] = f"error: {e!r}"
+
+    healthy = all(check == "ok" for check in checks.values())
+    return JSONResponse({"status": "ready" if healthy else "unavailable", "checks": checks},
+                        status_code=200 if healthy else 503)
+
+
+@app.get("/pool_stats")
+async def pool_stats() -> dict:
+    """Statistics of the database connection pools: size, waiting clients, connection errors..."""
+    return get_pool_stats()
+
+
+@app.get("/threads/{user_id}")
+async def threads(user_id: str, limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0)) -> ThreadPage:
+    """The user's threads, the most recently used first"""
+    return await list_threads(app.state.agent.store, user_id, limit, offset)
+
+
+@app.get("/history/{user_id}/{thread_id}")
+async def history(user_id: str, thread_id: str,
+                  limit: int = Query(20, ge=1, le=100), before: int | None = Query(None, ge=0)) -> HistoryPage:
+    """
+    A page of the thread's messages, the latest ones first; pass the returned
+    `before` to get the older ones. The messages the summaries removed from the
+    checkpoint are read from the store.
+    """
+    config = {"configurable": {"thread_id": user_id + "_" + thread_id, "user_id": user_id}}
+    state = await app.state.agent.aget_state(config)
+    try:
+        return await history_page(app.state.agent.store, user_id, config["configurable"]["thread_id"],
+                                  state.values, limit, before)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"The thread has no message before position {before}")
+
+
+async def run_chat(request: UserInput, endpoint: str = "chat") -> ResponseModel:
+    """
+    Run a turn of the agent and return its reply, after the previous runs of
+    the thread and within the run limits (raises `ServiceOverloaded`).
+    """
 
     #seperating threads with user id and thread id
     thread_id = request.user_id + "_" + request.thread_id
 
-    config = {"configurable":{"thread_id": thread_id, "user_id": request.user_id}}
     input_message = HumanMessage(content=request.message)
 
-    try:
+    with request_span(endpoint, user_id=request.user_id, thread_id=thread_id) as span:
+        config = {"configurable":{"thread_id": thread_id, "user_id": request.user_id},
+                  "callbacks": metrics_callbacks(span)}
+
         #now lets access agent from app lifespan
 
         agent = app.state.agent
 
-        response = await agent.ainvoke({"messages": input_message}, config=config)
-        
+        async def run_turn():
+            await flush_memory_updates(request)
+            response = await agent.ainvoke({"messages": input_message}, config=config)
+            await record_thread(agent.store, request.user_id, request.thread_id)
+            return response
 
-        last_message = response['messages'][-1]
-        if isinstance(last_message, AIMessage):
-            # Process the AI message as needed
-            response_message = last_message.content
-            status = "success"
+        # identical requests on the thread share one run, different ones wait for their turn
+        response = await app.state.run_coordinator.run(thread_id, (request.message, request.flush_memory), run_turn)
 
-        else:
-            response_message="Unexpected message type received."
-            status = "error"
+    last_message = response['messages'][-1]
+    if isinstance(last_message, AIMessage):
+        # Process the AI message as needed
+        response_message = last_message.content
+        status = "success"
 
+    else:
+        response_message="Unexpected message type received."
+        status = "error"
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
     return ResponseModel(
         response=response_message,
         thread_id=request.thread_id,
@@ -94,39 +234,153 @@ async def chat(request:UserInput) -> ResponseModel:
     )
 
 
-
-@app.post("/chat_stream")
+@app.post("/chat")
 async def chat(request:UserInput) -> ResponseModel:
+    try:
+        return await run_chat(request)
+    except ServiceOverloaded as e:
+        raise overloaded(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    config = {"configurable":{"thread_id": request.thread_id, "user_id": request.user_id}}
-    input_message = HumanMessage(content=request.message)
 
+async def batch_results(requests: list[UserInput]) -> AsyncGenerator[BatchResult, None]:
+    """Run the turns of a batch, the threads concurrently, and yield their results as they finish"""
+    async for index, result in run_grouped(requests,
+                                           key=lambda request: request.user_id + "_" + request.thread_id,
+                                           run=lambda request: run_chat(request, "chat_batch"),
+                                           concurrency=settings.SERVICE_BATCH_CONCURRENCY):
+        if isinstance(result, ResponseModel):
+            yield BatchResult(index=index, **result.model_dump())
+        else:
+            request = requests[index]
+            yield BatchResult(index=index,
+                              response="",
+                              thread_id=request.thread_id,
+                              user_id=request.user_id,
+                              status="rejected" if isinstance(result, ServiceOverloaded) else "error",
+                              detail=str(result))
+
+
+@app.post("/chat/batch", response_model=BatchResponse)
+async def chat_batch(batch: BatchInput):
+    """
+    Run many turns, e.g. for offline jobs. The turns of a thread run one after the
+    other in the batch's order, SERVICE_BATCH_CONCURRENCY threads at once, and
+    every turn goes through the same admission and run limits as /chat.
+
+    Returns the results in the batch's order, or with `stream` streams them as
+    NDJSON lines as they finish. A failed turn does not fail the batch, its
+    result has the "error" or "rejected" status.
+    """
+    if len(batch.requests) > settings.SERVICE_BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=413, detail=f"A batch takes at most {settings.SERVICE_BATCH_MAX_REQUESTS} requests")
+
+    # reject the whole batch right away when the service is already overloaded
     try:
+        app.state.run_coordinator.check_admission()
+    except ServiceOverloaded as e:
+        raise overloaded(e)
 
-        agent = app.state.agent
+    if batch.stream:
+        return StreamingResponse(
+            (result.model_dump_json() + "\n" async for result in batch_results(batch.requests)),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    results = [result async for result in batch_results(batch.requests)]
+    return BatchResponse(results=sorted(results, key=lambda result: result.index))
+
+
+
+MEMORY_UPDATE_NODES = ("update_profile", "update_todos", "update_instructions", "schedule_memory_update")
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format a single server-sent event frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        for chunk in agent.stream({"messages":input_message}, config=config, stream_mode="values"):
-            last_message = chunk['messages'][-1]
-            if isinstance(last_message, AIMessage):
-                # Process the AI message as needed
-                response_message = last_message.content
-                status = "success"
 
-            else:
-                response_message="Unexpected message type received."
-                status = "error"
+async def stream_agent_events(agent, input_message: HumanMessage, config: dict, request: UserInput) -> AsyncGenerator[str, None]:
+    """
+    Run the agent asynchronously and yield server-sent events as they arrive:
+    `token` for every LLM token of the reply, `memory_update` for every memory
+    update node that finishes, and a final `end` (or `error`) event.
 
+    The turn runs in a task of the run coordinator and this generator only reads
+    its events, so a client disconnecting does not stop the turn halfway.
+    """
+    response_message = ""
+
+    async def run_turn(emit):
+        nonlocal response_message
+        streamed = False
+        with request_span("chat_stream", user_id=request.user_id, thread_id=config["configurable"]["thread_id"]) as span:
+            run_config = {**config, "callbacks": metrics_callbacks(span)}
+            await flush_memory_updates(request)
+            async for mode, chunk in agent.astream({"messages": input_message}, config=run_config, stream_mode=["messages", "updates"]):
+
+                if mode == "messages":
+                    message, metadata = chunk
+                    # only the assistant reply is streamed, extractor calls inside the update nodes are not
+                    if metadata.get("langgraph_node") == "task_assistant" and isinstance(message, AIMessageChunk) and message.content:
+                        streamed = True
+                        emit(format_sse("token", {"content": message.content}))
+
+                elif mode == "updates":
+                    for node, update in chunk.items():
+                        if not update:
+                            continue
+                        if node in MEMORY_UPDATE_NODES:
+                            for tool_message in update["messages"]:
+                                emit(format_sse("memory_update", {"node": node, "content": tool_message["content"]}))
+                        elif node == "task_assistant":
+                            last_message = update["messages"][-1]
+                            if isinstance(last_message, AIMessage) and not last_message.tool_calls:
+                                response_message = last_message.content
+                                # a reply from the response cache comes without tokens
+                                if not streamed and response_message:
+                                    emit(format_sse("token", {"content": response_message}))
+                            streamed = False
+
+            await record_thread(agent.store, request.user_id, request.thread_id)
 
+    try:
+        # waits for the previous runs of the thread and a free run slot
+        async for event in app.state.run_coordinator.stream(config["configurable"]["thread_id"], run_turn):
+            yield event
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    return ResponseModel(
+        yield format_sse("error", {"detail": str(e)})
+        return
+
+    yield format_sse("end", ResponseModel(
         response=response_message,
         thread_id=request.thread_id,
         user_id=request.user_id,
-        status=status
-    )
-    
+        status="success"
+    ).model_dump())
 
 
+@app.post("/chat_stream")
+async def chat_stream(request:UserInput) -> StreamingResponse:
+
+    #seperating threads with user id and thread id
+    thread_id = request.user_id + "_" + request.thread_id
+
+    config = {"configurable":{"thread_id": thread_id, "user_id": request.user_id}}
+    input_message = HumanMessage(content=request.message)
+
+    agent = app.state.agent
 
+    # reject right away when the service is overloaded, rather than with an event in the stream
+    try:
+        app.state.run_coordinator.check_admission()
+    except ServiceOverloaded as e:
+        raise overloaded(e)
+
+    return StreamingResponse(
+        stream_agent_events(agent, input_message, config, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,33 +1,109 @@
 import streamlit as st
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-import os
 import sys
-from client import chat_with_agent
+from client import ChatClient, ChatAPIError
 
-# Initialize session state for chat history and threads
-if 'chat_threads' not in st.session_state:
-    st.session_state.chat_threads = {'Main Thread': []}
-if 'current_thread' not in st.session_state:
-    st.session_state.current_thread = 'Main Thread'
+# Messages loaded per page of a thread's history, a rerun only renders the loaded pages
+HISTORY_PAGE_SIZE = 20
+# Messages kept on screen: loading earlier pages drops the latest ones beyond it, new messages the oldest ones
+HISTORY_WINDOW = 5 * HISTORY_PAGE_SIZE
+THREADS_PAGE_SIZE = 50
 
 
-def create_new_thread(thread_name):
-    if thread_name not in st.session_state.chat_threads:
-        st.session_state.chat_threads[thread_name] = []
-        st.session_state.current_thread = thread_name
+@st.cache_resource
+def get_client() -> ChatClient:
+    # one pooled client for every session of the Streamlit server
+    return ChatClient()
 
-def get_chat_history():
-    return st.session_state.chat_threads[st.session_state.current_thread]
 
+# Initialize session state: threads and history are loaded from the server when first needed
+if 'thread_names' not in st.session_state:
+    st.session_state.thread_names = None
+if 'histories' not in st.session_state:
+    st.session_state.histories = {}
+if 'current_thread' not in st.session_state:
+    st.session_state.current_thread = None
 
-def my_agent_function(prompt, user_name, thread_name):
-    # This function should contain the logic to get a response from your agent.
-    # For demonstration, we'll just return a simple response.
 
-    response_json = chat_with_agent(message=prompt, user_id=user_name, thread_id=thread_name)
+def load_threads(user_name):
+    if st.session_state.thread_names is None:
+        try:
+            page = get_client().list_threads(user_name, limit=THREADS_PAGE_SIZE)
+        except ChatAPIError as e:
+            # not saved, so the next rerun asks again
+            st.error(f"Could not load your threads: {e}")
+            st.session_state.current_thread = st.session_state.current_thread or 'Main Thread'
+            return [st.session_state.current_thread]
+        names = [thread["thread_id"] for thread in page["threads"]]
+        st.session_state.thread_names = names or ['Main Thread']
+        # start on the most recently used thread
+        st.session_state.current_thread = st.session_state.thread_names[0]
+    return st.session_state.thread_names
 
-    return response_json.get('response', "error occurred while processing your request.")
 
+def create_new_thread(thread_name):
+    if thread_name not in st.session_state.thread_names:
+        st.session_state.thread_names.insert(0, thread_name)
+        st.session_state.histories[thread_name] = {"messages": [], "before": None, "trimmed": False}
+    st.session_state.current_thread = thread_name
+
+
+def get_chat_history(user_name, thread_name):
+    """The loaded messages of the thread, its latest page is fetched on first view"""
+    if thread_name not in st.session_state.histories:
+        try:
+            page = get_client().get_history(user_name, thread_name, limit=HISTORY_PAGE_SIZE)
+        except ChatAPIError as e:
+            st.error(f"Could not load the messages of {thread_name}: {e}")
+            return {"messages": [], "before": None, "trimmed": False}
+        st.session_state.histories[thread_name] = {**page, "trimmed": False}
+    return st.session_state.histories[thread_name]
+
+
+def load_earlier_messages(user_name, thread_name):
+    history = st.session_state.histories[thread_name]
+    try:
+        page = get_client().get_history(user_name, thread_name, limit=HISTORY_PAGE_SIZE, before=history["before"])
+    except ChatAPIError as e:
+        history["error"] = f"Could not load the earlier messages: {e}"
+        return
+    history["messages"] = page["messages"] + history["messages"]
+    history["before"] = page["before"]
+    if len(history["messages"]) > HISTORY_WINDOW:
+        history["messages"] = history["messages"][:HISTORY_WINDOW]
+        history["trimmed"] = True
+
+
+def append_message(history, message):
+    """Add a new message to the window, the oldest ones beyond HISTORY_WINDOW are dropped and can be loaded again"""
+    history["messages"].append(message)
+    if len(history["messages"]) > HISTORY_WINDOW:
+        del history["messages"][:-HISTORY_WINDOW]
+        history["before"] = history["messages"][0].get("position")
+        # only the messages sent from this page are left, they have no position yet
+        history["reload"] = history["before"] is None
+
+
+def show_latest_messages(thread_name):
+    # fetched again when the history is rendered
+    st.session_state.histories.pop(thread_name, None)
+
+
+@st.fragment
+def chat_history(user_name, thread_name):
+    """The loaded window of the thread's messages, its buttons rerun only this fragment"""
+    history = get_chat_history(user_name, thread_name)
+    if history.get("error"):
+        st.error(history.pop("error"))
+
+    if history["before"] is not None:
+        st.button("Load earlier messages", on_click=load_earlier_messages, args=(user_name, thread_name))
+
+    for message in history["messages"]:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
+
+    if history["trimmed"]:
+        st.button("Show the latest messages", on_click=show_latest_messages, args=(thread_name,))
 
 
 def main(user_name):
@@ -40,7 +116,7 @@ def main(user_name):
     if 'user-name' not in st.session_state:
         st.session_state['user-name'] = user_name
 
-    
+    thread_names = load_threads(st.session_state['user-name'])
 
     # Sidebar for thread management
     with st.sidebar:
@@ -52,41 +128,48 @@ def main(user_name):
 
         # Thread selection
         st.header("Select Thread")
+        if st.session_state.current_thread not in thread_names:
+            thread_names.insert(0, st.session_state.current_thread)
         selected_thread = st.selectbox(
             "Choose a thread",
-            options=list(st.session_state.chat_threads.keys())
+            options=thread_names,
+            index=thread_names.index(st.session_state.current_thread)
         )
         if selected_thread != st.session_state.current_thread:
             st.session_state.current_thread = selected_thread
 
     # Display chat history
-    for message in get_chat_history():
-        if isinstance(message, HumanMessage):
-            with st.chat_message("user"):
-                st.write(message.content)
-        elif isinstance(message, AIMessage):
-            with st.chat_message("assistant"):
-                st.write(message.content)
+    chat_history(st.session_state['user-name'], selected_thread)
+    # loaded by the fragment, a failed load is fetched again on the next run
+    history = st.session_state.histories.get(selected_thread, {"messages": [], "before": None, "trimmed": False})
 
     # Chat input
     if prompt := st.chat_input("What's on your mind?"):
         # Add user message to chat history
-        st.session_state.chat_threads[st.session_state.current_thread].append(HumanMessage(content=prompt))
-        
+        append_message(history, {"role": "user", "content": prompt})
+
         # Display user message
         with st.chat_message("user"):
             st.write(prompt)
 
-        # Get AI response using the existing agent
-        response = my_agent_function(prompt,st.session_state['user-name'], selected_thread)
-        ai_message = AIMessage(content=response)
+        # Render the reply token by token as the service streams it
+        with st.chat_message("assistant"):
+            try:
+                response = st.write_stream(get_client().stream_tokens(prompt, st.session_state['user-name'], selected_thread))
+            except ChatAPIError as e:
+                response = "error occurred while processing your request."
+                st.error(str(e))
 
         # Add AI response to chat history
-        st.session_state.chat_threads[st.session_state.current_thread].append(ai_message)
-        
-        # Display AI response
-        with st.chat_message("assistant"):
-            st.write(response)
+        append_message(history, {"role": "assistant", "content": response})
+        if history["trimmed"] or history.get("reload"):
+            # an earlier window was on screen, or the new messages need their positions:
+            # show the latest messages from the service
+            st.session_state.histories.pop(selected_thread, None)
+
+        # the thread is now the most recently used one
+        thread_names.remove(selected_thread)
+        thread_names.insert(0, selected_thread)
 
 if __name__ == "__main__":
     user_name = sys.argv[1] if len(sys.argv) > 1 else "User"
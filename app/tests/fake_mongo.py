@@ -0,0 +1,207 @@
+"""
+In-memory stand-in for the MongoDB collections, enough of the query language for
+the store and the checkpoint pruner. `motor=True` gives motor's API, where
+`aggregate()` returns a cursor, otherwise pymongo's asyncio API, where it is a
+coroutine returning one.
+"""
+import copy
+import random
+import re
+from itertools import count
+from types import SimpleNamespace
+
+from pymongo import DeleteMany, DeleteOne, UpdateOne
+
+_ids = count()
+# seeds the order of the documents a find returns, different for every call
+_finds = count()
+
+
+def _get(doc, path):
+    for part in path.split("."):
+        if isinstance(doc, list) and part.isdigit():
+            doc = doc[int(part)] if int(part) < len(doc) else None
+        elif isinstance(doc, dict):
+            doc = doc.get(part)
+        else:
+            return None
+    return doc
+
+
+def _compare(value, condition) -> bool:
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$exists":
+                if (value is not None) != operand:
+                    return False
+            elif operator == "$regex":
+                candidates = value if isinstance(value, list) else [value]
+                if not any(isinstance(v, str) and re.search(operand, v) for v in candidates):
+                    return False
+            elif not _compare_operator(value, operator, operand):
+                return False
+        return True
+    # an array field matches a value equal to the array or to one of its elements
+    return value == condition or (isinstance(value, list) and condition in value)
+
+
+def _compare_operator(value, operator, operand) -> bool:
+    candidates = value if isinstance(value, list) else [value]
+    tests = {
+        "$in": lambda v: v in operand,
+        "$gt": lambda v: v is not None and v > operand,
+        "$gte": lambda v: v is not None and v >= operand,
+        "$lt": lambda v: v is not None and v < operand,
+        "$lte": lambda v: v is not None and v <= operand,
+        "$ne": lambda v: v != operand,
+    }
+    return any(tests[operator](v) for v in candidates)
+
+
+def matches(doc, query) -> bool:
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif not _compare(_get(doc, field), condition):
+            return False
+    return True
+
+
+def _sort(docs, keys):
+    for field, direction in reversed(list(keys)):
+        docs.sort(key=lambda doc: (_get(doc, field) is not None, _get(doc, field)), reverse=direction < 0)
+    return docs
+
+
+def _expression(doc, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(doc, expression[1:])
+    if isinstance(expression, dict) and "$arrayElemAt" in expression:
+        array, index = (_expression(doc, e) for e in expression["$arrayElemAt"])
+        return array[index] if -len(array) <= index < len(array) else None
+    if isinstance(expression, dict):
+        return {key: _expression(doc, e) for key, e in expression.items()}
+    return expression
+
+
+def aggregate(docs, pipeline):
+    docs = [copy.deepcopy(doc) for doc in docs]
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == "$sort":
+            docs = _sort(docs, spec.items())
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [{"_id": doc["_id"], **{field: _expression(doc, e) for field, e in spec.items()}} for doc in docs]
+            docs = [{k: v for k, v in doc.items() if v is not None} for doc in docs]
+        elif name == "$group":
+            groups = {}
+            for doc in docs:
+                key = _expression(doc, spec["_id"])
+                group = groups.setdefault(repr(key), {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (operator, e), = accumulator.items()
+                    value = _expression(doc, e)
+                    if operator == "$max":
+                        group[field] = value if field not in group else max(group[field], value)
+                    elif operator == "$push":
+                        group.setdefault(field, []).append(value)
+            # like MongoDB, the groups come out in no particular order
+            docs = list(reversed(list(groups.values())))
+        else:
+            raise NotImplementedError(name)
+    return docs
+
+
+class FakeCursor:
+    """An async cursor, also awaitable as a list with `to_list`"""
+
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=None):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        self._docs = _sort(self._docs, keys)
+        return self
+
+    def skip(self, n):
+        self._docs = self._docs[n:]
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n] if n else self._docs
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+    async def to_list(self, length=None):
+        return list(self._docs)
+
+
+class FakeCollection:
+    def __init__(self, docs=(), motor: bool = False):
+        self.docs = [{"_id": next(_ids), **doc} for doc in docs]
+        self.motor = motor
+        self.indexes = {}
+
+    def find(self, query=None, projection=None):
+        docs = [copy.deepcopy(doc) for doc in self.docs if matches(doc, query or {})]
+        # like MongoDB, the documents come in no particular order, nor do those tied on the sort
+        random.Random(next(_finds)).shuffle(docs)
+        return FakeCursor(docs)
+
+    def aggregate(self, pipeline):
+        cursor = FakeCursor(aggregate(self.docs, pipeline))
+        if self.motor:
+            return cursor
+
+        async def result():
+            return cursor
+        return result()
+
+    async def create_index(self, keys, **kwargs):
+        name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        self.indexes[name] = keys
+        return name
+
+    async def index_information(self):
+        return {name: {"key": keys} for name, keys in self.indexes.items()}
+
+    async def drop_index(self, name):
+        del self.indexes[name]
+
+    async def delete_many(self, query):
+        before = len(self.docs)
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+        return SimpleNamespace(deleted_count=before - len(self.docs))
+
+    async def bulk_write(self, requests, ordered=True):
+        deleted = 0
+        for request in requests:
+            query, document = request._filter, request._doc if hasattr(request, "_doc") else None
+            if isinstance(request, DeleteMany):
+                deleted += (await self.delete_many(query)).deleted_count
+            elif isinstance(request, DeleteOne):
+                doc = next((doc for doc in self.docs if matches(doc, query)), None)
+                if doc is not None:
+                    self.docs.remove(doc)
+                    deleted += 1
+            elif isinstance(request, UpdateOne):
+                doc = next((doc for doc in self.docs if matches(doc, query)), None)
+                if doc is None:
+                    doc = {"_id": next(_ids), **{k: v for k, v in query.items() if not k.startswith("$")}}
+                    self.docs.append(doc)
+                    doc.update(document.get("$setOnInsert", {}))
+                doc.update(document.get("$set", {}))
+        return SimpleNamespace(deleted_count=deleted)
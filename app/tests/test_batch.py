@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import httpx
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.memory import InMemoryStore
+
+from agents.cache import memory_cache, response_cache
+from agents.personal_assistant import create_agent_graph
+from benchmarks.fake_llm import ScriptedChatModel, install_fake_llm
+from benchmarks.scenarios import Turn
+from config.settings import settings
+from service.concurrency import RunCoordinator
+from service.service import app
+
+
+class FailingOn:
+    """The agent, except that the turns sending `message` fail"""
+
+    def __init__(self, agent, message: str):
+        self.agent = agent
+        self.store = agent.store
+        self.message = message
+
+    async def ainvoke(self, input, config):
+        if input["messages"].content == self.message:
+            raise RuntimeError("model unavailable")
+        return await self.agent.ainvoke(input, config=config)
+
+    async def aget_state(self, config):
+        return await self.agent.aget_state(config)
+
+
+def chat_request(thread_id: str, message: str) -> dict:
+    return {"message": message, "user_id": "al", "thread_id": thread_id}
+
+
+def post_batch(monkeypatch, requests: list[dict], stream: bool, turns: list[Turn], coordinator: RunCoordinator):
+    """Send a batch to the service, its agent answering from the scripted turns; returns the response and the agent"""
+    memory_cache.clear()
+    response_cache.clear()
+    agent = FailingOn(create_agent_graph(checkpointer=MemorySaver(), store=InMemoryStore()), "boom")
+    monkeypatch.setattr(app.state, "agent", agent, raising=False)
+    monkeypatch.setattr(app.state, "run_coordinator", coordinator, raising=False)
+    monkeypatch.setattr(app.state, "memory_queue", None, raising=False)
+
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            with install_fake_llm(ScriptedChatModel.from_turns(turns, latency=0.02)):
+                return await client.post("/chat/batch", json={"requests": requests, "stream": stream})
+
+    return asyncio.run(send()), agent
+
+
+def test_streamed_batch_runs_threads_in_order_and_reports_every_turn(monkeypatch):
+    monkeypatch.setattr(settings, "SERVICE_BATCH_CONCURRENCY", 2)
+    turns = [Turn(message=f"message {i}", reply=f"reply {i}") for i in range(5)]
+    requests = [chat_request("a", "message 0"), chat_request("b", "message 1"), chat_request("a", "boom"),
+                chat_request("a", "message 2"), chat_request("c", "message 3"), chat_request("b", "message 4")]
+
+    response, agent = post_batch(monkeypatch, requests, True, turns, RunCoordinator())
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    results = {result["index"]: result for result in map(json.loads, response.text.splitlines())}
+    assert sorted(results) == list(range(len(requests)))
+    assert results[2]["status"] == "error" and results[2]["detail"] == "model unavailable"
+    # the failed turn doesn't stop the next turns of its thread or the batch
+    replies = {i: results[i]["response"] for i in results if i != 2}
+    assert replies == {0: "reply 0", 1: "reply 1", 3: "reply 2", 4: "reply 3", 5: "reply 4"}
+
+    state = asyncio.run(agent.aget_state({"configurable": {"thread_id": "al_a", "user_id": "al"}}))
+    assert [message.content for message in state.values["messages"]] == ["message 0", "reply 0", "message 2", "reply 2"]
+
+
+def test_overloaded_turns_are_rejected_without_failing_the_batch(monkeypatch):
+    monkeypatch.setattr(settings, "SERVICE_BATCH_CONCURRENCY", 3)
+    turns = [Turn(message=f"message {i}", reply=f"reply {i}") for i in range(6)]
+    requests = [chat_request(thread_id, f"message {i}") for i, thread_id in enumerate("abcabc")]
+
+    # one turn runs and one waits, the third thread is turned away
+    response, _ = post_batch(monkeypatch, requests, False, turns, RunCoordinator(max_concurrent=1, max_queued=1))
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == list(range(len(requests)))
+    assert {result["status"] for result in results} == {"success", "rejected"}
+    for result in results:
+        if result["status"] == "success":
+            assert result["response"] == f"reply {result['index']}"
+        else:
+            assert "Too many requests" in result["detail"]
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.memory import InMemoryStore
+from prometheus_client import REGISTRY
+
+from agents.cache import MemorySnapshot, MemorySnapshotCache, ResponseCache, memory_cache, response_cache
+from agents.personal_assistant import create_agent_graph
+from benchmarks.fake_llm import ScriptedChatModel, install_fake_llm
+from benchmarks.scenarios import Turn
+
+APP_DIR = Path(__file__).resolve().parents[1]
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def snapshot() -> MemorySnapshot:
+    return MemorySnapshot(user_profile=None, todos=[], instructions="")
+
+
+def test_memory_cache_exports_hits_misses_and_evictions():
+    cache = MemorySnapshotCache(max_size=1, ttl=60)
+    hits = sample("assistant_memory_cache_requests_total", result="hit")
+    misses = sample("assistant_memory_cache_requests_total", result="miss")
+    evicted = sample("assistant_memory_cache_evictions_total", reason="size")
+    invalidated = sample("assistant_memory_cache_evictions_total", reason="invalidated")
+
+    assert cache.get("alice") is None
+    cache.set("alice", snapshot())
+    assert cache.get("alice") is not None
+    cache.set("bob", snapshot())
+    cache.invalidate("bob")
+
+    assert sample("assistant_memory_cache_requests_total", result="hit") == hits + 1
+    assert sample("assistant_memory_cache_requests_total", result="miss") == misses + 1
+    assert sample("assistant_memory_cache_evictions_total", reason="size") == evicted + 1
+    assert sample("assistant_memory_cache_evictions_total", reason="invalidated") == invalidated + 1
+    assert sample("assistant_memory_cache_size") == 0
+    assert cache.stats()["hits"] == 1
+
+
+def test_memory_cache_drops_expired_snapshots():
+    cache = MemorySnapshotCache(max_size=10, ttl=-1)
+    expired = sample("assistant_memory_cache_evictions_total", reason="expired")
+    cache.set("alice", snapshot())
+    assert cache.get("alice") is None
+    assert sample("assistant_memory_cache_evictions_total", reason="expired") == expired + 1
+
+
+def test_response_key_changes_with_the_prompt_and_the_end_of_the_thread():
+    cache = ResponseCache(max_size=10, tail_messages=2)
+    history = [HumanMessage("hi"), AIMessage("Hello!"), HumanMessage("add milk"), AIMessage("Added.")]
+    key = cache.make_key("profile: Al", history, "What's on my list?")
+
+    assert cache.make_key("profile: Al", history, "what's on  my list") == key
+    assert cache.make_key("profile: Bo", history, "What's on my list?") != key
+    assert cache.make_key("profile: Al", history[:-1] + [AIMessage("Done.")], "What's on my list?") != key
+    # messages older than the tail don't change the reply
+    assert cache.make_key("profile: Al", [HumanMessage("hello")] + history[1:], "What's on my list?") == key
+
+
+def test_update_nodes_drop_the_users_cached_replies(monkeypatch):
+    monkeypatch.setattr(response_cache, "max_size", 10)
+    memory_cache.clear()
+    response_cache.clear()
+    response_cache.set("al", "key", "You have nothing on your list.")
+    response_cache.set("bo", "key", "You have nothing on your list.")
+    turn = Turn(message="Remind me to buy milk", updates=["todo"], todos=["buy milk"])
+
+    async def run():
+        agent = create_agent_graph(checkpointer=MemorySaver(), store=InMemoryStore())
+        config = {"configurable": {"thread_id": "al_main", "user_id": "al"}}
+        with install_fake_llm(ScriptedChatModel.from_turns([turn])):
+            await agent.ainvoke({"messages": [HumanMessage(turn.message)]}, config=config)
+
+    asyncio.run(run())
+
+    assert response_cache.get("al", "key") is None
+    assert response_cache.get("bo", "key") is not None
+    # the snapshot loaded before the update was dropped, the reply after it read the new task
+    assert [todo["task"] for todo in memory_cache.get("al").todos] == ["buy milk"]
+    response_cache.clear()
+
+
+def cache_sizes(**env: str) -> str:
+    env = {**os.environ, "MEMORY_CACHE_MAX_SIZE": "10", "RESPONSE_CACHE_MAX_SIZE": "10", **env}
+    code = "from agents.cache import memory_cache, response_cache; print(memory_cache.max_size, response_cache.max_size)"
+    return subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=env,
+                          capture_output=True, text=True, check=True).stdout.strip()
+
+
+def test_caches_are_off_with_several_workers():
+    assert cache_sizes(SERVICE_WORKERS="2", DEV="false") == "0 0"
+    assert cache_sizes(SERVICE_WORKERS="1", DEV="false") == "10 10"
+    # the dev server runs a single process whatever SERVICE_WORKERS says
+    assert cache_sizes(SERVICE_WORKERS="2", DEV="true") == "10 10"
@@ -0,0 +1,44 @@
+import httpx
+import pytest
+
+from client import ChatAPIError, ChatClient
+
+
+def client_with(statuses: list[int]) -> tuple[ChatClient, list[str]]:
+    """A client whose requests get the given statuses in turn, and the paths it requested"""
+    requested = []
+    responses = iter(statuses)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(request.url.path)
+        status = next(responses)
+        if request.url.path == "/chat":
+            body = {"response": "hi", "thread_id": "t", "user_id": "u", "status": "success"}
+        else:
+            body = {"threads": [], "next_offset": None}
+        return httpx.Response(status, json=body if status == 200 else {"detail": "unavailable"})
+
+    client = ChatClient(base_url="http://test", max_retries=3, backoff=0)
+    client._client = httpx.Client(transport=httpx.MockTransport(handler), base_url="http://test")
+    return client, requested
+
+
+def test_chat_is_retried_on_admission_rejections():
+    client, requested = client_with([429, 503, 200])
+    assert client.chat("hello", "u", "t")["response"] == "hi"
+    assert requested == ["/chat"] * 3
+
+
+@pytest.mark.parametrize("status", [502, 504])
+def test_chat_is_not_retried_on_gateway_errors(status):
+    # the turn and its memory updates may have run behind the gateway
+    client, requested = client_with([status, 200])
+    with pytest.raises(ChatAPIError):
+        client.chat("hello", "u", "t")
+    assert requested == ["/chat"]
+
+
+def test_reads_are_retried_on_gateway_errors():
+    client, requested = client_with([502, 504, 200])
+    assert client.list_threads("u") == {"threads": [], "next_offset": None}
+    assert requested == ["/threads/u"] * 3
@@ -0,0 +1,199 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from service.concurrency import RunCoordinator, ServiceOverloaded, run_grouped
+
+
+def test_stream_run_finishes_when_the_consumer_goes_away():
+    finished = []
+
+    async def run():
+        coordinator = RunCoordinator()
+        release = asyncio.Event()
+
+        async def turn(emit):
+            emit("token")
+            await release.wait()
+            emit("late token")
+            finished.append(True)
+
+        events = coordinator.stream("t", turn)
+        assert await anext(events) == "token"
+        # the client disconnects mid-turn
+        await events.aclose()
+        release.set()
+        await coordinator.drain()
+        assert not coordinator._tasks
+
+    asyncio.run(run())
+    assert finished == [True]
+
+
+def test_stream_raises_the_error_of_the_run_after_its_events():
+    async def run():
+        async def turn(emit):
+            emit("token")
+            raise RuntimeError("model unavailable")
+
+        received = []
+        try:
+            async for event in RunCoordinator().stream("t", turn):
+                received.append(event)
+        except RuntimeError as e:
+            return received, str(e)
+
+    assert asyncio.run(run()) == (["token"], "model unavailable")
+
+
+async def settle():
+    """Let the tasks started so far run until they block"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def assert_idle(coordinator: RunCoordinator):
+    assert (coordinator.queued, coordinator.running) == (0, 0)
+    assert not coordinator._thread_locks and not coordinator._thread_requests and not coordinator._inflight
+
+
+def test_runs_of_a_thread_are_serialized_and_threads_overlap():
+    log = []
+
+    async def run():
+        coordinator = RunCoordinator()
+
+        def turn(name: str):
+            async def run_turn():
+                log.append(f"start {name}")
+                await asyncio.sleep(0.01)
+                log.append(f"end {name}")
+                return name
+            return run_turn
+
+        results = await asyncio.gather(coordinator.run("t1", "first", turn("t1 first")),
+                                       coordinator.run("t1", "second", turn("t1 second")),
+                                       coordinator.run("t2", "first", turn("t2 first")))
+        assert_idle(coordinator)
+        return results
+
+    assert asyncio.run(run()) == ["t1 first", "t1 second", "t2 first"]
+    # the second run of t1 waits for the first, t2 runs alongside it
+    assert log.index("end t1 first") < log.index("start t1 second")
+    assert log.index("start t2 first") < log.index("end t1 first")
+
+
+def test_identical_requests_in_flight_share_one_run():
+    calls = []
+
+    async def run():
+        coordinator = RunCoordinator()
+
+        async def run_turn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        first = asyncio.create_task(coordinator.run("t", ("hello", False), run_turn))
+        await asyncio.sleep(0)
+        results = await asyncio.gather(first, coordinator.run("t", ("hello", False), run_turn))
+        # once done, the same request runs again
+        results.append(await coordinator.run("t", ("hello", False), run_turn))
+        assert_idle(coordinator)
+        return results
+
+    coalesced = REGISTRY.get_sample_value("assistant_requests_coalesced_total") or 0.0
+    assert asyncio.run(run()) == [1, 1, 2]
+    assert REGISTRY.get_sample_value("assistant_requests_coalesced_total") - coalesced == 1
+
+
+def test_requests_beyond_the_queue_are_rejected():
+    async def run():
+        coordinator = RunCoordinator(max_concurrent=1, max_queued=1)
+        release = asyncio.Event()
+
+        async def run_turn():
+            await release.wait()
+            return "done"
+
+        running = asyncio.create_task(coordinator.run("t1", "a", run_turn))
+        queued = asyncio.create_task(coordinator.run("t2", "b", run_turn))
+        await settle()
+        assert (coordinator.running, coordinator.queued) == (1, 1)
+        with pytest.raises(ServiceOverloaded):
+            await coordinator.run("t3", "c", run_turn)
+        with pytest.raises(ServiceOverloaded):
+            coordinator.check_admission()
+
+        release.set()
+        results = await asyncio.gather(running, queued)
+        assert_idle(coordinator)
+        return results
+
+    rejected = REGISTRY.get_sample_value("assistant_requests_rejected_total") or 0.0
+    assert asyncio.run(run()) == ["done", "done"]
+    assert REGISTRY.get_sample_value("assistant_requests_rejected_total") - rejected == 2
+
+
+def test_a_request_cancelled_while_queued_leaves_no_state_behind():
+    async def run():
+        coordinator = RunCoordinator()
+        release = asyncio.Event()
+
+        async def hold():
+            async with coordinator.slot("t"):
+                await release.wait()
+
+        async def wait_for_turn():
+            async with coordinator.slot("t"):
+                pass
+
+        holder = asyncio.create_task(hold())
+        waiter = asyncio.create_task(wait_for_turn())
+        await settle()
+        assert coordinator.queued == 1
+        waiter.cancel()
+        await settle()
+        assert coordinator.queued == 0
+        release.set()
+        await holder
+        assert_idle(coordinator)
+
+    asyncio.run(run())
+
+
+def test_grouped_runs_keep_the_order_of_a_key_and_overlap_up_to_the_bound():
+    items = [("a", 0), ("b", 0), ("a", 1), ("c", 0), ("a", 2), ("b", 1), ("d", 0), ("c", 1)]
+    running = []
+    overlaps = []
+    peak = 0
+    started = []
+
+    async def run(item):
+        nonlocal peak
+        overlaps.extend(other for other in running if other[0] == item[0])
+        running.append(item)
+        peak = max(peak, len(running))
+        started.append(item)
+        await asyncio.sleep(0.01)
+        running.remove(item)
+        if item == ("b", 0):
+            raise RuntimeError("model unavailable")
+        if item == ("c", 0):
+            raise ServiceOverloaded("busy")
+        return f"{item[0]}{item[1]}"
+
+    async def collect():
+        return [result async for result in run_grouped(items, key=lambda item: item[0], run=run, concurrency=3)]
+
+    results = asyncio.run(collect())
+
+    assert sorted(position for position, _ in results) == list(range(len(items)))
+    assert overlaps == [] and peak == 3
+    for key in "abcd":
+        assert [item for item in started if item[0] == key] == [item for item in items if item[0] == key]
+    outcomes = dict(results)
+    assert isinstance(outcomes[1], RuntimeError) and isinstance(outcomes[3], ServiceOverloaded)
+    # the failed items don't stop the rest of their group or the batch
+    assert [outcomes[i] for i in (0, 2, 4, 5, 6, 7)] == ["a0", "a1", "a2", "b1", "d0", "c1"]
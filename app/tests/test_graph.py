@@ -0,0 +1,53 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END
+from langgraph.store.memory import InMemoryStore
+
+from agents.cache import memory_cache, response_cache
+from agents.personal_assistant import create_agent_graph, route_message
+from benchmarks.fake_llm import ScriptedChatModel, install_fake_llm
+from benchmarks.graph_benchmark import NodeTimer
+from benchmarks.scenarios import Turn
+
+
+def update_request(*update_types: str) -> AIMessage:
+    return AIMessage(content="", tool_calls=[{"name": "UpdateMemory", "args": {"update_type": update_type}, "id": f"c{i}"}
+                                             for i, update_type in enumerate(update_types)])
+
+
+def test_route_message_fans_out_to_each_requested_node_once():
+    state = {"messages": [HumanMessage("hi"), update_request("todo", "user", "todo")]}
+    assert route_message(state, {}, None) == ["update_todos", "update_profile"]
+    assert route_message({"messages": [AIMessage("Hello")]}, {}, None) == END
+
+
+def test_graph_draws_the_memory_update_branches():
+    graph = create_agent_graph(checkpointer=None, store=None).get_graph()
+    branches = {edge.target for edge in graph.edges if edge.source == "task_assistant" and edge.conditional}
+    assert branches == {"__end__", "update_todos", "update_profile", "update_instructions"}
+
+
+def test_parallel_updates_run_each_node_once_and_answer_every_tool_call():
+    memory_cache.clear()
+    response_cache.clear()
+    turn = Turn(message="I'm Al, remind me to buy milk and call the bank",
+                updates=["todo", "user", "todo"], profile={"name": "Al"}, todos=["buy milk"])
+    timer = NodeTimer()
+
+    async def run():
+        agent = create_agent_graph(checkpointer=MemorySaver(), store=InMemoryStore())
+        config = {"configurable": {"thread_id": "al_main", "user_id": "al"}, "callbacks": [timer]}
+        with install_fake_llm(ScriptedChatModel.from_turns([turn])):
+            return await agent.ainvoke({"messages": [HumanMessage(turn.message)]}, config=config)
+
+    messages = asyncio.run(run())["messages"]
+
+    request = messages[1]
+    assert [call["args"]["update_type"] for call in request.tool_calls] == ["todo", "user", "todo"]
+    answered = {message.tool_call_id for message in messages if isinstance(message, ToolMessage)}
+    assert answered == {call["id"] for call in request.tool_calls}
+    assert {node: len(runs) for node, runs in timer.latencies.items()} == {
+        "task_assistant": 2, "update_todos": 1, "update_profile": 1,
+    }
@@ -0,0 +1,80 @@
+import asyncio
+
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.memory import InMemoryStore
+
+from agents.cache import memory_cache, response_cache
+import agents.personal_assistant as personal_assistant
+from agents.personal_assistant import create_agent_graph
+from benchmarks.fake_llm import ScriptedChatModel, install_fake_llm
+from benchmarks.scenarios import Turn
+from config.settings import settings
+from service.history import history_page
+
+
+class TranscriptReads(InMemoryStore):
+    """Store recording the keys of the transcript chunks that are read"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks_read = []
+
+    async def aget(self, namespace, key, **kwargs):
+        if namespace[0] == "transcripts":
+            self.chunks_read.append(key)
+        return await super().aget(namespace, key, **kwargs)
+
+
+def test_history_pages_through_summarized_turns(monkeypatch):
+    monkeypatch.setattr(settings, "SUMMARY_MAX_MESSAGES", 6)
+    monkeypatch.setattr(settings, "SUMMARY_MAX_TOKENS", 0)
+    monkeypatch.setattr(settings, "SUMMARY_KEEP_TURNS", 1)
+    # small chunks, so the summaries fill them over several saves
+    monkeypatch.setattr(personal_assistant, "TRANSCRIPT_CHUNK_SIZE", 5)
+    memory_cache.clear()
+    response_cache.clear()
+    turns = [Turn(message=f"message {i}", reply=f"reply {i}") for i in range(12)]
+    expected = [content for turn in turns for content in (turn.message, turn.reply)]
+
+    async def run():
+        store = TranscriptReads()
+        chunks_read = []
+        agent = create_agent_graph(checkpointer=MemorySaver(), store=store)
+        config = {"configurable": {"thread_id": "alice_main", "user_id": "alice"}}
+
+        async def page(before=None):
+            state = await agent.aget_state(config)
+            read = len(store.chunks_read)
+            result = await history_page(store, "alice", "alice_main", state.values, 3, before)
+            chunks_read.append(store.chunks_read[read:])
+            return result
+
+        async def play(turns):
+            for turn in turns:
+                await agent.ainvoke({"messages": [HumanMessage(turn.message)]}, config=config)
+
+        with install_fake_llm(ScriptedChatModel.from_turns(turns)):
+            await play(turns[:8])
+            first = await page()
+            # more turns get summarized while the user is reading, the cursor still points at the same message
+            await play(turns[8:])
+            state = await agent.aget_state(config)
+            assert len(state.values["messages"]) < 2 * len(turns)
+
+            pages = [first]
+            while pages[-1].before is not None:
+                pages.append(await page(pages[-1].before))
+            stored = await store.asearch(("transcripts", "alice", "alice_main"), limit=100)
+        return first, pages, chunks_read, [item.key for item in stored]
+
+    first, pages, chunks_read, chunks = asyncio.run(run())
+    assert [message.content for message in first.messages] == expected[13:16]
+    # the latest page is in the state, each older one reads at most the two chunks it spans
+    assert chunks_read[0] == []
+    assert all(len(keys) <= 2 for keys in chunks_read)
+    # and none of the chunks after it: the latest chunk was saved after the first page
+    assert len(chunks) > 3
+    assert all(key < max(chunks) for keys in chunks_read for key in keys)
+    history = [message.content for page in reversed(pages) for message in page.messages]
+    assert history == expected[:16]
@@ -0,0 +1,97 @@
+import httpx
+import pytest
+from groq import Groq
+from langchain_core.language_models import FakeListChatModel
+from prometheus_client import REGISTRY
+
+import core.llm as llm
+from config.settings import settings
+from core.llm import Provider, count_retry, create_chat_model, get_chat_model, register_provider, with_fallbacks
+
+
+class Throttled(Exception):
+    """Stands in for a provider's rate limit error"""
+
+
+class ThrottledModel(FakeListChatModel):
+    def _call(self, *args, **kwargs):
+        raise Throttled("rate limited")
+
+
+@pytest.fixture
+def fake_provider(monkeypatch):
+    """A `fake` provider whose `throttled` model always raises Throttled, and the models created so far"""
+    created = []
+
+    def create(model_name):
+        model = (ThrottledModel if model_name == "throttled" else FakeListChatModel)(responses=[f"{model_name} says hi"])
+        created.append(model_name)
+        return model
+
+    monkeypatch.setattr(llm, "PROVIDERS", dict(llm.PROVIDERS))
+    register_provider("fake", Provider(create, lambda: (Throttled,)))
+    get_chat_model.cache_clear()
+    llm.get_fallback_models.cache_clear()
+    yield created
+    get_chat_model.cache_clear()
+    llm.get_fallback_models.cache_clear()
+
+
+def test_models_are_created_from_their_provider_spec(fake_provider):
+    assert create_chat_model("fake:small").invoke("hello").content == "small says hi"
+    with pytest.raises(ValueError):
+        create_chat_model("unknown:model")
+    with pytest.raises(ValueError):
+        create_chat_model("fake")
+
+
+def test_extraction_uses_the_assistant_model_unless_set(fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_ASSISTANT_MODEL", "fake:large")
+    monkeypatch.setattr(settings, "LLM_EXTRACTION_MODEL", "")
+    assert get_chat_model("extraction").invoke("hello").content == "large says hi"
+    # created once per role
+    assert get_chat_model("extraction") is get_chat_model("extraction")
+
+    monkeypatch.setattr(settings, "LLM_EXTRACTION_MODEL", "fake:small")
+    get_chat_model.cache_clear()
+    assert get_chat_model("extraction").invoke("hello").content == "small says hi"
+    assert get_chat_model("assistant").invoke("hello").content == "large says hi"
+
+
+def test_fallback_models_take_over_on_provider_errors_only(fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_ASSISTANT_MODEL", "fake:throttled")
+    monkeypatch.setattr(settings, "LLM_EXTRACTION_MODEL", "")
+    monkeypatch.setattr(settings, "LLM_FALLBACK_MODELS", ["fake:throttled", "fake:backup"])
+
+    model = with_fallbacks(get_chat_model("assistant"))
+    assert model.invoke("hello").content == "backup says hi"
+
+    # an error that is not a provider error is raised, not hidden by the fallbacks
+    with pytest.raises(IndexError):
+        with_fallbacks(FakeListChatModel(responses=[])).invoke("hello")
+
+
+def retried_requests() -> float:
+    return REGISTRY.get_sample_value("assistant_llm_retries_total", {"host": "api.groq.com"}) or 0.0
+
+
+def test_retries_of_the_provider_sdk_are_counted():
+    statuses = iter([429, 503, 200])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        status = next(statuses)
+        if status != 200:
+            return httpx.Response(status, headers={"retry-after-ms": "1"}, json={"error": {"message": "busy"}})
+        return httpx.Response(200, json={
+            "id": "1", "object": "chat.completion", "created": 0, "model": "m",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}],
+        })
+
+    http_client = httpx.Client(transport=httpx.MockTransport(handler), event_hooks={"request": [count_retry]})
+    client = Groq(api_key="test", http_client=http_client, max_retries=2)
+    before = retried_requests()
+
+    reply = client.chat.completions.create(model="m", messages=[{"role": "user", "content": "hello"}])
+
+    assert reply.choices[0].message.content == "hi"
+    assert retried_requests() - before == 2
@@ -0,0 +1,71 @@
+import asyncio
+
+from langgraph.store.base import PutOp
+
+from agents.utilities import asearch_all
+from memory.mongodb_store import SEARCH_INDEX_WITHOUT_TIEBREAKER, AsyncMongoDBStore
+from tests.fake_mongo import FakeCollection
+
+
+def run_with_store(scenario, docs=()):
+    async def run():
+        store = AsyncMongoDBStore(FakeCollection(docs))
+        return await scenario(store)
+    return asyncio.run(run())
+
+
+def test_separator_in_namespace_parts_does_not_collide():
+    async def scenario(store):
+        await store.aput(("a/b",), "slash", {"v": 1})
+        await store.aput(("a", "b"), "nested", {"v": 2})
+        await store.aput(("ab", "c"), "other", {"v": 3})
+        return ([item.key for item in await store.asearch(("a/b",))],
+                [item.key for item in await store.asearch(("a", "b"))],
+                [item.key for item in await store.asearch(("a",))],
+                await store.alist_namespaces(prefix=("a",)))
+
+    slash, nested, prefix_a, namespaces = run_with_store(scenario)
+    assert slash == ["slash"]
+    assert nested == ["nested"]
+    assert prefix_a == ["nested"]
+    assert namespaces == [("a", "b")]
+
+
+def test_setup_rewrites_prefixes_of_namespaces_containing_the_separator():
+    old = [
+        {"namespace": ["a/b"], "key": "k", "value": {}, "namespace_prefix": ["a/b"]},
+        {"namespace": ["todo", "alice"], "key": "k", "value": {}},
+    ]
+
+    async def scenario(store):
+        await store.setup()
+        return {tuple(doc["namespace"]): doc["namespace_prefix"] for doc in store.collection.docs}
+
+    assert run_with_store(scenario, old) == {("a/b",): ["a\\/b"], ("todo", "alice"): ["todo", "todo/alice"]}
+
+
+def test_search_ignores_the_query():
+    async def scenario(store):
+        await store.aput(("todo", "alice"), "1", {"task": "climb"})
+        return [item.key for item in await store.asearch(("todo", "alice"), query="climbing")]
+
+    assert run_with_store(scenario) == ["1"]
+
+
+def test_paging_a_namespace_written_in_one_batch_reads_every_item_once():
+    async def scenario(store):
+        # the puts of one batch share their updated_at
+        await store.abatch([PutOp(("todo", "alice"), str(i), {"task": i}) for i in range(250)])
+        return [item.key for item in await asearch_all(store, ("todo", "alice"), page_size=100)]
+
+    keys = run_with_store(scenario)
+    assert sorted(keys, key=int) == [str(i) for i in range(250)]
+
+
+def test_setup_replaces_the_search_index_without_tiebreaker():
+    async def scenario(store):
+        store.collection.indexes[SEARCH_INDEX_WITHOUT_TIEBREAKER] = [("namespace_prefix", 1), ("updated_at", -1)]
+        await store.setup()
+        return sorted(store.collection.indexes)
+
+    assert run_with_store(scenario) == ["namespace_1_key_1", "namespace_prefix_1_updated_at_-1__id_1"]
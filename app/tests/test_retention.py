@@ -0,0 +1,138 @@
+import asyncio
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from memory.mongodb import MongoCheckpointPruner
+from memory.postgres import PostgresCheckpointPruner
+from memory.retention import RetentionPolicy, checkpoint_id_at, prune_checkpoints
+from tests.fake_mongo import FakeCollection
+
+NOW = datetime.now(timezone.utc)
+POLICY = RetentionPolicy(keep_last=2, max_idle=timedelta(days=30), grace=timedelta(minutes=5), batch_size=2)
+
+
+def saved_checkpoints() -> list[dict]:
+    """Four checkpoints for each of five active threads, two for an idle one and one for a running one"""
+    checkpoints = []
+    for thread in range(5):
+        for hours in (4, 3, 2, 1):
+            checkpoints.append({"thread_id": f"t{thread}", "checkpoint_ns": "",
+                                "checkpoint_id": checkpoint_id_at(NOW - timedelta(hours=hours, minutes=thread))})
+    for days in (60, 59):
+        checkpoints.append({"thread_id": "t5", "checkpoint_ns": "", "checkpoint_id": checkpoint_id_at(NOW - timedelta(days=days))})
+    # saved within the grace period, a run may still be writing to it
+    for seconds in (90, 30, 10):
+        checkpoints.append({"thread_id": "t6", "checkpoint_ns": "", "checkpoint_id": checkpoint_id_at(NOW - timedelta(seconds=seconds))})
+    return checkpoints
+
+
+def kept_checkpoints() -> dict[str, list[str]]:
+    kept = {}
+    for checkpoint in saved_checkpoints():
+        kept.setdefault(checkpoint["thread_id"], []).append(checkpoint["checkpoint_id"])
+    del kept["t5"]
+    return {thread_id: ids if thread_id == "t6" else ids[-2:] for thread_id, ids in kept.items()}
+
+
+def by_thread(rows) -> dict[str, list[str]]:
+    threads = {}
+    for row in sorted(rows, key=lambda row: (row["thread_id"], row["checkpoint_id"])):
+        threads.setdefault(row["thread_id"], []).append(row["checkpoint_id"])
+    return threads
+
+
+def test_mongo_pruner_walks_every_thread_with_motor_cursors():
+    checkpoints = saved_checkpoints()
+    checkpoints_collection = FakeCollection(checkpoints, motor=True)
+    writes_collection = FakeCollection([{**checkpoint, "task_id": "task", "idx": 0} for checkpoint in checkpoints], motor=True)
+    saver = SimpleNamespace(checkpoint_collection=checkpoints_collection, writes_collection=writes_collection)
+
+    result = asyncio.run(prune_checkpoints(MongoCheckpointPruner(saver), POLICY))
+
+    assert result.threads == 7
+    assert result.dropped_threads == 1
+    assert result.rows == {"checkpoints": 2 + 5 * 2, "checkpoint_writes": 2 + 5 * 2}
+    assert by_thread(checkpoints_collection.docs) == kept_checkpoints()
+    assert by_thread(writes_collection.docs) == kept_checkpoints()
+
+
+@pytest.fixture
+def postgres_url() -> str:
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    return url
+
+
+async def postgres_saver(url: str, schema: str):
+    """A saver on its own schema of the test database, with its tables created"""
+    async with await AsyncConnection.connect(url, autocommit=True) as conn:
+        await conn.execute(f"CREATE SCHEMA {schema}")
+    pool = AsyncConnectionPool(url, open=False, kwargs={"autocommit": True, "row_factory": dict_row,
+                                                        "options": f"-c search_path={schema}"})
+    await pool.open()
+    saver = AsyncPostgresSaver(pool)
+    await saver.setup()
+    return saver
+
+
+async def save(saver: AsyncPostgresSaver, checkpoints: list[dict]):
+    """Save every checkpoint with a channel value of its own and a pending write, as the graph does"""
+    for saved in checkpoints:
+        checkpoint = empty_checkpoint()
+        checkpoint["id"] = saved["checkpoint_id"]
+        checkpoint["channel_values"] = {"messages": [saved["checkpoint_id"]]}
+        checkpoint["channel_versions"] = {"messages": saved["checkpoint_id"]}
+        config = {"configurable": {"thread_id": saved["thread_id"], "checkpoint_ns": ""}}
+        config = await saver.aput(config, checkpoint, {}, {"messages": saved["checkpoint_id"]})
+        await saver.aput_writes(config, [("messages", ["pending"])], "task")
+
+
+async def rows(saver: AsyncPostgresSaver, sql: str) -> list[dict]:
+    async with saver.conn.connection() as conn:
+        cursor = await conn.execute(sql)
+        return await cursor.fetchall()
+
+
+def test_postgres_pruner_walks_every_thread(postgres_url):
+    schema = f"retention_test_{uuid.uuid4().hex}"
+
+    async def run():
+        saver = await postgres_saver(postgres_url, schema)
+        try:
+            await save(saver, saved_checkpoints())
+            pruner = PostgresCheckpointPruner(saver)
+
+            @asynccontextmanager
+            async def exclusive():
+                yield True
+            pruner.exclusive = exclusive
+
+            result = await prune_checkpoints(pruner, POLICY)
+            return (result,
+                    await rows(saver, "SELECT thread_id, checkpoint_id FROM checkpoints"),
+                    await rows(saver, "SELECT thread_id, checkpoint_id FROM checkpoint_writes"),
+                    await rows(saver, "SELECT version FROM checkpoint_blobs"))
+        finally:
+            await saver.conn.close()
+            async with await AsyncConnection.connect(postgres_url, autocommit=True) as conn:
+                await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+    result, checkpoints, writes, blobs = asyncio.run(run())
+
+    assert result.threads == 7
+    assert result.dropped_threads == 1
+    assert result.rows == {"checkpoints": 2 + 5 * 2, "checkpoint_writes": 2 + 5 * 2, "checkpoint_blobs": 2 + 5 * 2}
+    assert by_thread(checkpoints) == kept_checkpoints()
+    assert by_thread(writes) == kept_checkpoints()
+    assert sorted(blob["version"] for blob in blobs) == sorted(sum(kept_checkpoints().values(), []))
@@ -0,0 +1,6 @@
+from benchmarks.startup_benchmark import run_benchmark
+
+
+def test_service_starts_without_the_lazy_modules():
+    report = run_benchmark(runs=1, top=0)
+    assert report["lazy_modules_imported"] == []
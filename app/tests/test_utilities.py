@@ -0,0 +1,101 @@
+import asyncio
+
+from datetime import datetime, timezone
+
+from langchain_core.messages import HumanMessage
+from langgraph.store.base import Item, SearchItem
+from langgraph.store.memory import InMemoryStore
+
+from agents.tools import ToDo
+from agents.utilities import ToolCallCollector, _by_score, asearch_relevant, changed_memory_ops, create_todo_extractor, extract_tool_info
+from config.settings import settings
+from memory.embeddings import hashing_embed
+from benchmarks.fake_llm import ScriptedChatModel
+from benchmarks.scenarios import Turn
+
+
+def test_tool_call_collector_only_sees_its_own_extractor_run():
+    turns = [Turn(message="Buy milk", todos=["buy milk"]), Turn(message="Call the bank", todos=["call the bank"])]
+    # the extractor runs take turns at the model, so their callbacks interleave
+    extractor = create_todo_extractor(ScriptedChatModel.from_turns(turns, latency=0.01))
+
+    async def extract(turn: Turn) -> ToolCallCollector:
+        collector = ToolCallCollector()
+        await extractor.ainvoke({"messages": [HumanMessage(turn.message)], "existing": None},
+                                config={"callbacks": [collector]})
+        return collector
+
+    async def run():
+        return await asyncio.gather(*(extract(turn) for turn in turns))
+
+    milk, bank = asyncio.run(run())
+    assert [call["args"]["task"] for calls in milk.called_tools for call in calls] == ["buy milk"]
+    assert [call["args"]["task"] for calls in bank.called_tools for call in calls] == ["call the bank"]
+    assert "buy milk" in extract_tool_info(milk.called_tools, "ToDo")
+    assert "buy milk" not in extract_tool_info(bank.called_tools, "ToDo")
+
+
+def stored_todo(key: str, task: str) -> Item:
+    now = datetime.now(timezone.utc)
+    return Item(namespace=("todo", "alice"), key=key, value=ToDo(task=task, time_to_complete="30").model_dump(mode="json"),
+                created_at=now, updated_at=now)
+
+
+def test_changed_memory_ops_keeps_patches_and_skips_unchanged_and_repeated_inserts():
+    existing = [stored_todo("a", "buy milk"), stored_todo("b", "buy oat milk"), stored_todo("c", "call the bank")]
+    result = {
+        "responses": [
+            # two existing ToDos patched to the same value
+            ToDo(task="buy groceries", time_to_complete="30"),
+            ToDo(task="buy groceries", time_to_complete="30"),
+            # unchanged
+            ToDo(task="call the bank", time_to_complete="30"),
+            # the same new ToDo inserted twice
+            ToDo(task="book the dentist", time_to_complete="30"),
+            ToDo(task="book the dentist", time_to_complete="30"),
+        ],
+        "response_metadata": [{"id": "1", "json_doc_id": "a"}, {"id": "2", "json_doc_id": "b"},
+                              {"id": "3", "json_doc_id": "c"}, {"id": "4"}, {"id": "5"}],
+    }
+
+    ops = changed_memory_ops(("todo", "alice"), result, existing)
+
+    assert [(op.key, op.value["task"]) for op in ops[:2]] == [("a", "buy groceries"), ("b", "buy groceries")]
+    assert [op.value["task"] for op in ops[2:]] == ["book the dentist"]
+    assert ops[2].key not in {"a", "b", "c"}
+
+
+def test_relevant_search_merges_the_statuses_by_score():
+    store = InMemoryStore(index={"dims": settings.MEMORY_INDEX_DIMS, "embed": hashing_embed, "fields": ["task"]})
+    todos = {
+        "1": ("buy milk and bread", "not started"),
+        "2": ("buy milk for the party", "in progress"),
+        "3": ("call the bank about the loan", "not started"),
+        "4": ("buy milk", "done"),
+        "5": ("book a flight to Rome", "in progress"),
+    }
+
+    async def run():
+        for key, (task, status) in todos.items():
+            await store.aput(("todo", "alice"), key, {"task": task, "status": status})
+        found = await asearch_relevant(store, ("todo", "alice"), "buy milk", 3, ["not started", "in progress"])
+        everything = await asearch_relevant(store, ("todo", "alice"), "buy milk", 3)
+        return found, everything
+
+    found, everything = asyncio.run(run())
+
+    # the done task is left out, the milk tasks of both statuses rank before the others
+    assert [item.key for item in found][:2] in (["1", "2"], ["2", "1"])
+    assert len(found) == 3 and "4" not in {item.key for item in found}
+    assert [item.score for item in found] == sorted((item.score for item in found), reverse=True)
+    assert everything[0].key == "4"
+
+
+def test_unscored_results_keep_their_order_after_the_scored_ones():
+    now = datetime.now(timezone.utc)
+
+    def result(key, score):
+        return SearchItem(namespace=("todo",), key=key, value={}, created_at=now, updated_at=now, score=score)
+
+    pages = [[result("a", None), result("b", 0.2)], [result("c", None), result("d", 0.9)]]
+    assert [item.key for item in _by_score(pages, 3)] == ["d", "b", "a"]
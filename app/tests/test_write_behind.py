@@ -0,0 +1,52 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.store.memory import InMemoryStore
+
+import agents.personal_assistant as personal_assistant
+from agents.write_behind import MemoryUpdateQueue
+
+
+def update_request(call_id: str) -> AIMessage:
+    return AIMessage(content="", id=f"ai-{call_id}",
+                     tool_calls=[{"name": "UpdateMemory", "args": {"update_type": "user"}, "id": call_id}])
+
+
+def test_failed_background_update_keeps_its_turns_for_the_next_extraction(monkeypatch):
+    windows = []
+
+    async def update_profile(state, config, store):
+        window, _, cursor_update = personal_assistant.get_extraction_messages(state, "profile")
+        windows.append([message.content for message in window if isinstance(message, HumanMessage)])
+        if len(windows) == 1:
+            raise RuntimeError("extractor unavailable")
+        return {"messages": [], "extraction_cursors": cursor_update}
+
+    monkeypatch.setattr(personal_assistant, "update_profile", update_profile)
+
+    async def run():
+        queue = MemoryUpdateQueue()
+        await queue.start()
+        store = InMemoryStore()
+        schedule = personal_assistant.create_schedule_memory_update(queue)
+        config = {"configurable": {"user_id": "alice", "thread_id": "alice_main"}}
+
+        messages = [HumanMessage("I live in Berlin", id="h1"), update_request("c1")]
+        update = await schedule({"messages": messages}, config, store)
+        assert "extraction_cursors" not in update
+        await queue.flush("alice")
+
+        messages += [ToolMessage("scheduled", tool_call_id="c1"), AIMessage("Noted", id="a1"),
+                     HumanMessage("I'm a nurse", id="h2"), update_request("c2")]
+        await schedule({"messages": messages}, config, store)
+        await queue.flush("alice")
+
+        messages += [ToolMessage("scheduled", tool_call_id="c2"), AIMessage("Noted", id="a2"),
+                     HumanMessage("I like climbing", id="h3"), update_request("c3")]
+        await schedule({"messages": messages}, config, store)
+        await queue.close()
+
+    asyncio.run(run())
+
+    # the failed extraction's turn is extracted by the next update, and only once it committed is it skipped
+    assert windows == [["I live in Berlin"], ["I live in Berlin", "I'm a nurse"], ["I like climbing"]]